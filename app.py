@@ -14,6 +14,7 @@ import tkinter as tk
 from tkinter import ttk
 
 import requests
+from client_http import backoff_remaining, enable_conditional_get, enable_rate_limit_backoff
 # manager_app.py
 # Отправляет заявки на server.py
 # pip install requests
@@ -47,6 +48,7 @@ LOGIN_BG_PATH = r"login_background.png"      # <-- сюда путь к .png/.gi
 
 API_URL = os.getenv("API_URL", "http://34.179.169.197:5002")
 HTTP_TIMEOUT = 6
+ORDERS_BATCH_TIMEOUT = 20  # одна публикация на всю пачку заявок
 
 # Token file (persist across sessions regardless of current working directory)
 def app_base_dir() -> str:
@@ -89,9 +91,6 @@ def safe_json(resp: requests.Response) -> Dict[str, Any]:
         return {}
 
 
-
-
-
 def load_login_image(path: str):
     """
     Пытаемся загрузить фон/иконку для окна логина.
@@ -354,7 +353,6 @@ def error(parent: tk.Misc, title: str, text: str) -> None:
     dark_message(parent, title, text, "error")
 
 
-
 def exit_app(parent: tk.Misc, message: str = "Ключ продукта недействителен") -> None:
     """Показывает окно ошибки и завершает программу."""
     try:
@@ -385,11 +383,15 @@ class AppGUI:
 
         self.http = requests.Session()
         self.http.headers.update(self.headers)
+        enable_rate_limit_backoff(self.http)
+        enable_conditional_get(self.http)
         # License is checked only on login/registration (server-authoritative).
 
         self.active_orders = set()
         self.offers_seen = {}
         self.removed_offers = {}
+        self.offers_after = 0  # change-log version for /market/offers?after= (0 = full state)
+        self.publishing = False  # save_and_run в процессе
         self.polling_active = False
         self.temp_id_counter = -1
 
@@ -890,10 +892,10 @@ class AppGUI:
     def save_and_run(self):
         if not self.id_map:
             return
+        if self.publishing:
+            return
 
-        info(self.root, "Публикация", "Заявки загружены. Пожалуйста, ожидайте откликов.")
-
-        first = True
+        pending = []
         for item, order in list(self.id_map.items()):
             order_id = order[0]
             if order_id is None or int(order_id) < 0:
@@ -906,26 +908,59 @@ class AppGUI:
                     "price": order[6],
                     "info": order[7],
                 }
+                pending.append((item, payload))
 
-                try:
-                    resp = self.http.post(f"{API_URL}/orders/create", json=payload, timeout=10)
-                    if resp.status_code in (200, 201):
-                        new_id = safe_json(resp).get("order_id")
-                        if new_id is not None:
-                            order[0] = int(new_id)
-                            self.active_orders.add(int(new_id))
-                            self.id_map[item] = order
-                        else:
-                            warn(self.root, "Внимание", "Сервер не вернул ID заявки.")
-                    else:
-                        j = safe_json(resp)
-                        error(self.root, "Ошибка", f"Не удалось отправить заявку\n"
-                              f"HTTP {resp.status_code}\n"
-                              f"{j.get('error') or j.get('message') or resp.text}")
-                except Exception as e:
-                    error(self.root, "Ошибка", f"Ошибка при отправке: {e}")
+        info(self.root, "Публикация", "Заявки загружены. Пожалуйста, ожидайте откликов.")
+        if not pending:
+            self.start_polling()
+            return
 
-        self.start_polling()
+        self.publishing = True
+        payloads = [p for _item, p in pending]
+
+        def fail_text(r):
+            return (f"Не удалось отправить заявку\nHTTP {r.status_code}\n" + (safe_json(r).get("error") or safe_json(r).get("message") or r.text))
+
+        def work():
+            # вся пачка одним запросом; старый сервер без /orders/create_batch -> по одной
+            resp = self.http.post(f"{API_URL}/orders/create_batch", json={"orders": payloads}, timeout=ORDERS_BATCH_TIMEOUT)
+            if resp.status_code in (200, 201):
+                ids = safe_json(resp).get("order_ids")
+                if not isinstance(ids, list) or len(ids) != len(payloads):
+                    return [None] * len(payloads), "Сервер не вернул ID заявок."
+                return ids, None
+            if resp.status_code != 404:
+                return [None] * len(payloads), fail_text(resp)
+
+            ids, problem = [], None
+            for payload in payloads:
+                r = self.http.post(f"{API_URL}/orders/create", json=payload, timeout=10)
+                if r.status_code in (200, 201):
+                    ids.append(safe_json(r).get("order_id"))
+                else:
+                    ids.append(None)
+                    problem = problem or fail_text(r)
+            return ids, problem
+
+        def on_ok(result):
+            self.publishing = False
+            ids, problem = result
+            for (item, _payload), new_id in zip(pending, ids):
+                order = self.id_map.get(item)
+                if order is None or new_id is None:
+                    continue
+                order[0] = int(new_id)
+                self.active_orders.add(int(new_id))
+                self.id_map[item] = order
+            if problem:
+                error(self.root, "Ошибка", problem)
+            self.start_polling()
+
+        def on_err(e):
+            self.publishing = False
+            error(self.root, "Ошибка", f"Ошибка при отправке: {e}")
+
+        self.run_http_async(work, on_ok=on_ok, on_err=on_err)
 
     def start_polling(self):
         if not self.polling_active and self.active_orders:
@@ -937,9 +972,35 @@ class AppGUI:
             self.polling_active = False
             return
 
-        order_ids = list(self.active_orders)
+        order_ids = sorted(self.active_orders)
+        after = self.offers_after
 
         def work():
+            # один запрос на все активные заявки
+            try:
+                r = self.http.get(
+                    f"{API_URL}/market/offers",
+                    params={"order_ids": ",".join(str(oid) for oid in order_ids), "after": after},
+                    timeout=HTTP_TIMEOUT,
+                )
+            except Exception:
+                return [], after
+            if r.status_code == 200:
+                j = safe_json(r)
+                groups = j.get("items") if isinstance(j.get("items"), dict) else {}
+                results = []
+                for oid in order_ids:
+                    if str(oid) in groups:
+                        results.append((oid, {"items": groups[str(oid)]}))
+                try:
+                    new_after = int(j.get("after") or after)
+                except Exception:
+                    new_after = after
+                return results, new_after
+            if r.status_code != 404:
+                return [], after
+
+            # старый сервер без batch-эндпоинта
             results = []
             for oid in order_ids:
                 try:
@@ -948,9 +1009,11 @@ class AppGUI:
                         results.append((oid, r.json()))
                 except Exception:
                     pass
-            return results
+            return results, after
 
-        def on_ok(results):
+        def on_ok(res):
+            results, new_after = res
+            self.offers_after = max(self.offers_after, new_after)
             for order_id, offers in results:
                 if order_id not in self.offers_seen:
                     self.offers_seen[order_id] = set()
@@ -993,7 +1056,8 @@ class AppGUI:
                     self.offers_map[row_item] = (order_id, transport_user, off)
 
             if self.active_orders:
-                self.root.after(4000, self.poll_offers)
+                # после 429 ждём не меньше Retry-After
+                self.root.after(max(4000, int(backoff_remaining(self.http) * 1000)), self.poll_offers)
             else:
                 self.polling_active = False
 
@@ -1141,7 +1205,7 @@ class AppGUI:
             return
 
         def work():
-            # server.py ожидает {"ids": [..]} и закрывает заявки + market_orders
+            # server.py ожидает {"ids": [..]}, закрывает заявки + market_orders и возвращает results по каждому id
             return self.http.post(f"{API_URL}/orders/close", json={"ids": ids_to_close}, timeout=HTTP_TIMEOUT)
 
         def on_ok(resp):
@@ -1150,12 +1214,21 @@ class AppGUI:
                 error(self.root, "Ошибка", f"Не удалось закрыть заявки")
                 return
 
+            # results: id -> closed / not_found / not_owner (старый сервер results не присылает)
+            results = safe_json(resp).get("results")
+            if not isinstance(results, dict):
+                results = {}
+            kept = 0
+
             # Удаляем закрытые заявки из UI
             for item in list(to_close):
                 meta = self.id_map.get(item)
                 if not meta:
                     continue
                 oid = int(meta[0])
+                if results.get(str(oid), "closed") not in ("closed", "not_found"):
+                    kept += 1
+                    continue
                 self.active_orders.discard(oid)
                 self.offers_seen.pop(oid, None)
                 self.removed_offers.pop(oid, None)
@@ -1171,11 +1244,12 @@ class AppGUI:
 
             if not self.active_orders:
                 self.polling_active = False
+            if kept:
+                warn(self.root, "Внимание", f"Не удалось закрыть заявок: {kept} (нет прав на эти заявки).")
 
         self.run_http_async(work, on_ok=on_ok)
 
 
-
 # ================= Login window =================
 
 def login_to_server(root: tk.Tk) -> Optional[str]:
@@ -0,0 +1,106 @@
+# client_http.py
+# -*- coding: utf-8 -*-
+# Общие HTTP-помощники клиентов (app.py, manager_app.py, transport_app.py): 429/Retry-After, ETag/304, SSE.
+# Правки логики — только здесь, чтобы клиенты не расходились.
+
+import threading
+import time
+from typing import Any, Dict
+
+import requests
+
+
+RATE_LIMIT_MAX_WAIT = 10  # сек: дольше внутри запроса не ждём, 429 уходит вызывающему коду
+
+
+def enable_rate_limit_backoff(session: requests.Session) -> None:
+    """
+    429 от сервера: Retry-After запоминается в session.backoff_until (time.time()).
+    В фоновых потоках короткий Retry-After выжидаем и повторяем запрос один раз;
+    циклы опроса смотрят backoff_remaining() и откладывают следующий тик.
+    """
+    session.backoff_until = 0.0
+    orig_request = session.request
+
+    def _request(method, url, **kwargs):
+        resp = orig_request(method, url, **kwargs)
+        if resp.status_code != 429:
+            return resp
+        try:
+            wait = max(1.0, float(resp.headers.get("Retry-After") or 1))
+        except Exception:
+            wait = 1.0
+        session.backoff_until = max(session.backoff_until, time.time() + wait)
+        if wait <= RATE_LIMIT_MAX_WAIT and not kwargs.get("stream") and threading.current_thread() is not threading.main_thread():
+            time.sleep(wait)
+            resp = orig_request(method, url, **kwargs)
+        return resp
+
+    session.request = _request
+
+
+def backoff_remaining(session: requests.Session) -> float:
+    return max(0.0, getattr(session, "backoff_until", 0.0) - time.time())
+
+
+CONDITIONAL_CACHE_MAX = 64
+
+
+def enable_conditional_get(session: requests.Session) -> None:
+    """
+    GET через session отправляет If-None-Match с последним ETag для этого URL;
+    на 304 возвращается сохранённый ответ (status 200, то же тело) — вызывающий код ничего не замечает.
+    """
+    cache: Dict[str, Any] = {}  # url -> (etag, response)
+    lock = threading.Lock()
+    orig_request = session.request
+
+    def _request(method, url, **kwargs):
+        if str(method).upper() != "GET" or kwargs.get("stream"):
+            return orig_request(method, url, **kwargs)
+        try:
+            key = requests.Request("GET", url, params=kwargs.get("params")).prepare().url
+        except Exception:
+            return orig_request(method, url, **kwargs)
+
+        with lock:
+            hit = cache.get(key)
+        headers = dict(kwargs.pop("headers", None) or {})
+        if hit:
+            headers.setdefault("If-None-Match", hit[0])
+        resp = orig_request(method, url, headers=headers, **kwargs)
+
+        if resp.status_code == 304 and hit:
+            return hit[1]
+        etag = resp.headers.get("ETag")
+        with lock:
+            if resp.status_code == 200 and etag:
+                _ = resp.content  # тело читаем сразу, ответ будет переиспользован
+                if key not in cache and len(cache) >= CONDITIONAL_CACHE_MAX:
+                    cache.pop(next(iter(cache)))
+                cache[key] = (etag, resp)
+            else:
+                cache.pop(key, None)
+        return resp
+
+    session.request = _request
+
+
+def iter_sse_events(resp: requests.Response):
+    """Разбирает text/event-stream: отдаёт (event, id, data_str) по каждому событию."""
+    event, event_id, data_lines = "message", None, []
+    for line in resp.iter_lines(decode_unicode=True):
+        if line is None:
+            continue
+        if line == "":
+            if data_lines:
+                yield event, event_id, "\n".join(data_lines)
+            event, event_id, data_lines = "message", None, []
+        elif line.startswith(":"):
+            continue
+        elif line.startswith("event:"):
+            event = line[6:].strip()
+        elif line.startswith("id:"):
+            event_id = line[3:].strip()
+        elif line.startswith("data:"):
+            data_lines.append(line[5:].lstrip())
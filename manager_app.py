@@ -25,6 +25,7 @@ import requests
 import os
 import json
 
+from client_http import backoff_remaining, enable_conditional_get, enable_rate_limit_backoff, iter_sse_events
 from market_stats_popup import open_market_stats_popup
 
 class AutoScrollbar(ttk.Scrollbar):
@@ -53,6 +54,12 @@ LOGIN_BG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "login_
 
 API_URL = os.getenv("API_URL", "http://34.179.169.197")
 HTTP_TIMEOUT = 6
+ORDERS_BATCH_TIMEOUT = 20  # одна публикация на всю пачку заявок
+
+# Отклики: push через /events/stream, опрос остаётся запасным вариантом
+OFFERS_POLL_MS = 4000
+OFFERS_POLL_STREAM_MS = 30000  # пока поток подключён — опрашиваем редко
+EVENTS_READ_TIMEOUT = 60       # сервер шлёт heartbeat каждые ~15 с
 
 # Token file (persist across sessions regardless of current working directory)
 def app_base_dir() -> str:
@@ -131,6 +138,7 @@ ERROR_CODE_TO_TEXT = {
     "license_expired": "Срок действия ключа истёк. Обратитесь к администратору.",
     "license_app_mismatch": "Этот ключ предназначен для другой версии программы.",
     "device_limit_reached": "Достигнут лимит устройств для этого ключа. Обратитесь к администратору.",
+    "active_device_limit_reached": "Слишком много устройств сейчас работают с этим ключом. Попробуйте позже или обратитесь к администратору.",
 
     # Company ↔ key binding (то, что ты попросил)
     "license_company_required": "Для этого ключа не задана компания. Обратитесь к администратору.",
@@ -183,9 +191,6 @@ def format_api_error(resp: Any, fallback: str = "Произошла ошибка
     return text
 
 
-
-
-
 def load_login_image(path: str):
     """
     Пытаемся загрузить фон/иконку для окна логина.
@@ -261,8 +266,6 @@ def disable_tk_bell(widget: tk.Misc) -> None:
         pass
 
 
-
-
 class RoundedButton(tk.Canvas):
     """
     Canvas-based rounded button (works on all platforms in pure Tkinter).
@@ -754,7 +757,6 @@ def error(parent: tk.Misc, title: str, text: str) -> None:
     dark_message(parent, title, text, "error")
 
 
-
 def exit_app(parent: tk.Misc, message: str = "Ключ продукта недействителен") -> None:
     """Показывает окно ошибки и завершает программу."""
     try:
@@ -911,7 +913,6 @@ class CalendarPopup(tk.Toplevel):
                 btn.grid(row=r, column=c, padx=1, pady=1)
 
 
-
 class AppGUI:
     def __init__(self, root, token: str):
         self.root = root
@@ -926,12 +927,18 @@ class AppGUI:
 
         self.http = requests.Session()
         self.http.headers.update(self.headers)
+        enable_rate_limit_backoff(self.http)
+        enable_conditional_get(self.http)
         # License is checked only on login/registration (server-authoritative).
 
         self.active_orders = set()
         self.offers_seen = {}
         self.removed_offers = {}
+        self.offers_after = 0  # change-log version for /market/offers?after= (0 = full state)
+        self.publishing = False  # save_and_run в процессе
         self.polling_active = False
+        self.stream_connected = False
+        self._stream_stop = threading.Event()
         self.temp_id_counter = -1
 
         root.title("Логистика — заявки (Manager)")
@@ -970,6 +977,7 @@ class AppGUI:
         self.root.bind("<Control-KP_Enter>", lambda _e: self.add_order(), add="+")
 
         self.refresh_orders(initial_fetch=True)
+        self._start_offer_stream()
 
     def _process_ui_queue(self):
         try:
@@ -1242,6 +1250,7 @@ class AppGUI:
         try:
             self.polling_active = False
             self.active_orders.clear()
+            self._stream_stop.set()
         except Exception:
             pass
 
@@ -1837,10 +1846,10 @@ class AppGUI:
     def save_and_run(self):
         if not self.id_map:
             return
+        if self.publishing:
+            return
 
-        info(self.root, "Публикация", "Заявки загружены. Пожалуйста, ожидайте откликов.")
-
-        first = True
+        pending = []
         for item, order in list(self.id_map.items()):
             order_id = order[0]
             if order_id is None or int(order_id) < 0:
@@ -1853,24 +1862,59 @@ class AppGUI:
                     "price": order[6],
                     "info": order[7],
                 }
+                pending.append((item, payload))
 
-                try:
-                    resp = self.http.post(f"{API_URL}/orders/create", json=payload, timeout=10)
-                    if resp.status_code in (200, 201):
-                        new_id = safe_json(resp).get("order_id")
-                        if new_id is not None:
-                            order[0] = int(new_id)
-                            self.active_orders.add(int(new_id))
-                            self.id_map[item] = order
-                        else:
-                            warn(self.root, "Внимание", "Сервер не вернул ID заявки.")
-                    else:
-                        j = safe_json(resp)
-                        error(self.root, "Ошибка", format_api_error(resp, "Не удалось отправить заявку. Попробуйте ещё раз."))
-                except Exception as e:
-                    error(self.root, "Ошибка", ("Не удалось отправить заявку.\n\nПроверьте соединение и попробуйте ещё раз." + (f"\n\n[Тех. детали: {e}]" if SHOW_TECH_ERRORS else "")))
+        info(self.root, "Публикация", "Заявки загружены. Пожалуйста, ожидайте откликов.")
+        if not pending:
+            self.start_polling()
+            return
 
-        self.start_polling()
+        self.publishing = True
+        payloads = [p for _item, p in pending]
+
+        def fail_text(r):
+            return format_api_error(r, "Не удалось отправить заявку. Попробуйте ещё раз.")
+
+        def work():
+            # вся пачка одним запросом; старый сервер без /orders/create_batch -> по одной
+            resp = self.http.post(f"{API_URL}/orders/create_batch", json={"orders": payloads}, timeout=ORDERS_BATCH_TIMEOUT)
+            if resp.status_code in (200, 201):
+                ids = safe_json(resp).get("order_ids")
+                if not isinstance(ids, list) or len(ids) != len(payloads):
+                    return [None] * len(payloads), "Сервер не вернул ID заявок."
+                return ids, None
+            if resp.status_code != 404:
+                return [None] * len(payloads), fail_text(resp)
+
+            ids, problem = [], None
+            for payload in payloads:
+                r = self.http.post(f"{API_URL}/orders/create", json=payload, timeout=10)
+                if r.status_code in (200, 201):
+                    ids.append(safe_json(r).get("order_id"))
+                else:
+                    ids.append(None)
+                    problem = problem or fail_text(r)
+            return ids, problem
+
+        def on_ok(result):
+            self.publishing = False
+            ids, problem = result
+            for (item, _payload), new_id in zip(pending, ids):
+                order = self.id_map.get(item)
+                if order is None or new_id is None:
+                    continue
+                order[0] = int(new_id)
+                self.active_orders.add(int(new_id))
+                self.id_map[item] = order
+            if problem:
+                error(self.root, "Ошибка", problem)
+            self.start_polling()
+
+        def on_err(e):
+            self.publishing = False
+            error(self.root, "Ошибка", ("Не удалось отправить заявку.\n\nПроверьте соединение и попробуйте ещё раз." + (f"\n\n[Тех. детали: {e}]" if SHOW_TECH_ERRORS else "")))
+
+        self.run_http_async(work, on_ok=on_ok, on_err=on_err)
 
     def start_polling(self):
         if not self.polling_active and self.active_orders:
@@ -1882,9 +1926,35 @@ class AppGUI:
             self.polling_active = False
             return
 
-        order_ids = list(self.active_orders)
+        order_ids = sorted(self.active_orders)
+        after = self.offers_after
 
         def work():
+            # один запрос на все активные заявки
+            try:
+                r = self.http.get(
+                    f"{API_URL}/market/offers",
+                    params={"order_ids": ",".join(str(oid) for oid in order_ids), "after": after},
+                    timeout=HTTP_TIMEOUT,
+                )
+            except Exception:
+                return [], after
+            if r.status_code == 200:
+                j = safe_json(r)
+                groups = j.get("items") if isinstance(j.get("items"), dict) else {}
+                results = []
+                for oid in order_ids:
+                    if str(oid) in groups:
+                        results.append((oid, {"items": groups[str(oid)]}))
+                try:
+                    new_after = int(j.get("after") or after)
+                except Exception:
+                    new_after = after
+                return results, new_after
+            if r.status_code != 404:
+                return [], after
+
+            # старый сервер без batch-эндпоинта
             results = []
             for oid in order_ids:
                 try:
@@ -1893,59 +1963,107 @@ class AppGUI:
                         results.append((oid, r.json()))
                 except Exception:
                     pass
-            return results
+            return results, after
 
-        def on_ok(results):
-            for order_id, offers in results:
-                if order_id not in self.offers_seen:
-                    self.offers_seen[order_id] = set()
-                if order_id not in self.removed_offers:
-                    self.removed_offers[order_id] = set()
+        def on_ok(res):
+            results, new_after = res
+            self.offers_after = max(self.offers_after, new_after)
+            self._apply_offer_results(results)
 
-                direction = ""
-                cargo = ""
-                for _item, od in self.id_map.items():
-                    if int(od[0]) == int(order_id):
-                        direction = od[1]
-                        cargo = od[2]
-                        break
+            if self.active_orders:
+                delay = OFFERS_POLL_STREAM_MS if self.stream_connected else OFFERS_POLL_MS
+                # после 429 ждём не меньше Retry-After
+                self.root.after(max(delay, int(backoff_remaining(self.http) * 1000)), self.poll_offers)
+            else:
+                self.polling_active = False
 
-                offers_list = offers.get('items') if isinstance(offers, dict) else offers
-                if not isinstance(offers_list, list):
-                    offers_list = []
+        self.run_http_async(work, on_ok=on_ok)
 
-                for off in offers_list:
-                    transport_user = (off.get("transport_username") or "").strip()
-                    if not transport_user:
-                        continue
+    def _apply_offer_results(self, results):
+        for order_id, offers in results:
+            if order_id not in self.offers_seen:
+                self.offers_seen[order_id] = set()
+            if order_id not in self.removed_offers:
+                self.removed_offers[order_id] = set()
 
-                    if transport_user in self.removed_offers[order_id]:
-                        continue
-                    if transport_user in self.offers_seen[order_id]:
-                        continue
+            direction = ""
+            cargo = ""
+            for _item, od in self.id_map.items():
+                if int(od[0]) == int(order_id):
+                    direction = od[1]
+                    cargo = od[2]
+                    break
+
+            offers_list = offers.get('items') if isinstance(offers, dict) else offers
+            if not isinstance(offers_list, list):
+                offers_list = []
+
+            for off in offers_list:
+                transport_user = (off.get("transport_username") or "").strip()
+                if not transport_user:
+                    continue
 
-                    self.offers_seen[order_id].add(transport_user)
+                if transport_user in self.removed_offers[order_id]:
+                    continue
+                if transport_user in self.offers_seen[order_id]:
+                    continue
 
-                    company = off.get("company", "") or ""
-                    price = off.get("price", "") or ""
-                    contact = off.get("contact", "") or ""
+                self.offers_seen[order_id].add(transport_user)
 
-                    row_item = self.offers.insert(
-                        "",
-                        "end",
-                        values=(UNCHECKED, company, f"{price}$"),
-                    )
-                    self.offers_map[row_item] = (order_id, transport_user, off)
+                company = off.get("company", "") or ""
+                price = off.get("price", "") or ""
+                contact = off.get("contact", "") or ""
 
-            # если открыто окно откликов — обновим
-            self._refresh_offers_dialog_view()
+                row_item = self.offers.insert(
+                    "",
+                    "end",
+                    values=(UNCHECKED, company, f"{price}$"),
+                )
+                self.offers_map[row_item] = (order_id, transport_user, off)
 
-            if self.active_orders:
-                self.root.after(4000, self.poll_offers)
-            else:
-                self.polling_active = False
+        # если открыто окно откликов — обновим
+        self._refresh_offers_dialog_view()
 
-        self.run_http_async(work, on_ok=on_ok)
+    def _start_offer_stream(self):
+        threading.Thread(target=self._offer_stream_loop, daemon=True).start()
+
+    def _offer_stream_loop(self):
+        """Фоновый поток: держит /events/stream и сразу показывает новые отклики."""
+        backoff = 2
+        http = requests.Session()
+        http.headers.update(self.headers)
+        while not self._stream_stop.is_set():
+            try:
+                with http.get(f"{API_URL}/events/stream", stream=True, timeout=(HTTP_TIMEOUT, EVENTS_READ_TIMEOUT)) as r:
+                    if r.status_code in (401, 403, 404):
+                        # сессия закончилась или сервер без потока — остаёмся на опросе
+                        return
+                    if r.status_code != 200:
+                        raise RuntimeError(f"HTTP {r.status_code}")
+                    self.stream_connected = True
+                    backoff = 2
+                    for event, _event_id, data in iter_sse_events(r):
+                        if self._stream_stop.is_set():
+                            return
+                        if event != "offer":
+                            continue
+                        try:
+                            off = json.loads(data)
+                            oid = int(off.get("order_id"))
+                        except Exception:
+                            continue
+                        self.ui_queue.put(lambda oid=oid, off=off: self._on_stream_offer(oid, off))
+            except Exception:
+                pass
+            finally:
+                self.stream_connected = False
+            self._stream_stop.wait(backoff)
+            backoff = min(backoff * 2, 30)
+
+    def _on_stream_offer(self, order_id: int, off: Dict[str, Any]):
+        if order_id not in self.active_orders:
+            return
+        self._apply_offer_results([(order_id, {"items": [off]})])
 
     def on_offer_click(self, event):
         """Ставим галочку только в колонке 'check' (первая колонка)."""
@@ -2156,7 +2274,7 @@ class AppGUI:
             return
 
         def work():
-            # server.py ожидает {"ids": [..]} и закрывает заявки + market_orders
+            # server.py ожидает {"ids": [..]}, закрывает заявки + market_orders и возвращает results по каждому id
             return self.http.post(f"{API_URL}/orders/close", json={"ids": ids_to_close}, timeout=HTTP_TIMEOUT)
 
         def on_ok(resp):
@@ -2165,12 +2283,21 @@ class AppGUI:
                 error(self.root, "Ошибка", format_api_error(resp, "Не удалось закрыть выбранные заявки. Попробуйте ещё раз."))
                 return
 
+            # results: id -> closed / not_found / not_owner (старый сервер results не присылает)
+            results = safe_json(resp).get("results")
+            if not isinstance(results, dict):
+                results = {}
+            kept = 0
+
             # Удаляем закрытые заявки из UI
             for item in list(to_close):
                 meta = self.id_map.get(item)
                 if not meta:
                     continue
                 oid = int(meta[0])
+                if results.get(str(oid), "closed") not in ("closed", "not_found"):
+                    kept += 1
+                    continue
                 self.active_orders.discard(oid)
                 self.offers_seen.pop(oid, None)
                 self.removed_offers.pop(oid, None)
@@ -2186,11 +2313,12 @@ class AppGUI:
 
             if not self.active_orders:
                 self.polling_active = False
+            if kept:
+                warn(self.root, "Внимание", f"Не удалось закрыть заявок: {kept} (нет прав на эти заявки).")
 
         self.run_http_async(work, on_ok=on_ok)
 
 
-
 # ================= Login window =================
 
 def login_to_server(root: tk.Tk) -> Optional[str]:
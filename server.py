@@ -7,20 +7,35 @@ import secrets
 import hashlib
 import sqlite3
 import threading
+import atexit
+import math
+import base64
+import multiprocessing
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import smtplib
 from email.message import EmailMessage
 import re
 import io
-from typing import Optional, Dict, Any, Tuple
+import logging
+from logging.handlers import RotatingFileHandler
+import json
+import queue
+import bisect
+from collections import OrderedDict, deque
+from typing import Optional, Dict, Any, Tuple, List, Callable
 
-from flask import Flask, request, jsonify, send_file, abort, send_from_directory
+from flask import Flask, Response, g, has_request_context, request, jsonify, send_file, abort, send_from_directory, stream_with_context
 
 # server.py
 # РџСЂРёРЅРёРјР°РµС‚ Р·Р°СЏРІРєРё РѕС‚ manager_app Рё РџР•Р Р•РЎР«Р›РђР•Рў РёС… РІ telegram_app
-# pip install fastapi uvicorn requests
+# pip install fastapi uvicorn requests httpx
 
+import asyncio
 from fastapi import FastAPI, HTTPException, Header
-import requests
+from fastapi.responses import JSONResponse, PlainTextResponse
+import httpx
 import uvicorn
 
 forwarder_app = FastAPI()
@@ -32,6 +47,177 @@ SERVER_PORT = 5002
 TELEGRAM_APP_URL = "http://127.0.0.1:5001"  # <-- РР—РњР•РќР РµСЃР»Рё РЅСѓР¶РЅРѕ
 VALID_TOKEN = "SECRET_TOKEN"
 
+# Accepted orders are spooled to disk before the 200, so a sender restart only delays delivery.
+FORWARDER_SPOOL_PATH = os.getenv("FORWARDER_SPOOL_PATH") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "forwarder_spool.db")
+FORWARDER_QUEUE_MAX = int(os.getenv("FORWARDER_QUEUE_MAX", "1000"))         # undelivered orders; beyond this -> 503
+FORWARDER_BATCH_SIZE = int(os.getenv("FORWARDER_BATCH_SIZE", "20"))         # orders taken from the queue per round
+FORWARDER_CONCURRENCY = int(os.getenv("FORWARDER_CONCURRENCY", "8"))        # parallel POSTs / pooled connections
+FORWARDER_TIMEOUT_SECONDS = float(os.getenv("FORWARDER_TIMEOUT_SECONDS", "5"))
+FORWARDER_BACKOFF_MAX_SECONDS = float(os.getenv("FORWARDER_BACKOFF_MAX_SECONDS", "60"))
+FORWARDER_RETRY_AFTER_SECONDS = 5
+
+
+class ForwarderSpool:
+    """
+    Disk copy of the forwarder queue (separate SQLite file). Rows are inserted on accept and deleted on delivery;
+    whatever is left is replayed on startup. Rejected (4xx) orders stay with status='dead'.
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+        CREATE TABLE IF NOT EXISTS spool (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          payload TEXT NOT NULL,
+          status TEXT NOT NULL DEFAULT 'pending',   -- pending / dead
+          attempts INTEGER NOT NULL DEFAULT 0,
+          last_error TEXT DEFAULT '',
+          created_at INTEGER NOT NULL
+        )
+        """)
+        self._conn.commit()
+
+    def add(self, order: Dict[str, Any]) -> int:
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO spool (payload, created_at) VALUES (?, ?)",
+                (json.dumps(order, ensure_ascii=False), int(time.time())),
+            )
+            self._conn.commit()
+            return int(cur.lastrowid)
+
+    def pending(self) -> List[Tuple[int, Dict[str, Any]]]:
+        with self._lock:
+            rows = self._conn.execute("SELECT id, payload FROM spool WHERE status='pending' ORDER BY id").fetchall()
+        return [(int(r[0]), json.loads(r[1])) for r in rows]
+
+    def finish(self, delivered: List[int], failed: List[Tuple[str, int]], dead: List[Tuple[str, int]]) -> None:
+        with self._lock:
+            if delivered:
+                self._conn.executemany("DELETE FROM spool WHERE id=?", [(i,) for i in delivered])
+            if failed:
+                self._conn.executemany("UPDATE spool SET attempts=attempts+1, last_error=? WHERE id=?", failed)
+            if dead:
+                self._conn.executemany("UPDATE spool SET status='dead', attempts=attempts+1, last_error=? WHERE id=?", dead)
+            self._conn.commit()
+
+
+class OrderForwarder:
+    """
+    Accept -> spool -> asyncio queue -> batches of concurrent POSTs over one pooled httpx.AsyncClient.
+    Network errors and 5xx/429 are retried with backoff (forever: the sender being down is not a reason to drop);
+    other 4xx mean the sender rejected the order and it is parked as dead in the spool.
+    """
+
+    def __init__(self):
+        self.spool: Optional[ForwarderSpool] = None
+        self.queue: Optional["asyncio.Queue[Tuple[int, Dict[str, Any], int]]"] = None
+        self.client: Optional[httpx.AsyncClient] = None
+        self.depth = 0  # accepted but not yet delivered/dead; admission control bounds the queue with it
+        self._worker: Optional["asyncio.Task[None]"] = None
+        self._requeues: "set[asyncio.Task[None]]" = set()  # strong refs so pending retries are not collected
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    async def start(self) -> None:
+        self.spool = await asyncio.to_thread(ForwarderSpool, FORWARDER_SPOOL_PATH)
+        self._slots = asyncio.Semaphore(max(1, FORWARDER_CONCURRENCY))
+        self.queue = asyncio.Queue()
+        self.client = httpx.AsyncClient(
+            timeout=FORWARDER_TIMEOUT_SECONDS,
+            limits=httpx.Limits(max_connections=FORWARDER_CONCURRENCY, max_keepalive_connections=FORWARDER_CONCURRENCY),
+        )
+        backlog = await asyncio.to_thread(self.spool.pending)
+        for spool_id, order in backlog:
+            self.queue.put_nowait((spool_id, order, 0))
+        self.depth = len(backlog)
+        if backlog:
+            print(f"[FORWARDER] replaying {len(backlog)} spooled order(s)")
+        self._worker = asyncio.create_task(self._deliver_loop())
+
+    async def stop(self) -> None:
+        if self._worker:
+            self._worker.cancel()
+        for task in list(self._requeues):
+            task.cancel()
+        if self.client:
+            await self.client.aclose()
+
+    def full(self) -> bool:
+        return self.depth >= FORWARDER_QUEUE_MAX
+
+    async def submit(self, order: Dict[str, Any]) -> None:
+        self.depth += 1
+        try:
+            spool_id = await asyncio.to_thread(self.spool.add, order)  # type: ignore[union-attr]
+        except Exception:
+            self.depth -= 1
+            raise
+        self.queue.put_nowait((spool_id, order, 0))  # type: ignore[union-attr]
+
+    async def _post(self, order: Dict[str, Any]) -> Tuple[str, str]:
+        """Returns ("ok" | "retry" | "dead", error)."""
+        try:
+            async with self._slots:  # type: ignore[union-attr]
+                r = await self.client.post(TELEGRAM_APP_URL, json=order)  # type: ignore[union-attr]
+        except Exception as e:
+            return "retry", str(e)
+        if r.status_code < 300:
+            return "ok", ""
+        if r.status_code >= 500 or r.status_code in (408, 429):
+            return "retry", f"HTTP {r.status_code}"
+        return "dead", f"HTTP {r.status_code}"
+
+    async def _requeue_later(self, item: Tuple[int, Dict[str, Any], int], delay: float) -> None:
+        await asyncio.sleep(delay)
+        self.queue.put_nowait(item)  # type: ignore[union-attr]
+
+    async def _deliver_loop(self) -> None:
+        while True:
+            batch = [await self.queue.get()]  # type: ignore[union-attr]
+            while len(batch) < FORWARDER_BATCH_SIZE and not self.queue.empty():  # type: ignore[union-attr]
+                batch.append(self.queue.get_nowait())  # type: ignore[union-attr]
+
+            outcomes = await asyncio.gather(*(self._post(order) for _sid, order, _att in batch))
+            delivered: List[int] = []
+            failed: List[Tuple[str, int]] = []
+            dead: List[Tuple[str, int]] = []
+            for (spool_id, order, attempts), (status, error) in zip(batch, outcomes):
+                if status == "ok":
+                    delivered.append(spool_id)
+                elif status == "dead":
+                    dead.append((error, spool_id))
+                    print("[FORWARDER] order rejected by sender:", error)
+                else:
+                    failed.append((error, spool_id))
+                    delay = min(FORWARDER_BACKOFF_MAX_SECONDS, 2.0 ** min(attempts, 10))
+                    task = asyncio.create_task(self._requeue_later((spool_id, order, attempts + 1), delay))
+                    self._requeues.add(task)
+                    task.add_done_callback(self._requeues.discard)
+            self.depth -= len(delivered) + len(dead)
+            try:
+                await asyncio.to_thread(self.spool.finish, delivered, failed, dead)  # type: ignore[union-attr]
+            except Exception as e:
+                # delivered rows left in the spool are re-sent after a restart (at-least-once)
+                print("[FORWARDER] spool update error:", e)
+            if failed and not delivered:
+                print(f"[FORWARDER] sender unavailable ({failed[0][0]}), {self.depth} order(s) waiting")
+
+
+forwarder = OrderForwarder()
+
+
+@forwarder_app.on_event("startup")
+async def forwarder_startup():
+    await forwarder.start()
+
+
+@forwarder_app.on_event("shutdown")
+async def forwarder_shutdown():
+    await forwarder.stop()
+
 
 @forwarder_app.post("/login")
 def login(data: dict):
@@ -41,21 +227,20 @@ def login(data: dict):
 
 
 @forwarder_app.post("/orders/create")
-def create_order(order: dict, authorization: str = Header(None)):
+async def create_order(order: dict, authorization: str = Header(None)):
     if authorization != f"Bearer {VALID_TOKEN}":
         raise HTTPException(status_code=401, detail="bad/expired token")
 
-    # РїРµСЂРµСЃС‹Р»Р°РµРј Р·Р°СЏРІРєСѓ РІ telegram_app
-    try:
-        requests.post(
-            TELEGRAM_APP_URL,
-            json=order,
-            timeout=3
+    if forwarder.full():
+        # backpressure: the client retries later instead of us buffering without bound
+        return JSONResponse(
+            {"error": "forwarder_busy"}, status_code=503,
+            headers={"Retry-After": str(FORWARDER_RETRY_AFTER_SECONDS)},
         )
-    except Exception as e:
-        print("[SERVER] Telegram send error:", e)
 
-    return {"status": "ok"}
+    # РїРµСЂРµСЃС‹Р»Р°РµРј Р·Р°СЏРІРєСѓ РІ telegram_app
+    await forwarder.submit(order)
+    return {"status": "queued"}
 
 
 def run_forwarder():
@@ -74,10 +259,45 @@ MUSIC_DIR = r"music"
 MUSIC_DEFAULT_FILE = ""
 
 DB_PATH = os.getenv("DB_PATH") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "mvp_server.db")
+
 ADMIN_SETUP_KEY = os.getenv("ADMIN_SETUP_KEY", "CHANGE_ME_SETUP_KEY")
 HOST = os.getenv("HOST", "0.0.0.0")
 PORT = int(os.getenv("PORT", "5000"))
+
+# === PRODUCTION SERVING (--serve, gunicorn gthread) ===
+# Every worker is a separate process with its own DB pool, caches and background threads (no preload);
+# sessions, revocations and stream events are shared through the DB. An SSE stream holds one thread for its
+# lifetime, so each worker serves at most STREAMS_MAX_PER_WORKER of them (see below).
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", str(os.cpu_count() or 2)))
+WEB_THREADS = int(os.getenv("WEB_THREADS", "16"))                    # per worker; each may hold one DB_POOL connection
+WEB_KEEPALIVE = int(os.getenv("WEB_KEEPALIVE", "5"))                 # seconds an idle keep-alive connection is kept
+WEB_TIMEOUT = int(os.getenv("WEB_TIMEOUT", "60"))                    # silent worker is killed and replaced after this
+WEB_GRACEFUL_TIMEOUT = int(os.getenv("WEB_GRACEFUL_TIMEOUT", "30"))  # SIGTERM: finish in-flight requests within this
+WEB_MAX_REQUESTS = int(os.getenv("WEB_MAX_REQUESTS", "0"))           # recycle a worker after N requests (0 = never)
+WEB_ACCESS_LOG = os.getenv("WEB_ACCESS_LOG", "0") == "1"
+
+# === DB CONNECTIONS ===
+# Request threads and the background threads of a process (touch flusher, outbox dispatcher, sweeper, change tail)
+# share one pool. It must hold WEB_THREADS plus those, or a fully busy worker starves them (and they it):
+# requests then wait DB_POOL_TIMEOUT_SECONDS and fail with "db pool exhausted". Raise both together.
+DB_POOL_BACKGROUND_CONNECTIONS = 4
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", str(WEB_THREADS + DB_POOL_BACKGROUND_CONNECTIONS)))  # max open per process
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "10"))  # wait for a free connection
+DB_HEALTHCHECK_IDLE_SECONDS = float(os.getenv("DB_HEALTHCHECK_IDLE_SECONDS", "30"))  # ping connections idle longer than this
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")                    # NORMAL is durable enough with WAL
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "65536"))           # page cache per connection
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+MAX_CONTENT_LENGTH = int(os.getenv("MAX_CONTENT_LENGTH", str(10 * 1024 * 1024)))  # request body limit (413 above)
 MARKET_MY_OFFERS_MAX_HOURS = 24 * 30
+MARKET_OFFERS_BATCH_MAX_ORDERS = int(os.getenv("MARKET_OFFERS_BATCH_MAX_ORDERS", "500"))
+MARKET_OFFERS_BATCH_MAX_CHANGES = int(os.getenv("MARKET_OFFERS_BATCH_MAX_CHANGES", "2000"))  # offers per call; the rest next poll
+SYNC_DEFAULT_LIMIT = int(os.getenv("SYNC_DEFAULT_LIMIT", "500"))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "1000"))  # upper bound for ?limit= on paginated listings
+ORDERS_BATCH_MAX = int(os.getenv("ORDERS_BATCH_MAX", "200"))  # max orders per POST /orders/create_batch
+SQL_IN_CHUNK = 500  # ids per IN (...) list; stays under SQLite's host-parameter limit on old builds
+SYNC_MAX_LIMIT = int(os.getenv("SYNC_MAX_LIMIT", "2000"))
 
 REQUIRE_DEVICE_ID = os.getenv("REQUIRE_DEVICE_ID", "1") == "1"
 REQUIRE_APP_IN_LOGIN = os.getenv("REQUIRE_APP_IN_LOGIN", "1") == "1"
@@ -95,6 +315,101 @@ ENFORCE_LICENSE_ON_EACH_REQUEST = os.getenv("ENFORCE_LICENSE_ON_EACH_REQUEST", "
 # If True, any non-admin user MUST have a license_key_used set. If it's empty/NULL -> API returns 403 license_required.
 REQUIRE_LICENSE_FOR_NON_ADMIN = os.getenv("REQUIRE_LICENSE_FOR_NON_ADMIN", "1") == "1"
 
+# === AUTH CACHE ===
+# Successful require_auth() verdicts (token valid, account active, license ok) are cached in memory per token.
+# Revocations and license changes drop entries immediately in the process that makes them and reach other
+# processes (workers, CLI) through the revocations table within SESSION_SYNC_INTERVAL_SECONDS.
+# The TTL still bounds staleness for anything that bypasses those paths. 0 disables the cache.
+AUTH_CACHE_TTL_SECONDS = float(os.getenv("AUTH_CACHE_TTL_SECONDS", "10"))
+
+# === PASSWORD HASHING ===
+# New hashes use scrypt; legacy unsalted sha256 hashes are upgraded on the next successful login.
+PASSWORD_SCRYPT_N = int(os.getenv("PASSWORD_SCRYPT_N", str(2 ** 14)))  # CPU/memory cost (128 * N * r bytes)
+PASSWORD_SCRYPT_R = int(os.getenv("PASSWORD_SCRYPT_R", "8"))
+PASSWORD_SCRYPT_P = int(os.getenv("PASSWORD_SCRYPT_P", "1"))
+# KDF runs in a process pool so request threads only wait on it; 0 = hash inline in the request thread
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(max(1, min(4, (os.cpu_count() or 2) // 2)))))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))    # queued KDF jobs; beyond -> 503
+PASSWORD_HASH_WAIT_SECONDS = float(os.getenv("PASSWORD_HASH_WAIT_SECONDS", "2"))  # wait for a queue slot
+
+# === RATE LIMITING (token buckets, per process) ===
+# Budgets are "requests per second" refill + burst size, per endpoint class. Each request is charged to its token
+# and to its user (budget x RATE_USER_MULTIPLIER, so a few machines per account still fit); requests without a
+# token known to this process are charged to the client IP instead. Rejections are 429 with Retry-After.
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_POLL_RPS = float(os.getenv("RATE_POLL_RPS", "2"))          # GET endpoints
+RATE_POLL_BURST = float(os.getenv("RATE_POLL_BURST", "30"))
+RATE_WRITE_RPS = float(os.getenv("RATE_WRITE_RPS", "1"))        # POST/PUT/PATCH/DELETE
+RATE_WRITE_BURST = float(os.getenv("RATE_WRITE_BURST", "20"))
+RATE_STREAM_RPS = float(os.getenv("RATE_STREAM_RPS", "0.1"))    # SSE (re)connects
+RATE_STREAM_BURST = float(os.getenv("RATE_STREAM_BURST", "6"))
+RATE_AUTH_RPS = float(os.getenv("RATE_AUTH_RPS", "0.2"))        # /login, /register (per IP)
+RATE_AUTH_BURST = float(os.getenv("RATE_AUTH_BURST", "10"))
+RATE_USER_MULTIPLIER = float(os.getenv("RATE_USER_MULTIPLIER", "4"))
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+RATE_LIMIT_TRUST_PROXY = os.getenv("RATE_LIMIT_TRUST_PROXY", "0") == "1"  # take the client IP from X-Forwarded-For
+
+# === METRICS (/metrics, Prometheus text format; numbers are per process) ===
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")          # if set, /metrics requires "Authorization: Bearer <token>"
+# count statements via an sqlite3 trace callback: it expands the SQL of every statement, so it is opt-in
+METRICS_SQL_COUNT = os.getenv("METRICS_SQL_COUNT", "0") == "1"
+
+# === SQL TRACING (opt-in: wraps every pooled cursor, costs a few microseconds per statement) ===
+SQL_TRACE_ENABLED = os.getenv("SQL_TRACE_ENABLED", "0") == "1"
+SQL_SLOW_MS = float(os.getenv("SQL_SLOW_MS", "50"))                       # execute + fetch time that counts as slow
+SQL_SLOW_LOG_PATH = os.getenv("SQL_SLOW_LOG_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "slow_queries.log"))
+SQL_SLOW_LOG_MAX_BYTES = int(os.getenv("SQL_SLOW_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+SQL_SLOW_LOG_BACKUPS = int(os.getenv("SQL_SLOW_LOG_BACKUPS", "5"))
+SQL_SLOW_LOG_VALUES = os.getenv("SQL_SLOW_LOG_VALUES", "0") == "1"       # log the expanded SQL with bound values (may contain secrets)
+SQL_TRACE_MAX_STATEMENTS = int(os.getenv("SQL_TRACE_MAX_STATEMENTS", "2000"))  # distinct statement shapes kept in memory
+
+# How often each process replays the shared revocations table (checked lazily on the auth path)
+SESSION_SYNC_INTERVAL_SECONDS = float(os.getenv("SESSION_SYNC_INTERVAL_SECONDS", "1"))
+
+# sessions.last_seen / license_activations.last_seen are buffered in memory and written in one batch this often
+TOUCH_FLUSH_INTERVAL_SECONDS = float(os.getenv("TOUCH_FLUSH_INTERVAL_SECONDS", "5"))
+
+# === EVENT STREAM (SSE) ===
+EVENTS_HEARTBEAT_SECONDS = float(os.getenv("EVENTS_HEARTBEAT_SECONDS", "15"))  # also how often the token is re-checked
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "256"))                 # per connection; overflow is dropped
+MARKET_FEED_BACKLOG = int(os.getenv("MARKET_FEED_BACKLOG", "5000"))            # market events kept for resume
+EVENTS_POLL_SECONDS = float(os.getenv("EVENTS_POLL_SECONDS", "0.5"))           # other workers' events show up this late
+# open streams per worker beyond this get 503 + Retry-After (clients poll meanwhile); the rest of WEB_THREADS
+# stays free for ordinary requests
+STREAMS_MAX_PER_WORKER = int(os.getenv("STREAMS_MAX_PER_WORKER", str(max(1, WEB_THREADS // 2))))
+
+# === MARKET SNAPSHOT (/market/orders and /market/stats/orders served from memory) ===
+MARKET_SNAPSHOT_ENABLED = os.getenv("MARKET_SNAPSHOT_ENABLED", "1") == "1"
+MARKET_SNAPSHOT_CHECK_SECONDS = float(os.getenv("MARKET_SNAPSHOT_CHECK_SECONDS", "0.5"))   # other workers' writes show up this late
+MARKET_SNAPSHOT_REBUILD_SECONDS = float(os.getenv("MARKET_SNAPSHOT_REBUILD_SECONDS", "300"))  # full rebuild even without changes
+MARKET_SNAPSHOT_MAX_DELTA = int(os.getenv("MARKET_SNAPSHOT_MAX_DELTA", "2000"))            # more public changes -> rebuild
+
+# === OUTBOX (post-commit side effects: telegram) ===
+OUTBOX_DISPATCHER_ENABLED = os.getenv("OUTBOX_DISPATCHER_ENABLED", "1") == "1"  # 0: this process only enqueues
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "2"))              # idle poll; commits wake it sooner
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))                # then the row is parked as 'dead'
+OUTBOX_BACKOFF_BASE_SECONDS = int(os.getenv("OUTBOX_BACKOFF_BASE_SECONDS", "5"))
+OUTBOX_BACKOFF_MAX_SECONDS = int(os.getenv("OUTBOX_BACKOFF_MAX_SECONDS", "900"))
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "120"))            # claimed rows are retried after this if we crash
+
+# === SWEEPER (background cleanup of expired/abandoned rows) ===
+SWEEPER_ENABLED = os.getenv("SWEEPER_ENABLED", "1") == "1"
+SWEEP_INTERVAL_SECONDS = float(os.getenv("SWEEP_INTERVAL_SECONDS", "300"))
+SWEEP_BATCH_SIZE = int(os.getenv("SWEEP_BATCH_SIZE", "500"))            # rows per DELETE transaction
+SWEEP_MAX_BATCHES = int(os.getenv("SWEEP_MAX_BATCHES", "40"))           # per table per run; the rest waits for the next run
+SWEEP_BATCH_PAUSE_SECONDS = float(os.getenv("SWEEP_BATCH_PAUSE_SECONDS", "0.05"))  # lets request writers take the lock
+REVOCATION_RETENTION_SECONDS = int(os.getenv("REVOCATION_RETENTION_SECONDS", "86400"))
+# license_activations idle longer than this are deleted, freeing their device slot. 0 = keep forever
+ACTIVATION_RETENTION_SECONDS = int(os.getenv("ACTIVATION_RETENTION_SECONDS", "0"))
+
+# === ARCHIVE (cold tier: closed orders and their offers move to a separate SQLite file) ===
+# Attached to every pooled connection as schema `archive`; empty = no archiving. The sweeper moves a few batches per pass.
+ARCHIVE_DB_PATH = os.getenv("ARCHIVE_DB_PATH", "")
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))       # closed longer than this
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "200"))      # orders per move (their offers go along)
+
 
 TELEGRAM_ENABLED = os.getenv("TELEGRAM_ENABLED", "0") == "1"
 
@@ -103,6 +418,7 @@ ALLOWED_APPS = {"manager", "transport"}
 
 # ================== APP ==================
 app = Flask(__name__)
+app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DOWNLOADS_DIR = os.path.join(BASE_DIR, "downloads")
@@ -167,15 +483,608 @@ def music_stream():
     return send_file(path, conditional=True, as_attachment=False)
 
 
-data_lock = threading.Lock()
-TOKENS: Dict[str, Dict[str, Any]] = {}
+# ================== METRICS ==================
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SQL_PER_REQUEST_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+class MetricsRegistry:
+    """
+    Counters and histograms sharded per thread: each request thread only ever writes its own dict,
+    so the hot path takes no lock. /metrics sums the shards. Gauges are computed by collectors at scrape time.
+    Shards of finished threads are folded into one base dict (the dev server starts a thread per request).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()  # only for registering a new shard / metric
+        self._local = threading.local()
+        self._shards: List[Tuple[threading.Thread, Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float]]] = []
+        self._base: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}  # totals of finished threads
+        self._meta: Dict[str, Tuple[str, str]] = {}  # name -> (type, help), in registration order
+        self._collectors: List[Callable[[], List[Tuple[str, Tuple[Tuple[str, str], ...], float]]]] = []
+
+    def describe(self, name: str, kind: str, help_text: str) -> None:
+        with self._lock:
+            self._meta[name] = (kind, help_text)
+
+    def add_collector(self, fn: Callable[[], List[Tuple[str, Tuple[Tuple[str, str], ...], float]]]) -> None:
+        with self._lock:
+            self._collectors.append(fn)
+
+    def _shard(self) -> Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float]:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = {}
+            self._local.shard = shard
+            with self._lock:
+                self._fold_dead_shards()
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def _fold_dead_shards(self) -> None:
+        # caller holds self._lock; a finished thread can no longer write its shard
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+                continue
+            for key, v in shard.items():
+                self._base[key] = self._base.get(key, 0.0) + v
+        self._shards = live
+
+    def inc(self, name: str, labels: Tuple[Tuple[str, str], ...] = (), value: float = 1.0) -> None:
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0.0) + value
+
+    def observe(self, name: str, labels: Tuple[Tuple[str, str], ...], value: float, buckets: Tuple[float, ...]) -> None:
+        shard = self._shard()
+        # every bucket of the ladder exists from the first observation, so all series expose the same set of le
+        for le in buckets:
+            key = (name + "_bucket", labels + (("le", repr(float(le))),))
+            shard[key] = shard.get(key, 0.0) + (1.0 if value <= le else 0.0)
+        for suffix, v in (("_bucket", 1.0), ("_sum", value), ("_count", 1.0)):
+            key = (name + suffix, labels + ((("le", "+Inf"),) if suffix == "_bucket" else ()))
+            shard[key] = shard.get(key, 0.0) + v
+
+    @staticmethod
+    def _sort_key(sample: Tuple[str, Tuple[Tuple[str, str], ...], float]) -> Tuple:
+        name, labels, _ = sample
+        le = dict(labels).get("le")
+        rest = tuple(kv for kv in labels if kv[0] != "le")
+        return (name, rest, float("inf") if le == "+Inf" else float(le) if le else 0.0)
+
+    @staticmethod
+    def _number(v: float) -> str:
+        return str(int(v)) if v == int(v) and abs(v) < 1e15 else repr(v)
+
+    @staticmethod
+    def _escape(v: str) -> str:
+        return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def render(self) -> str:
+        with self._lock:
+            self._fold_dead_shards()
+            totals = dict(self._base)
+            shards = [shard for _thread, shard in self._shards]
+            collectors = list(self._collectors)
+            meta = list(self._meta.items())
+        for shard in shards:
+            for key, v in dict(shard).items():  # dict() copies without releasing the GIL
+                totals[key] = totals.get(key, 0.0) + v
+        for fn in collectors:
+            try:
+                for name, labels, v in fn():
+                    totals[(name, labels)] = v
+            except Exception as e:
+                print("[METRICS] collector failed:", e)
+
+        by_base: Dict[str, List[Tuple[str, Tuple[Tuple[str, str], ...], float]]] = {}
+        for (name, labels), v in totals.items():
+            base = name
+            for suffix in ("_bucket", "_sum", "_count"):
+                if name.endswith(suffix) and name[: -len(suffix)] in self._meta:
+                    base = name[: -len(suffix)]
+            by_base.setdefault(base, []).append((name, labels, v))
+
+        out: List[str] = []
+        for base, (kind, help_text) in meta:
+            out.append(f"# HELP {base} {help_text}")
+            out.append(f"# TYPE {base} {kind}")
+            for name, labels, v in sorted(by_base.get(base, []), key=self._sort_key):
+                lbl = ",".join(f'{k}="{self._escape(val)}"' for k, val in labels)
+                out.append(f"{name}{{{lbl}}} {self._number(v)}" if lbl else f"{name} {self._number(v)}")
+        return "\n".join(out) + "\n"
+
+
+METRICS = MetricsRegistry()
+METRICS.describe("http_requests_total", "counter", "Finished HTTP requests by route, method and status.")
+METRICS.describe("http_request_duration_seconds", "histogram", "Time to response (first byte for streams) by route.")
+METRICS.describe("http_requests_in_flight", "gauge", "Requests being handled, including open SSE streams.")
+METRICS.describe("db_statements_per_request", "histogram", "SQL statements executed while handling one request.")
+METRICS.describe("db_statements_total", "counter", "SQL statements executed, all threads.")
+METRICS.describe("rate_limited_total", "counter", "Requests rejected with 429 by endpoint class.")
+METRICS.describe("db_slow_statements_total", "counter", "Statements over SQL_SLOW_MS by route (SQL_TRACE_ENABLED only).")
+
+_SQL_TLS = threading.local()
+
+
+def _count_sql(statement: str) -> None:
+    # sqlite3 trace callback: runs in the thread that executes the statement
+    if METRICS_SQL_COUNT:
+        _SQL_TLS.count = getattr(_SQL_TLS, "count", 0) + 1
+        METRICS.inc("db_statements_total")
+    if SQL_TRACE_ENABLED and SQL_SLOW_LOG_VALUES:
+        _SQL_TLS.expanded = statement  # what SQLite actually ran, bound values inlined
+
+
+def _route_labels() -> Tuple[Tuple[str, str], ...]:
+    rule = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    return (("route", rule), ("method", request.method))
+
+
+@app.before_request
+def metrics_begin():
+    if not METRICS_ENABLED:
+        return None
+    g.metrics_start = time.perf_counter()
+    g.metrics_done = False
+    _SQL_TLS.count = 0
+    METRICS.inc("http_requests_in_flight")
+    return None
+
+
+@app.after_request
+def metrics_finish(response):
+    if METRICS_ENABLED and getattr(g, "metrics_start", None) is not None and not g.metrics_done:
+        g.metrics_done = True
+        labels = _route_labels()
+        METRICS.inc("http_requests_total", labels + (("status", str(response.status_code)),))
+        METRICS.observe("http_request_duration_seconds", labels, time.perf_counter() - g.metrics_start, LATENCY_BUCKETS)
+        if METRICS_SQL_COUNT:
+            METRICS.observe("db_statements_per_request", labels[:1], getattr(_SQL_TLS, "count", 0), SQL_PER_REQUEST_BUCKETS)
+    return response
+
+
+@app.teardown_request
+def metrics_teardown(exc):
+    # also runs for unhandled exceptions (after_request does not) and when a streamed response ends
+    if not METRICS_ENABLED or getattr(g, "metrics_start", None) is None:
+        return
+    if not g.metrics_done:
+        g.metrics_done = True
+        labels = _route_labels()
+        METRICS.inc("http_requests_total", labels + (("status", "500"),))
+        METRICS.observe("http_request_duration_seconds", labels, time.perf_counter() - g.metrics_start, LATENCY_BUCKETS)
+    METRICS.inc("http_requests_in_flight", value=-1.0)
+
+
+# ================== SQL TRACING ==================
+_SQL_SPACE_RE = re.compile(r"\s+")
+_SQL_PLACEHOLDER_LIST_RE = re.compile(r"\?(?:\s*,\s*\?)+")
+
+
+def sql_shape(sql: str) -> str:
+    """Statement text with whitespace collapsed and IN (?, ?, ...) lists folded, so chunked queries group together."""
+    return _SQL_PLACEHOLDER_LIST_RE.sub("?, ...", _SQL_SPACE_RE.sub(" ", sql).strip())
+
+
+def _trace_route() -> str:
+    if has_request_context():
+        rule = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        return f"{request.method} {rule}"
+    return "thread:" + threading.current_thread().name
+
+
+class SqlTracer:
+    """
+    Aggregates timed statements by shape: calls, total/max seconds, rows and the routes that ran them.
+    Statements over SQL_SLOW_MS also go to a rotating JSON-lines log; the first slow run of a shape
+    is logged with its EXPLAIN QUERY PLAN, taken on a private read-only connection with the same parameters.
+    """
+
+    def __init__(self, db_path: str):
+        self._db_path = db_path
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, Any]] = {}
+        self._dropped = 0
+        self._explain_lock = threading.Lock()
+        self._explain_conn: Optional[sqlite3.Connection] = None
+        self._log: Optional[logging.Logger] = None
+
+    def _slow_log(self) -> logging.Logger:
+        if self._log is None:
+            log = logging.getLogger("server.slow_sql")
+            log.propagate = False
+            if not log.handlers:
+                handler = RotatingFileHandler(SQL_SLOW_LOG_PATH, maxBytes=SQL_SLOW_LOG_MAX_BYTES, backupCount=SQL_SLOW_LOG_BACKUPS, encoding="utf-8")
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                log.addHandler(handler)
+                log.setLevel(logging.INFO)
+            self._log = log
+        return self._log
+
+    def explain(self, sql: str, params: Any) -> List[str]:
+        """EXPLAIN QUERY PLAN as indented 'detail' lines; never runs the statement itself."""
+        head = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ""
+        if head not in ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE"):
+            return []
+        with self._explain_lock:
+            try:
+                if self._explain_conn is None:
+                    self._explain_conn = sqlite3.connect(f"file:{self._db_path}?mode=ro", uri=True, check_same_thread=False)
+                    if ARCHIVE_DB_PATH:
+                        self._explain_conn.execute("ATTACH DATABASE ? AS archive", (f"file:{ARCHIVE_DB_PATH}?mode=ro",))
+                rows = self._explain_conn.execute("EXPLAIN QUERY PLAN " + sql, params if params is not None else ()).fetchall()
+            except Exception as e:
+                return [f"explain failed: {e}"]
+        depth: Dict[int, int] = {0: -1}
+        out = []
+        for node_id, parent, _unused, detail in rows:
+            depth[node_id] = depth.get(parent, -1) + 1
+            out.append("  " * depth[node_id] + str(detail))
+        return out
+
+    def record(self, sql: str, params: Any, seconds: float, rows: int, expanded: Optional[str] = None) -> None:
+        shape = sql_shape(sql)
+        route = _trace_route()
+        slow = seconds * 1000.0 >= SQL_SLOW_MS
+        first_slow = False
+        with self._lock:
+            st = self._stats.get(shape)
+            if st is None:
+                if len(self._stats) >= SQL_TRACE_MAX_STATEMENTS:
+                    self._dropped += 1
+                    st = None
+                else:
+                    st = {"calls": 0, "total_s": 0.0, "max_s": 0.0, "rows": 0, "slow": 0, "routes": {}, "sample": None, "plan": None}
+                    self._stats[shape] = st
+            if st is not None:
+                st["calls"] += 1
+                st["total_s"] += seconds
+                st["rows"] += rows
+                st["routes"][route] = st["routes"].get(route, 0) + 1
+                if seconds >= st["max_s"]:
+                    st["max_s"] = seconds
+                    st["sample"] = (sql, params)  # kept for EXPLAIN; never returned by the API
+                if slow:
+                    st["slow"] += 1
+                    first_slow = st["plan"] is None
+        if not slow:
+            return
+        METRICS.inc("db_slow_statements_total", (("route", route),))
+        entry: Dict[str, Any] = {"ts": now_ts(), "ms": round(seconds * 1000.0, 3), "rows": rows, "route": route, "sql": shape}
+        if SQL_SLOW_LOG_VALUES and expanded:
+            entry["expanded"] = expanded
+        if first_slow:
+            plan = self.explain(sql, params)
+            with self._lock:
+                if st is not None:
+                    st["plan"] = plan
+            entry["plan"] = plan
+        try:
+            self._slow_log().info(json.dumps(entry, ensure_ascii=False))
+        except Exception as e:
+            print("[SQL] slow log write failed:", e)
+
+    def top(self, limit: int, sort: str = "total") -> Dict[str, Any]:
+        key = {"total": "total_s", "max": "max_s", "calls": "calls", "rows": "rows", "slow": "slow"}.get(sort, "total_s")
+        with self._lock:
+            items = sorted(self._stats.items(), key=lambda kv: kv[1][key], reverse=True)[:limit]
+            snapshot = [(shape, dict(st, routes=dict(st["routes"]))) for shape, st in items]
+            dropped = self._dropped
+        out = []
+        for shape, st in snapshot:
+            plan = st["plan"]
+            if plan is None and st["sample"] is not None:
+                plan = self.explain(*st["sample"])
+                with self._lock:
+                    if shape in self._stats:
+                        self._stats[shape]["plan"] = plan
+            calls = st["calls"] or 1
+            out.append({
+                "sql": shape,
+                "calls": st["calls"],
+                "total_ms": round(st["total_s"] * 1000.0, 3),
+                "avg_ms": round(st["total_s"] * 1000.0 / calls, 3),
+                "max_ms": round(st["max_s"] * 1000.0, 3),
+                "rows": st["rows"],
+                "slow": st["slow"],
+                "routes": dict(sorted(st["routes"].items(), key=lambda kv: kv[1], reverse=True)[:10]),
+                "plan": plan,
+                "full_scan": any(line.lstrip().startswith("SCAN ") for line in plan or []),
+            })
+        return {"items": out, "shapes": len(self._stats), "dropped": dropped}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+            self._dropped = 0
+
+
+SQL_TRACER = SqlTracer(DB_PATH)
+
+
+class TracedCursor:
+    """
+    sqlite3.Cursor wrapper that times execute() and every fetch, and reports the statement when its
+    result is exhausted, the next statement starts, or the cursor goes away.
+    """
+
+    __slots__ = ("_cur", "_sql", "_params", "_seconds", "_rows", "_expanded")
+
+    def __init__(self, cur: sqlite3.Cursor):
+        self._cur = cur
+        self._sql: Optional[str] = None
+        self._params: Any = None
+        self._seconds = 0.0
+        self._rows = 0
+        self._expanded: Optional[str] = None
+
+    def _finish(self) -> None:
+        sql, self._sql = self._sql, None
+        if sql is None:
+            return
+        rows = self._rows
+        if rows == 0:
+            try:
+                rows = max(0, self._cur.rowcount)
+            except Exception:
+                rows = 0
+        SQL_TRACER.record(sql, self._params, self._seconds, rows, self._expanded)
+
+    def _start(self, sql: str, params: Any) -> None:
+        self._finish()
+        self._sql, self._params, self._seconds, self._rows, self._expanded = sql, params, 0.0, 0, None
+
+    def execute(self, sql: str, params: Any = ()):
+        self._start(sql, params)
+        t0 = time.perf_counter()
+        try:
+            self._cur.execute(sql, params)
+        finally:
+            self._seconds += time.perf_counter() - t0
+            self._expanded = getattr(_SQL_TLS, "expanded", None)
+        if self._cur.description is None:
+            self._finish()  # DML/DDL: nothing to fetch
+        return self
+
+    def executemany(self, sql: str, seq_of_params):
+        seq = seq_of_params if isinstance(seq_of_params, (list, tuple)) else list(seq_of_params)
+        self._start(sql, seq[0] if seq else ())
+        t0 = time.perf_counter()
+        try:
+            self._cur.executemany(sql, seq)
+        finally:
+            self._seconds += time.perf_counter() - t0
+        self._finish()
+        return self
+
+    def fetchone(self):
+        t0 = time.perf_counter()
+        row = self._cur.fetchone()
+        self._seconds += time.perf_counter() - t0
+        if row is None:
+            self._finish()
+        else:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, size: Optional[int] = None):
+        t0 = time.perf_counter()
+        rows = self._cur.fetchmany(size if size is not None else self._cur.arraysize)
+        self._seconds += time.perf_counter() - t0
+        self._rows += len(rows)
+        if not rows:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        t0 = time.perf_counter()
+        rows = self._cur.fetchall()
+        self._seconds += time.perf_counter() - t0
+        self._rows += len(rows)
+        self._finish()
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    def close(self) -> None:
+        self._finish()
+        self._cur.close()
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+    def __del__(self):
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+
+# token -> (monotonic expiry, token meta, license activation to touch); only positive verdicts are stored
+auth_cache_lock = threading.Lock()
+AUTH_CACHE: Dict[str, Tuple[float, Dict[str, Any], Optional[Tuple[str, str, str]]]] = {}
+_auth_cache_generation = 0
 
 
 # ================== DB HELPERS ==================
+class PooledConnection:
+    """sqlite3.Connection stand-in handed out by db_connect(). close() gives the connection back to the pool."""
+
+    __slots__ = ("_pool", "_conn")
+
+    def __init__(self, pool: "ConnectionPool", conn: sqlite3.Connection):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        conn = self._conn
+        if conn is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return getattr(conn, name)
+
+    def cursor(self, *args):
+        cur = self.__getattr__("cursor")(*args)
+        return TracedCursor(cur) if SQL_TRACE_ENABLED else cur
+
+    def execute(self, sql: str, params: Any = ()):
+        if SQL_TRACE_ENABLED:
+            return self.cursor().execute(sql, params)
+        return self.__getattr__("execute")(sql, params)
+
+    def executemany(self, sql: str, seq_of_params):
+        if SQL_TRACE_ENABLED:
+            return self.cursor().executemany(sql, seq_of_params)
+        return self.__getattr__("executemany")(sql, seq_of_params)
+
+    def close(self) -> None:
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._pool.release(conn)
+
+    def __del__(self):
+        # handlers that forget close() must not leak a pool slot
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """
+    Bounded pool of configured SQLite connections.
+    A thread gets back the connection it released last, so steady-state request threads keep one connection each;
+    nested db_connect() calls (auth helpers inside a handler) get their own connection, as before.
+    """
+
+    def __init__(self, path: str, size: int, timeout: float):
+        self._path = path
+        self._size = max(1, int(size))
+        self._timeout = float(timeout)
+        self._cond = threading.Condition()
+        self._idle: List[Tuple[int, float, sqlite3.Connection]] = []  # (owner thread, released at, conn)
+        self._open = 0
+
+    def _new_connection(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self._path, check_same_thread=False, timeout=DB_BUSY_TIMEOUT_MS / 1000.0)
+        conn.row_factory = sqlite3.Row
+        for pragma in (
+            "PRAGMA journal_mode=WAL",
+            f"PRAGMA synchronous={DB_SYNCHRONOUS}",
+            f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT_MS)}",
+            f"PRAGMA cache_size=-{int(DB_CACHE_SIZE_KB)}",
+            f"PRAGMA mmap_size={int(DB_MMAP_SIZE)}",
+            "PRAGMA temp_store=MEMORY",
+        ):
+            try:
+                conn.execute(pragma)
+            except sqlite3.Error as e:
+                print("[DB] pragma failed:", pragma, e)
+        if ARCHIVE_DB_PATH:
+            conn.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DB_PATH,))
+            conn.execute("PRAGMA archive.journal_mode=WAL")
+            conn.execute(f"PRAGMA archive.synchronous={DB_SYNCHRONOUS}")
+        if (METRICS_ENABLED and METRICS_SQL_COUNT) or (SQL_TRACE_ENABLED and SQL_SLOW_LOG_VALUES):
+            conn.set_trace_callback(_count_sql)
+        return conn
+
+    @staticmethod
+    def _healthy(conn: sqlite3.Connection) -> bool:
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close_quietly(conn: sqlite3.Connection) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def acquire(self) -> PooledConnection:
+        me = threading.get_ident()
+        deadline = time.monotonic() + self._timeout
+        conn = None
+        released_at = 0.0
+        with self._cond:
+            while True:
+                if self._idle:
+                    idx = len(self._idle) - 1
+                    for i in range(len(self._idle) - 1, -1, -1):
+                        if self._idle[i][0] == me:
+                            idx = i
+                            break
+                    _owner, released_at, conn = self._idle.pop(idx)
+                    break
+                if self._open < self._size:
+                    self._open += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise sqlite3.OperationalError("db pool exhausted")
+                self._cond.wait(remaining)
+
+        if conn is not None and time.monotonic() - released_at > DB_HEALTHCHECK_IDLE_SECONDS and not self._healthy(conn):
+            self._close_quietly(conn)
+            conn = None
+        if conn is None:
+            try:
+                conn = self._new_connection()
+            except Exception:
+                with self._cond:
+                    self._open -= 1
+                    self._cond.notify()
+                raise
+        return PooledConnection(self, conn)
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        # same semantics as closing a plain connection: uncommitted work is discarded
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            reusable = True
+        except Exception:
+            reusable = False
+        with self._cond:
+            if reusable:
+                self._idle.append((threading.get_ident(), time.monotonic(), conn))
+            else:
+                self._open -= 1
+            self._cond.notify()
+        if not reusable:
+            self._close_quietly(conn)
+
+    def close_idle(self) -> None:
+        with self._cond:
+            idle = [c for _o, _t, c in self._idle]
+            self._idle.clear()
+            self._open -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            self._close_quietly(conn)
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {"size": self._size, "open": self._open, "idle": len(self._idle), "in_use": self._open - len(self._idle)}
+
+
+DB_POOL = ConnectionPool(DB_PATH, DB_POOL_SIZE, DB_POOL_TIMEOUT_SECONDS)
+atexit.register(DB_POOL.close_idle)
+
+
 def db_connect():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return DB_POOL.acquire()
 
 
 def now_ts() -> int:
@@ -186,6 +1095,237 @@ def sha256(s: str) -> str:
     return hashlib.sha256(s.encode("utf-8")).hexdigest()
 
 
+# ================== PASSWORDS ==================
+class PasswordHasher(ABC):
+    """One storage scheme that can verify stored hashes. Only PASSWORD_HASHER writes new ones."""
+
+    @abstractmethod
+    def identifies(self, encoded: str) -> bool:
+        ...
+
+    @abstractmethod
+    def verify(self, password: str, encoded: str) -> bool:
+        ...
+
+    def needs_rehash(self, encoded: str) -> bool:
+        return False
+
+
+class ScryptHasher(PasswordHasher):
+    """scrypt$<n>$<r>$<p>$<salt b64>$<hash b64>; parameters travel with the hash, so they can be raised later."""
+
+    def __init__(self, n: int, r: int, p: int):
+        self.n, self.r, self.p = n, r, p
+
+    @staticmethod
+    def _derive(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+        return hashlib.scrypt(password.encode("utf-8"), salt=salt, n=n, r=r, p=p,
+                              maxmem=256 * n * r + 1024 * 1024, dklen=32)
+
+    def identifies(self, encoded: str) -> bool:
+        return encoded.startswith("scrypt$")
+
+    def hash(self, password: str) -> str:
+        salt = secrets.token_bytes(16)
+        dk = self._derive(password, salt, self.n, self.r, self.p)
+        return "$".join(["scrypt", str(self.n), str(self.r), str(self.p),
+                         base64.b64encode(salt).decode("ascii"), base64.b64encode(dk).decode("ascii")])
+
+    def verify(self, password: str, encoded: str) -> bool:
+        try:
+            _scheme, n, r, p, salt_b64, dk_b64 = encoded.split("$")
+            dk = self._derive(password, base64.b64decode(salt_b64), int(n), int(r), int(p))
+        except Exception:
+            return False
+        return hmac.compare_digest(dk, base64.b64decode(dk_b64))
+
+    def needs_rehash(self, encoded: str) -> bool:
+        try:
+            _scheme, n, r, p, _salt, _dk = encoded.split("$")
+            return (int(n), int(r), int(p)) != (self.n, self.r, self.p)
+        except Exception:
+            return True
+
+
+class LegacySha256Hasher(PasswordHasher):
+    """Unsalted sha256 hex, as stored before scrypt. Verify-only: there is deliberately no hash()."""
+
+    def identifies(self, encoded: str) -> bool:
+        return len(encoded) == 64 and "$" not in encoded
+
+    def verify(self, password: str, encoded: str) -> bool:
+        return hmac.compare_digest(sha256(password), encoded)
+
+
+PASSWORD_HASHER = ScryptHasher(PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)  # new passwords
+PASSWORD_HASHERS: List[PasswordHasher] = [PASSWORD_HASHER, LegacySha256Hasher()]  # current scheme first
+
+
+def _password_hash_job(password: str) -> str:
+    return PASSWORD_HASHER.hash(password)
+
+
+def _password_verify_job(password: str, encoded: str) -> Tuple[bool, bool]:
+    """(matches, should be re-hashed with the current scheme/parameters)."""
+    for i, hasher in enumerate(PASSWORD_HASHERS):
+        if hasher.identifies(encoded):
+            ok = hasher.verify(password, encoded)
+            return ok, ok and (i > 0 or hasher.needs_rehash(encoded))
+    return False, False
+
+
+class PasswordHashBusy(Exception):
+    """Too many KDF jobs queued; the caller answers 503 with Retry-After."""
+
+
+_password_pool: Optional[ProcessPoolExecutor] = None
+_password_pool_lock = threading.Lock()
+_password_slots = threading.BoundedSemaphore(max(1, PASSWORD_HASH_MAX_PENDING))
+
+
+def start_password_pool() -> None:
+    """
+    Fork the KDF children. Called by start_runtime() before the process starts any thread, so no child inherits a
+    lock held by another thread. Without a pool (CLI tools, tests) jobs run in the calling thread.
+    """
+    global _password_pool
+    if PASSWORD_HASH_WORKERS <= 0 or _password_pool is not None:
+        return
+    methods = multiprocessing.get_all_start_methods()
+    # fork: children only run hashlib, and spawn would re-import this whole module in every child
+    ctx = multiprocessing.get_context("fork" if "fork" in methods else None)
+    pool = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, mp_context=ctx)
+    pool.submit(os.getpid).result()  # a fork pool starts all of its children on the first job
+    _password_pool = pool
+
+
+def _run_password_job(fn: Callable[..., Any], *args: Any) -> Any:
+    global _password_pool
+    if PASSWORD_HASH_WORKERS <= 0:
+        return fn(*args)
+    if not _password_slots.acquire(timeout=PASSWORD_HASH_WAIT_SECONDS):
+        raise PasswordHashBusy()
+    try:
+        pool = _password_pool
+        if pool is not None:
+            try:
+                return pool.submit(fn, *args).result()
+            except BrokenProcessPool:
+                # a child was killed (OOM, signal). Re-forking now would copy a process full of threads,
+                # so the remaining jobs run here, still bounded by _password_slots; a restart brings the pool back.
+                with _password_pool_lock:
+                    if _password_pool is pool:
+                        _password_pool = None
+                        print("[PASSWORDS] KDF pool broken, hashing in-process until restart")
+                pool.shutdown(wait=False, cancel_futures=True)
+        return fn(*args)
+    finally:
+        _password_slots.release()
+
+
+def hash_password(password: str) -> str:
+    return _run_password_job(_password_hash_job, password)
+
+
+_dummy_password_hash: Optional[str] = None
+
+
+def dummy_password_hash() -> str:
+    """Verified instead of a real hash when the username is unknown (same scheme and cost). Made on first use."""
+    global _dummy_password_hash
+    if _dummy_password_hash is None:
+        _dummy_password_hash = hash_password(secrets.token_urlsafe(16))
+    return _dummy_password_hash
+
+
+def verify_password_upgrade(password: str, password_hash: str) -> Tuple[bool, bool]:
+    """Returns (ok, needs_rehash). May raise PasswordHashBusy."""
+    return _run_password_job(_password_verify_job, password, password_hash or "")
+
+
+def _shutdown_password_pool() -> None:
+    global _password_pool
+    pool, _password_pool = _password_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+atexit.register(_shutdown_password_pool)
+
+
+def password_busy_response():
+    resp = jsonify({"error": "busy", "retry_after": 1})
+    resp.headers["Retry-After"] = "1"
+    return resp, 503
+
+
+# ================== WRITE-BEHIND last_seen ==================
+# last_seen is informational (and used for the active-device window), so it does not need a commit per request.
+# Request threads only record the newest timestamp here; a background thread writes everything in one transaction.
+touch_lock = threading.Lock()
+_PENDING_SESSION_TOUCH: Dict[str, int] = {}
+_PENDING_ACTIVATION_TOUCH: Dict[Tuple[str, str, str], int] = {}
+
+
+def queue_session_touch(token: str, ts: int) -> None:
+    with touch_lock:
+        if ts > _PENDING_SESSION_TOUCH.get(token, 0):
+            _PENDING_SESSION_TOUCH[token] = ts
+
+
+def queue_activation_touch(license_key: str, app_name: str, device_id: str, ts: int) -> None:
+    k = (license_key, app_name, device_id)
+    with touch_lock:
+        if ts > _PENDING_ACTIVATION_TOUCH.get(k, 0):
+            _PENDING_ACTIVATION_TOUCH[k] = ts
+
+
+def flush_touches() -> None:
+    with touch_lock:
+        sessions = dict(_PENDING_SESSION_TOUCH)
+        activations = dict(_PENDING_ACTIVATION_TOUCH)
+        _PENDING_SESSION_TOUCH.clear()
+        _PENDING_ACTIVATION_TOUCH.clear()
+    if not sessions and not activations:
+        return
+
+    conn = None
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.executemany(
+            "UPDATE sessions SET last_seen=? WHERE token=? AND last_seen<?",
+            [(ts, token, ts) for token, ts in sessions.items()],
+        )
+        cur.executemany(
+            "UPDATE license_activations SET last_seen=? WHERE license_key=? AND app=? AND device_id=? AND last_seen<?",
+            [(ts, k, a, d, ts) for (k, a, d), ts in activations.items()],
+        )
+        conn.commit()
+    except Exception as e:
+        print("[TOUCH] flush error:", e)
+        # keep the timestamps for the next round unless newer ones arrived meanwhile
+        for token, ts in sessions.items():
+            queue_session_touch(token, ts)
+        for (k, a, d), ts in activations.items():
+            queue_activation_touch(k, a, d, ts)
+    finally:
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+def _touch_flusher_loop() -> None:
+    while True:
+        time.sleep(max(0.5, TOUCH_FLUSH_INTERVAL_SECONDS))
+        flush_touches()
+
+
+atexit.register(flush_touches)
+
+
 CODE_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789@#$%&"
 
 
@@ -259,9 +1399,7 @@ def generate_license_key(length: int = 20) -> str:
 def license_is_expired(expires_at: Optional[int]) -> bool:
     return expires_at is not None and int(expires_at) > 0 and now_ts() > int(expires_at)
 
-def ensure_license_tables():
-    conn = db_connect()
-    cur = conn.cursor()
+def ensure_license_tables(cur: sqlite3.Cursor) -> None:
     cur.execute("""
     CREATE TABLE IF NOT EXISTS license_keys (
       license_key TEXT PRIMARY KEY,
@@ -300,10 +1438,111 @@ def ensure_license_tables():
     except Exception:
         pass
 
-    conn.commit()
-    conn.close()
+class LicenseCache:
+    """
+    License rows and per-(key, app) activated device sets, so a known device on a known key is checked
+    without SQL. The DB stays the source of truth: a device missing from the cached set re-reads the set
+    (another worker may have activated it), and only committed activations ever enter the cache.
+    Every mutation goes through SESSIONS.flush_auth_everywhere(), which clears this cache here and,
+    via the revocations replay, in the other processes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rows: Dict[str, Dict[str, Any]] = {}
+        self._devices: Dict[Tuple[str, str], frozenset] = {}
+        # (key, app) -> device_id -> last_seen, oldest first: expiring the window pops from the front
+        self._active: Dict[Tuple[str, str], "OrderedDict[str, int]"] = {}
+        self._generation = 0
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._rows.clear()
+            self._devices.clear()
+            self._active.clear()
+            self._generation += 1
+
+    def row(self, cur: sqlite3.Cursor, license_key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            hit = self._rows.get(license_key)
+            generation = self._generation
+        if hit is not None:
+            return hit
+        cur.execute(
+            "SELECT app, max_devices, max_users, max_active_devices, expires_at, active FROM license_keys WHERE license_key=?",
+            (license_key,),
+        )
+        r = cur.fetchone()
+        if not r:
+            return None  # unknown keys are not cached: a key created by another process must work at once
+        row = dict(r)
+        with self._lock:
+            if generation == self._generation:
+                self._rows[license_key] = row
+        return row
+
+    def devices(self, cur: sqlite3.Cursor, license_key: str, app_name: str, reload: bool = False) -> frozenset:
+        with self._lock:
+            hit = None if reload else self._devices.get((license_key, app_name))
+            generation = self._generation
+        if hit is not None:
+            return hit
+        cur.execute("SELECT device_id FROM license_activations WHERE license_key=? AND app=?", (license_key, app_name))
+        devices = frozenset(r["device_id"] for r in cur.fetchall())
+        with self._lock:
+            if generation == self._generation:
+                self._devices[(license_key, app_name)] = devices
+        return devices
+
+    def _load_window(self, cur: sqlite3.Cursor, license_key: str, app_name: str, cutoff: int) -> None:
+        # range scan on idx_license_activations_seen; last_seen on disk lags by up to TOUCH_FLUSH_INTERVAL_SECONDS,
+        # so rows merge with what this process has seen (newest wins)
+        cur.execute(
+            "SELECT device_id, last_seen FROM license_activations WHERE license_key=? AND app=? AND last_seen>=? ORDER BY last_seen",
+            (license_key, app_name, cutoff),
+        )
+        rows = cur.fetchall()
+        with self._lock:
+            window = self._active.get((license_key, app_name))
+            merged = {r["device_id"]: int(r["last_seen"]) for r in rows}
+            if window is not None:
+                for dev, seen in window.items():
+                    if seen > merged.get(dev, 0):
+                        merged[dev] = seen
+            self._active[(license_key, app_name)] = OrderedDict(sorted(merged.items(), key=lambda kv: kv[1]))
+
+    def admit_active(self, cur: sqlite3.Cursor, license_key: str, app_name: str, device_id: str, limit: int,
+                     ts: int, record: bool) -> Tuple[bool, int]:
+        """
+        Sliding-window check for max_active_devices: (allowed, devices active in the window).
+        A device already in the window costs a dict lookup; one entering it re-reads the window from the
+        index first, since other workers' devices are only visible there.
+        """
+        cutoff = ts - ACTIVE_DEVICE_WINDOW_SECONDS
+        key = (license_key, app_name)
+        with self._lock:
+            window = self._active.get(key)
+            known = window is not None and window.get(device_id, -1) >= cutoff
+        if not known:
+            self._load_window(cur, license_key, app_name, cutoff)
+        with self._lock:
+            window = self._active.setdefault(key, OrderedDict())
+            while window and next(iter(window.values())) < cutoff:
+                window.popitem(last=False)
+            if device_id not in window and len(window) >= limit:
+                return False, len(window)
+            if record:
+                window[device_id] = max(ts, window.get(device_id, 0))
+                window.move_to_end(device_id)
+            return True, len(window)
+
+    def size(self) -> int:
+        with self._lock:
+            return len(self._rows)
+
+
+LICENSES = LicenseCache()
 
-ensure_license_tables()
 
 def validate_license_and_touch(conn: sqlite3.Connection, license_key: str, app_name: str, device_id: str) -> Tuple[bool, str, Dict[str, Any]]:
     license_key_norm = normalize_license_key(license_key)
@@ -319,8 +1558,7 @@ def validate_license_and_touch(conn: sqlite3.Connection, license_key: str, app_n
         return False, "device_id_required", {}
 
     cur = conn.cursor()
-    cur.execute("SELECT * FROM license_keys WHERE license_key=?", (license_key_fmt,))
-    row = cur.fetchone()
+    row = LICENSES.row(cur, license_key_fmt)
     if not row:
         return False, "license_not_found", {}
     if int(row["active"]) != 1:
@@ -338,19 +1576,29 @@ def validate_license_and_touch(conn: sqlite3.Connection, license_key: str, app_n
     max_active_devices = int(row["max_active_devices"] or 0)
 
     # СЃС‡РёС‚Р°РµРј Р°РєС‚РёРІРёСЂРѕРІР°РЅРЅС‹Рµ СѓСЃС‚СЂРѕР№СЃС‚РІР°
-    cur.execute("SELECT COUNT(DISTINCT device_id) AS c FROM license_activations WHERE license_key=? AND app=?", (license_key_fmt, app_name))
-    c = int(cur.fetchone()["c"] or 0)
-
-    cur.execute("SELECT 1 FROM license_activations WHERE license_key=? AND app=? AND device_id=?", (license_key_fmt, app_name, device_id))
-    already = cur.fetchone() is not None
+    devices = LICENSES.devices(cur, license_key_fmt, app_name)
+    if device_id not in devices:
+        devices = LICENSES.devices(cur, license_key_fmt, app_name, reload=True)
+    c = len(devices)
+    already = device_id in devices
 
     if not already and c >= max_devices:
         return False, "device_limit_reached", {"max_devices": max_devices, "used_devices": c}
 
     ts = now_ts()
+    if max_active_devices > 0:
+        # a new activation is checked but not recorded: the caller may still roll it back
+        ok_active, active = LICENSES.admit_active(cur, license_key_fmt, app_name, device_id, max_active_devices, ts, record=already)
+        if not ok_active:
+            return False, "active_device_limit_reached", {
+                "max_active_devices": max_active_devices,
+                "active_devices": active,
+                "window_seconds": ACTIVE_DEVICE_WINDOW_SECONDS,
+            }
     if already:
-        cur.execute("UPDATE license_activations SET last_seen=? WHERE license_key=? AND app=? AND device_id=?", (ts, license_key_fmt, app_name, device_id))
+        queue_activation_touch(license_key_fmt, app_name, device_id, ts)
     else:
+        # not added to the cache: the caller may still roll back (/license/status does); the next check reloads it
         cur.execute(
             "INSERT INTO license_activations (license_key, app, device_id, activated_at, last_seen) VALUES (?, ?, ?, ?, ?)",
             (license_key_fmt, app_name, device_id, ts, ts),
@@ -359,7 +1607,7 @@ def validate_license_and_touch(conn: sqlite3.Connection, license_key: str, app_n
 
 
 def verify_password(password: str, password_hash: str) -> bool:
-    return hmac.compare_digest(sha256(password), password_hash)
+    return verify_password_upgrade(password, password_hash)[0]
 
 
 def normalize_username(u: Optional[str]) -> str:
@@ -369,10 +1617,7 @@ def normalize_username(u: Optional[str]) -> str:
     return u.lower()
 
 
-def db_init():
-    conn = db_connect()
-    cur = conn.cursor()
-
+def db_init(cur: sqlite3.Cursor) -> None:
     cur.execute("""
     CREATE TABLE IF NOT EXISTS users (
       username TEXT PRIMARY KEY,
@@ -451,13 +1696,8 @@ def db_init():
     )
     """)
 
-    conn.commit()
-    conn.close()
-
 
-def db_migrate_users():
-    conn = db_connect()
-    cur = conn.cursor()
+def db_migrate_users(cur: sqlite3.Cursor) -> None:
     cur.execute("PRAGMA table_info(users)")
     cols = {row[1] for row in cur.fetchall()}
 
@@ -478,160 +1718,999 @@ def db_migrate_users():
     if "active" not in cols:
         cur.execute("ALTER TABLE users ADD COLUMN active INTEGER NOT NULL DEFAULT 1")
 
-    conn.commit()
-    conn.close()
 
+def db_add_hot_path_indexes(cur: sqlite3.Cursor) -> None:
+    # /orders/my and /market/offers/<id> are indexed by migration 6 on their (created_at, id) page cursor
+    # /market/orders, /market/stats/orders: WHERE m.status='open' JOIN orders ON id (covering)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_market_orders_status ON market_orders(status, order_id)")
+    # /market/my-offers: WHERE transport_username=? [AND created_at>=?] ORDER BY created_at DESC, id DESC
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_market_offers_transport ON market_offers(transport_username, created_at, id)")
+    # /register user limit, CLI key disable/delete
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_license_key ON users(license_key_used)")
+    # revoke_all_tokens_for(): DELETE FROM sessions WHERE username=?
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sessions_username ON sessions(username)")
 
-def db_migrate_invite_codes():
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("PRAGMA table_info(invite_codes)")
-    _ = cur.fetchall()
-    conn.commit()
-    conn.close()
 
+def db_create_changes(cur: sqlite3.Cursor) -> None:
+    # Append-only change log, written in the same transaction as the mutation it describes.
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS changes (
+      version INTEGER PRIMARY KEY AUTOINCREMENT,
+      kind TEXT NOT NULL,                -- order_created / orders_closed / offer_upserted / offer_deleted / orders_deleted (+ legacy order_closed / market_status)
+      order_id INTEGER DEFAULT NULL,
+      owner TEXT DEFAULT NULL,           -- manager who owns the order
+      actor TEXT DEFAULT NULL,           -- user who made the change
+      public INTEGER NOT NULL DEFAULT 0, -- 1 = market-wide, visible to every authenticated user
+      payload TEXT NOT NULL DEFAULT '{}',
+      created_at INTEGER NOT NULL
+    )
+    """)
+    # /sync: version > ? AND (public=1 OR owner=? OR actor=?) -> one range seek per branch
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_changes_public ON changes(public, version)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_changes_owner ON changes(owner, version)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_changes_actor ON changes(actor, version)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_changes_order ON changes(order_id, version)")
 
-db_init()
-db_migrate_users()
-db_migrate_invite_codes()
 
-# ================== OPTIONAL TELEGRAM ENGINE ==================
-telegram_engine = None
-if TELEGRAM_ENABLED:
-    try:
-        from telegram_engine import TelegramEngine  # type: ignore
-        telegram_engine = TelegramEngine()
-        print("[TELEGRAM] enabled")
-    except Exception as e:
-        telegram_engine = None
-        print("[TELEGRAM] failed to init:", e)
+def db_add_keyset_indexes(cur: sqlite3.Cursor) -> None:
+    # listings page by (created_at, id) DESC; each index ends with the full cursor so a page is one range seek
+    # /orders/my: WHERE username=? ORDER BY created_at DESC, id DESC
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_username_created ON orders(username, created_at, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_created ON orders(created_at, id)")
+    # /market/offers/<id>: WHERE order_id=? ORDER BY created_at DESC, id DESC
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_market_offers_order_created ON market_offers(order_id, created_at, id)")
 
 
-# ================== AUTH HELPERS ==================
-def get_bearer_token() -> Optional[str]:
-    auth = request.headers.get("Authorization", "")
-    if not auth.startswith("Bearer "):
-        return None
-    return auth.split(" ", 1)[1].strip()
+def db_create_outbox(cur: sqlite3.Cursor) -> None:
+    # side effects written in the same transaction as the business change; drained by OutboxDispatcher.
+    # Delivered rows are deleted, so the table only holds pending work and dead letters.
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS outbox (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      kind TEXT NOT NULL,                   -- telegram_offer
+      payload TEXT NOT NULL,                -- JSON
+      status TEXT NOT NULL DEFAULT 'pending',  -- pending / dead
+      attempts INTEGER NOT NULL DEFAULT 0,
+      next_attempt_at INTEGER NOT NULL,     -- also the lease: a claimed row is pushed into the future
+      last_error TEXT DEFAULT '',
+      created_at INTEGER NOT NULL
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_attempt_at, id)")
 
 
-def revoke_all_tokens_for(username: str):
-    with data_lock:
-        to_del = [t for t, v in TOKENS.items() if v.get("username") == username]
-        for t in to_del:
-            TOKENS.pop(t, None)
-    _session_delete_for_user(username)
+def db_add_activation_window_index(cur: sqlite3.Cursor) -> None:
+    # max_active_devices: "devices of this key seen since T" is a range scan instead of a walk over every activation
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_license_activations_seen ON license_activations(license_key, app, last_seen)")
+
+
+def db_add_sweeper_indexes(cur: sqlite3.Cursor) -> None:
+    # Sweeper: "oldest expired first" must be an index range, not a scan of every session / activation
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_license_activations_last_seen ON license_activations(last_seen)")
 
 
+def db_add_archive_index(cur: sqlite3.Cursor) -> None:
+    # archiver: "closed before T, oldest first" without touching open orders
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_closed_at ON orders(closed_at) WHERE status='closed'")
 
 
-def _session_store(token: str, meta: Dict[str, Any]) -> None:
-    """Persist session token so it survives server restarts."""
+def db_create_revocations(cur: sqlite3.Cursor) -> None:
+    # cross-process invalidation log replayed by SessionStore.sync(); username NULL = drop every cached auth verdict
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS revocations (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      username TEXT,
+      created_at INTEGER NOT NULL
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_revocations_created ON revocations(created_at)")
+
+
+# ================== SCHEMA MIGRATIONS ==================
+# Ordered, append-only. Every step must be idempotent: databases created before schema_version existed
+# replay all steps once. Never edit or renumber a step that has shipped - add a new one.
+MIGRATIONS = [
+    (1, "base tables", db_init),
+    (2, "users columns", db_migrate_users),
+    (3, "license tables", ensure_license_tables),
+    (4, "hot path indexes", db_add_hot_path_indexes),
+    (5, "change log", db_create_changes),
+    (6, "keyset pagination indexes", db_add_keyset_indexes),
+    (7, "outbox", db_create_outbox),
+    (8, "revocations", db_create_revocations),
+    (9, "activation window index", db_add_activation_window_index),
+    (10, "sweeper indexes", db_add_sweeper_indexes),
+    (11, "archive candidates index", db_add_archive_index),
+]
+
+
+def db_migrate() -> None:
+    conn = db_connect()
     try:
-        conn = db_connect()
         cur = conn.cursor()
-        issued_at = int(meta.get("issued_at", now_ts()))
-        last_seen = int(meta.get("last_seen", issued_at))
-        expires_at = issued_at + int(TOKEN_TTL_SECONDS)
-        cur.execute(
-            "INSERT OR REPLACE INTO sessions (token, username, role, app, issued_at, last_seen, expires_at) "
-            "VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (token, meta.get("username"), meta.get("role"), meta.get("app"), issued_at, last_seen, expires_at),
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+          version INTEGER PRIMARY KEY,
+          name TEXT NOT NULL,
+          applied_at INTEGER NOT NULL
         )
+        """)
         conn.commit()
-    except Exception:
-        pass
+
+        for version, name, step in MIGRATIONS:
+            # IMMEDIATE: several worker processes may start at once; only one applies each step
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                cur.execute("SELECT 1 FROM schema_version WHERE version=?", (version,))
+                if cur.fetchone():
+                    conn.rollback()
+                    continue
+                step(cur)
+                cur.execute("INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)", (version, name, now_ts()))
+                conn.commit()
+                print(f"[DB] migration {version} applied: {name}")
+            except Exception:
+                conn.rollback()
+                raise
     finally:
+        conn.close()
+
+
+db_migrate()
+
+
+def record_change(cur: sqlite3.Cursor, kind: str, *, order_id: Optional[int] = None, owner: Optional[str] = None,
+                  actor: Optional[str] = None, public: bool = False, payload: Optional[Dict[str, Any]] = None) -> int:
+    """Append to the change log using the caller's cursor, i.e. inside the caller's transaction. Returns the version."""
+    cur.execute(
+        "INSERT INTO changes (kind, order_id, owner, actor, public, payload, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (kind, order_id, owner, actor, 1 if public else 0, json.dumps(payload or {}, ensure_ascii=False), now_ts()),
+    )
+    return int(cur.lastrowid)
+
+
+def record_changes(cur: sqlite3.Cursor, entries: List[Dict[str, Any]]) -> None:
+    """Bulk form of record_change: entries are dicts of record_change keyword arguments plus "kind"."""
+    ts = now_ts()
+    cur.executemany(
+        "INSERT INTO changes (kind, order_id, owner, actor, public, payload, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+            (e["kind"], e.get("order_id"), e.get("owner"), e.get("actor"), 1 if e.get("public") else 0,
+             json.dumps(e.get("payload") or {}, ensure_ascii=False), ts)
+            for e in entries
+        ],
+    )
+
+
+# ================== CONDITIONAL GET (ETag) ==================
+# List endpoints are validated by the newest change-log version in their scope, which is one index seek.
+# The ETag also covers path, query string and caller, so one validator never matches another view.
+_CHANGE_SCOPE_COLUMNS = {"public": "public", "owner": "owner", "actor": "actor", "order": "order_id"}
+
+
+def change_version(cur: sqlite3.Cursor, scope: str, value: Any = 1) -> int:
+    col = _CHANGE_SCOPE_COLUMNS[scope]
+    cur.execute(f"SELECT version FROM changes WHERE {col}=? ORDER BY version DESC LIMIT 1", (value,))
+    row = cur.fetchone()
+    return int(row[0]) if row else 0
+
+
+def make_etag(version: int, username: str, *extra: Any) -> str:
+    basis = "|".join([request.path, request.query_string.decode("latin-1"), username, *[str(x) for x in extra]])
+    return f'W/"{int(version)}-{sha256(basis)[:16]}"'
+
+
+def etag_matches(etag: str) -> bool:
+    inm = request.headers.get("If-None-Match") or ""
+    if not inm:
+        return False
+    tags = [t.strip() for t in inm.split(",")]
+    return "*" in tags or etag in tags
+
+
+def not_modified(etag: str):
+    resp = Response(status=304)
+    resp.headers["ETag"] = etag
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+
+# ================== KEYSET PAGINATION ==================
+# ?limit=N&cursor=<created_at>:<id>. Pages are ordered by (created_at, id) DESC and the cursor is the last row
+# of the previous page, so every page is a range seek regardless of depth. next_cursor is null on the last page.
+def page_args(default_limit: int):
+    """Returns (limit, cursor, error_response). cursor is (created_at, id) or None."""
+    limit_raw = (request.args.get("limit") or "").strip()
+    cursor_raw = (request.args.get("cursor") or "").strip()
+    try:
+        limit = int(limit_raw) if limit_raw else int(default_limit)
+    except Exception:
+        return 0, None, (jsonify({"error": "bad limit"}), 400)
+    if limit < 1:
+        return 0, None, (jsonify({"error": "bad limit"}), 400)
+    limit = min(limit, PAGE_SIZE_MAX)
+
+    cursor = None
+    if cursor_raw:
+        created_s, _sep, id_s = cursor_raw.partition(":")
         try:
-            conn.close()
+            cursor = (int(created_s), int(id_s))
         except Exception:
-            pass
+            return 0, None, (jsonify({"error": "bad cursor"}), 400)
+    return limit, cursor, None
+
+
+def keyset_page(rows: List[Dict[str, Any]], limit: int, created_key: str = "created_at", id_key: str = "id"):
+    """rows were fetched with LIMIT limit+1. Returns (page, next_cursor)."""
+    if len(rows) <= limit:
+        return rows, None
+    page = rows[:limit]
+    last = page[-1]
+    return page, f"{int(last[created_key] or 0)}:{int(last[id_key])}"
+
+
+def json_with_etag(payload: Dict[str, Any], etag: str):
+    resp = jsonify(payload)
+    resp.headers["ETag"] = etag
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+# ================== EVENT STREAM ==================
+# Both SSE endpoints are fed from the change log, not from the request that made the change: an event written by
+# any worker (or the CLI) reaches the streams of every worker, and event ids are change versions, so any worker
+# can resume any Last-Event-ID.
+class EventBroker:
+    """In-process fan-out of small JSON events to the SSE connections of one user."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subs: Dict[str, List[queue.Queue]] = {}
+
+    def subscribe(self, username: str) -> queue.Queue:
+        q: queue.Queue = queue.Queue(maxsize=EVENTS_QUEUE_SIZE)
+        with self._lock:
+            self._subs.setdefault(username, []).append(q)
+        return q
+
+    def unsubscribe(self, username: str, q: queue.Queue) -> None:
+        with self._lock:
+            subs = self._subs.get(username) or []
+            if q in subs:
+                subs.remove(q)
+            if not subs:
+                self._subs.pop(username, None)
+
+    def publish(self, username: str, event: str, data: Dict[str, Any], version: int) -> None:
+        with self._lock:
+            subs = list(self._subs.get(username) or [])
+        for q in subs:
+            try:
+                q.put_nowait((version, event, data))
+            except queue.Full:
+                # slow consumer: it still has polling as a fallback
+                pass
+
+
+    def connections(self) -> int:
+        with self._lock:
+            return sum(len(subs) for subs in self._subs.values())
+
 
+EVENTS = EventBroker()
 
-def _session_load(token: str) -> Optional[Dict[str, Any]]:
-    """Load session token from DB. Returns meta or None."""
+
+def replay_offer_events(username: str, after: int) -> List[Tuple[int, Dict[str, Any]]]:
+    """Offers on the user's orders logged after `after` (an /events/stream id), oldest first, at most EVENTS_QUEUE_SIZE."""
+    conn = db_connect()
     try:
-        conn = db_connect()
         cur = conn.cursor()
-        cur.execute("SELECT * FROM sessions WHERE token=?", (token,))
-        row = cur.fetchone()
-        if not row:
+        cur.execute(
+            "SELECT version, payload FROM changes WHERE owner=? AND version>? AND kind='offer_upserted' "
+            "ORDER BY version LIMIT ?",
+            (username, after, max(1, EVENTS_QUEUE_SIZE)),
+        )
+        return [(int(r["version"]), json.loads(r["payload"] or "{}")) for r in cur.fetchall()]
+    finally:
+        conn.close()
+
+
+class MarketFeed:
+    """
+    Market events (order_opened / orders_closed) derived from public change-log rows and kept in memory for the
+    streams of this process. Resume tokens are change versions. A token older than the in-memory backlog is
+    replayed from the change log; one more than MARKET_FEED_BACKLOG events behind, or one this DB never issued,
+    cannot be resumed and the client is told to reload the full list instead.
+    """
+
+    def __init__(self, backlog: int):
+        self._cond = threading.Condition()
+        self._backlog = max(1, backlog)
+        self._seq = 0    # newest change version applied (market event or not)
+        self._floor = 0  # _log holds every market event with version > _floor
+        self._log: deque = deque()  # (version, event, data)
+
+    @staticmethod
+    def token(seq: int) -> str:
+        return str(seq)
+
+    @staticmethod
+    def parse_token(token: str) -> Optional[int]:
+        try:
+            seq = int(token)
+        except Exception:
+            return None  # includes "<boot>:<seq>" tokens from before the feed followed the change log
+        return seq if seq >= 0 else None
+
+    @staticmethod
+    def event_for(kind: str, payload: Dict[str, Any]) -> Optional[Tuple[str, Dict[str, Any]]]:
+        if kind == "order_created":
+            return "order_opened", payload
+        if kind == "orders_closed":
+            ids = payload.get("market_ids") or []
+            return ("orders_closed", {"ids": ids}) if ids else None
+        if kind == "orders_deleted":
+            return "orders_closed", {"ids": payload.get("order_ids") or []}
+        return None
+
+    def current(self) -> int:
+        with self._cond:
+            return self._seq
+
+    def start_at(self, version: int) -> None:
+        with self._cond:
+            self._seq = self._floor = version
+
+    def advance(self, events: List[Tuple[int, str, Dict[str, Any]]], head: int) -> None:
+        with self._cond:
+            self._log.extend(events)
+            while len(self._log) > self._backlog:
+                self._floor = self._log.popleft()[0]
+            self._seq = max(self._seq, head)
+            self._cond.notify_all()
+
+    def read(self, after: int, timeout: float) -> Optional[Tuple[int, List[Tuple[int, str, Dict[str, Any]]]]]:
+        """
+        (new position, events with version > after), waiting up to timeout for the log to move past `after`.
+        None = the token cannot be resumed.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._seq > after, timeout)
+            if after > self._seq:
+                return None  # still ahead of the change log after a full wait: not a version of this DB
+            if after >= self._floor:
+                return self._seq, [e for e in self._log if e[0] > after]
+            head = self._seq
+        return self._replay(after, head)
+
+    def _replay(self, after: int, head: int) -> Optional[Tuple[int, List[Tuple[int, str, Dict[str, Any]]]]]:
+        # behind the in-memory log (older token, or this worker started after it was issued): read the change log
+        conn = db_connect()
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT version, kind, payload FROM changes WHERE public=1 AND version>? ORDER BY version LIMIT ?",
+                (after, self._backlog + 1),
+            )
+            rows = cur.fetchall()
+        finally:
+            conn.close()
+        if len(rows) > self._backlog:
             return None
-        row = dict(row)
-        if now_ts() > int(row.get("expires_at", 0)):
+        events = []
+        for r in rows:
+            mapped = self.event_for(r["kind"], json.loads(r["payload"] or "{}"))
+            if mapped:
+                events.append((int(r["version"]), mapped[0], mapped[1]))
+        # every public row after `after` was read, so the stream may continue from the log's head
+        return max([head] + [int(r["version"]) for r in rows]), events
+
+
+MARKET_FEED = MarketFeed(MARKET_FEED_BACKLOG)
+
+
+class ChangeTail:
+    """
+    One thread per process follows the change log and hands new rows to MARKET_FEED and EVENTS. Started by the
+    first stream; polls every EVENTS_POLL_SECONDS, or at once after a local write (poke()).
+    """
+
+    BATCH = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._head = 0
+
+    def ensure_started(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+            conn = db_connect()
             try:
-                cur.execute("DELETE FROM sessions WHERE token=?", (token,))
-                conn.commit()
-            except Exception:
-                pass
-            return None
-        return {
-            "username": row.get("username"),
-            "role": row.get("role"),
-            "app": row.get("app"),
-            "issued_at": int(row.get("issued_at", 0)),
-            "last_seen": int(row.get("last_seen", 0)),
-        }
-    except Exception:
+                cur = conn.cursor()
+                cur.execute("SELECT COALESCE(MAX(version), 0) FROM changes")
+                self._head = int(cur.fetchone()[0])
+            finally:
+                conn.close()
+            MARKET_FEED.start_at(self._head)
+            self._thread = threading.Thread(target=self._run, name="change-tail", daemon=True)
+            self._thread.start()
+
+    def poke(self) -> None:
+        self._wake.set()
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(EVENTS_POLL_SECONDS)
+            self._wake.clear()
+            try:
+                if self._poll() >= self.BATCH:
+                    self._wake.set()  # more behind this batch
+            except Exception as e:
+                print("[STREAM] change log poll failed:", e)
+
+    def _poll(self) -> int:
+        conn = db_connect()
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT version, kind, owner, public, payload FROM changes WHERE version>? ORDER BY version LIMIT ?",
+                (self._head, self.BATCH),
+            )
+            rows = cur.fetchall()
+        finally:
+            conn.close()
+        if not rows:
+            return 0
+        market: List[Tuple[int, str, Dict[str, Any]]] = []
+        for r in rows:
+            version, kind = int(r["version"]), r["kind"]
+            if kind == "offer_upserted":
+                EVENTS.publish(r["owner"], "offer", json.loads(r["payload"] or "{}"), version)
+            elif r["public"]:
+                mapped = MARKET_FEED.event_for(kind, json.loads(r["payload"] or "{}"))
+                if mapped:
+                    market.append((version, mapped[0], mapped[1]))
+        self._head = int(rows[-1]["version"])
+        MARKET_FEED.advance(market, self._head)
+        return len(rows)
+
+
+CHANGE_TAIL = ChangeTail()
+_STREAM_SLOTS = threading.BoundedSemaphore(max(1, STREAMS_MAX_PER_WORKER))
+
+
+def acquire_stream_slot() -> Optional[Callable[[], None]]:
+    """A release callback, or None when this worker already serves STREAMS_MAX_PER_WORKER streams."""
+    if not _STREAM_SLOTS.acquire(blocking=False):
         return None
-    finally:
+    released = []
+
+    def release() -> None:
+        if not released:
+            released.append(True)
+            _STREAM_SLOTS.release()
+
+    return release
+
+
+def streams_busy_response():
+    resp = jsonify({"error": "streams_busy", "retry_after": 30})
+    resp.headers["Retry-After"] = "30"
+    return resp, 503
+
+
+# ================== MARKET SNAPSHOT ==================
+class _MarketView:
+    """One immutable state of the open market: rows newest first, each already serialized for both endpoints."""
+
+    __slots__ = ("version", "keys", "cursors", "market", "stats", "first_pages")
+
+    def __init__(self, version: int, rows: List[Dict[str, Any]]):
+        rows = sorted(rows, key=lambda r: (int(r["created_at"] or 0), int(r["id"])), reverse=True)
+        self.version = version
+        self.keys = [(-int(r["created_at"] or 0), -int(r["id"])) for r in rows]  # ascending, for bisect
+        self.cursors = [f"{int(r['created_at'] or 0)}:{int(r['id'])}" for r in rows]
+        self.market = [json.dumps({k: v for k, v in r.items() if k != "company_name"}, ensure_ascii=False).encode("utf-8") for r in rows]
+        self.stats = [json.dumps({k: r[k] for k in _MARKET_STATS_COLUMNS}, ensure_ascii=False).encode("utf-8") for r in rows]
+        self.first_pages: Dict[Tuple[str, int], bytes] = {}
+
+    def page(self, kind: str, limit: int, cursor: Optional[Tuple[int, int]]) -> bytes:
+        if cursor is None:
+            hit = self.first_pages.get((kind, limit))
+            if hit is not None:
+                return hit
+        start = bisect.bisect_right(self.keys, (-cursor[0], -cursor[1])) if cursor else 0
+        end = start + limit
+        frags = (self.market if kind == "market" else self.stats)[start:end]
+        next_cursor = json.dumps(self.cursors[end - 1] if end < len(self.keys) else None).encode("utf-8")
+        body = b'{"items":[' + b",".join(frags) + b'],"next_cursor":' + next_cursor
+        if kind == "stats":
+            body += b',"total":' + str(len(frags)).encode("ascii")
+        body += b"}"
+        if cursor is None and len(self.first_pages) < 16:
+            self.first_pages[(kind, limit)] = body  # benign race: two threads may build the same bytes
+        return body
+
+
+_MARKET_STATS_COLUMNS = ("id", "username", "direction", "cargo", "tonnage", "truck", "date", "price", "info", "created_at", "company_name")
+_MARKET_SNAPSHOT_SQL = (
+    "SELECT o.*, COALESCE(u.company_name, '') AS company_name FROM orders o "
+    "CROSS JOIN market_orders m ON m.order_id = o.id "
+    "LEFT JOIN users u ON u.username = o.username "
+    "WHERE m.status='open' "
+)
+
+
+class MarketSnapshot:
+    """
+    Copy-on-write snapshot of the open market. Readers take the current _MarketView reference and never lock.
+    Freshness is checked lazily, at most every MARKET_SNAPSHOT_CHECK_SECONDS (immediately after a local write,
+    see poke()): public change-log entries newer than the view name the orders to re-read, and a new view is
+    swapped in. Unknown change kinds, large gaps and MARKET_SNAPSHOT_REBUILD_SECONDS fall back to a full rebuild.
+    """
+
+    def __init__(self):
+        self._view: Optional[_MarketView] = None
+        self._rows: Dict[int, Dict[str, Any]] = {}  # owned by the refreshing thread
+        self._refresh_lock = threading.Lock()
+        self._next_check = 0.0
+        self._next_rebuild = 0.0
+
+    def poke(self) -> None:
+        self._next_check = 0.0
+
+    @staticmethod
+    def _changed_ids(kind: str, payload: Dict[str, Any]) -> Optional[List[int]]:
+        if kind == "order_created":
+            return [int(payload["id"])]
+        if kind == "orders_closed":
+            return [int(x) for x in (payload.get("market_ids") or []) + (payload.get("ids") or [])]
+        if kind in ("orders_deleted", "orders_archived"):
+            return [int(x) for x in payload.get("order_ids") or []]
+        return None
+
+    def _rebuild(self, cur: sqlite3.Cursor, version: int) -> None:
+        cur.execute(_MARKET_SNAPSHOT_SQL)
+        self._rows = {int(r["id"]): dict(r) for r in cur.fetchall()}
+        self._view = _MarketView(version, list(self._rows.values()))
+        self._next_rebuild = time.monotonic() + MARKET_SNAPSHOT_REBUILD_SECONDS
+
+    def _refresh(self) -> None:
+        conn = db_connect()
         try:
+            cur = conn.cursor()
+            cur.execute("BEGIN")  # one read snapshot for the change log and the rows it points at
+            try:
+                view = self._view
+                if view is None or time.monotonic() >= self._next_rebuild:
+                    self._rebuild(cur, change_version(cur, "public"))
+                    return
+                cur.execute(
+                    "SELECT version, kind, payload FROM changes WHERE public=1 AND version>? ORDER BY version LIMIT ?",
+                    (view.version, MARKET_SNAPSHOT_MAX_DELTA + 1),
+                )
+                changes = cur.fetchall()
+                if not changes:
+                    return
+                latest = int(changes[-1]["version"])
+                ids: set = set()
+                for ch in changes:
+                    try:
+                        found = self._changed_ids(ch["kind"], json.loads(ch["payload"] or "{}"))
+                    except Exception:
+                        found = None
+                    if found is None:
+                        break
+                    ids.update(found)
+                else:
+                    if len(changes) <= MARKET_SNAPSHOT_MAX_DELTA:
+                        rows = dict(self._rows)
+                        id_list = sorted(ids)
+                        for oid in id_list:
+                            rows.pop(oid, None)
+                        for i in range(0, len(id_list), SQL_IN_CHUNK):
+                            chunk = id_list[i:i + SQL_IN_CHUNK]
+                            cur.execute(_MARKET_SNAPSHOT_SQL + f"AND o.id IN ({','.join('?' * len(chunk))})", chunk)
+                            for r in cur.fetchall():
+                                rows[int(r["id"])] = dict(r)
+                        self._rows = rows
+                        self._view = _MarketView(latest, list(rows.values()))
+                        return
+                self._rebuild(cur, change_version(cur, "public"))
+            finally:
+                conn.rollback()
+        finally:
             conn.close()
-        except Exception:
-            pass
+
+    def view(self) -> _MarketView:
+        now = time.monotonic()
+        if self._view is None or now >= self._next_check:
+            # one thread refreshes; the rest keep serving the previous view (only the very first build waits)
+            if self._refresh_lock.acquire(blocking=self._view is None):
+                try:
+                    if self._view is None or time.monotonic() >= self._next_check:
+                        self._next_check = now + MARKET_SNAPSHOT_CHECK_SECONDS
+                        try:
+                            self._refresh()
+                        except Exception as e:
+                            if self._view is None:
+                                raise
+                            print("[MARKET] snapshot refresh failed, serving the previous one:", e)
+                finally:
+                    self._refresh_lock.release()
+        return self._view  # type: ignore[return-value]
+
+    def serve(self, kind: str, limit: int, cursor: Optional[Tuple[int, int]], username: str):
+        view = self.view()
+        etag = make_etag(view.version, username)
+        if etag_matches(etag):
+            return not_modified(etag)
+        resp = Response(view.page(kind, limit, cursor), mimetype="application/json")
+        resp.headers["ETag"] = etag
+        resp.headers["Cache-Control"] = "no-cache"
+        return resp
+
+    def size(self) -> int:
+        view = self._view
+        return len(view.keys) if view is not None else 0
+
+
+MARKET_SNAPSHOT = MarketSnapshot()
+
+
+def sse_format(event: str, data: Dict[str, Any], event_id: Optional[str] = None) -> str:
+    out = f"event: {event}\n"
+    if event_id is not None:
+        out += f"id: {event_id}\n"
+    return out + "data: " + json.dumps(data, ensure_ascii=False) + "\n\n"
 
 
-def _session_touch(token: str, last_seen: int) -> None:
+# ================== OPTIONAL TELEGRAM ENGINE ==================
+telegram_engine = None
+if TELEGRAM_ENABLED:
     try:
+        from telegram_engine import TelegramEngine  # type: ignore
+        telegram_engine = TelegramEngine()
+        print("[TELEGRAM] enabled")
+    except Exception as e:
+        telegram_engine = None
+        print("[TELEGRAM] failed to init:", e)
+
+
+# ================== OUTBOX ==================
+class OutboxPermanentError(Exception):
+    """Raised by a handler when retrying cannot help (bad address, feature disabled): the row goes straight to dead."""
+
+
+def enqueue_outbox(cur: sqlite3.Cursor, kind: str, payload: Dict[str, Any]) -> int:
+    """Queue a side effect inside the caller's transaction. Call OUTBOX.wake() after commit."""
+    ts = now_ts()
+    cur.execute(
+        "INSERT INTO outbox (kind, payload, status, attempts, next_attempt_at, created_at) VALUES (?, ?, 'pending', 0, ?, ?)",
+        (kind, json.dumps(payload, ensure_ascii=False), ts, ts),
+    )
+    return int(cur.lastrowid)
+
+
+def _outbox_telegram_offer(payload: Dict[str, Any]) -> None:
+    if not telegram_engine:
+        raise OutboxPermanentError("telegram disabled")
+    telegram_engine.notify_new_offer(  # type: ignore
+        payload["order_id"], payload["transport_username"], payload["price"],
+        payload.get("comment", ""), payload.get("contact", ""), payload.get("company", ""),
+    )
+
+
+OUTBOX_HANDLERS: Dict[str, Callable[[Dict[str, Any]], None]] = {
+    "telegram_offer": _outbox_telegram_offer,
+}
+
+
+class OutboxDispatcher:
+    """
+    Drains the outbox table: claim a batch (lease via next_attempt_at), run handlers with no DB connection held,
+    then record all outcomes in one transaction. Failures back off exponentially; after OUTBOX_MAX_ATTEMPTS
+    or a permanent error the row is kept as status='dead'. Delivery is at-least-once.
+    """
+
+    def __init__(self):
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="outbox-dispatcher", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=30)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(max(0.2, OUTBOX_POLL_SECONDS))
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            try:
+                while self.dispatch_once() >= OUTBOX_BATCH_SIZE:
+                    pass
+            except Exception as e:
+                print("[OUTBOX] dispatch error:", e)
+
+    @staticmethod
+    def backoff_seconds(attempts: int) -> int:
+        delay = min(OUTBOX_BACKOFF_MAX_SECONDS, OUTBOX_BACKOFF_BASE_SECONDS * (2 ** max(0, attempts - 1)))
+        return int(delay + secrets.randbelow(max(1, OUTBOX_BACKOFF_BASE_SECONDS)))
+
+    def _claim(self) -> List[sqlite3.Row]:
         conn = db_connect()
-        cur = conn.cursor()
-        cur.execute("UPDATE sessions SET last_seen=? WHERE token=?", (int(last_seen), token))
-        conn.commit()
-    except Exception:
-        pass
-    finally:
         try:
+            cur = conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            ts = now_ts()
+            cur.execute(
+                "SELECT id, kind, payload, attempts FROM outbox WHERE status='pending' AND next_attempt_at<=? "
+                "ORDER BY next_attempt_at, id LIMIT ?",
+                (ts, OUTBOX_BATCH_SIZE),
+            )
+            rows = cur.fetchall()
+            if rows:
+                cur.executemany(
+                    "UPDATE outbox SET next_attempt_at=? WHERE id=?",
+                    [(ts + OUTBOX_LEASE_SECONDS, r["id"]) for r in rows],
+                )
+            conn.commit()
+            return rows
+        finally:
             conn.close()
-        except Exception:
-            pass
 
+    def dispatch_once(self) -> int:
+        rows = self._claim()
+        if not rows:
+            return 0
+
+        delivered: List[Tuple[int]] = []
+        retry: List[Tuple[int, str, int]] = []
+        dead: List[Tuple[str, int]] = []
+        for r in rows:
+            attempts = int(r["attempts"]) + 1
+            handler = OUTBOX_HANDLERS.get(r["kind"])
+            try:
+                if handler is None:
+                    raise OutboxPermanentError(f"no handler for {r['kind']}")
+                handler(json.loads(r["payload"] or "{}"))
+                delivered.append((r["id"],))
+            except OutboxPermanentError as e:
+                dead.append((str(e)[:500], r["id"]))
+            except Exception as e:
+                if attempts >= OUTBOX_MAX_ATTEMPTS:
+                    dead.append((str(e)[:500], r["id"]))
+                else:
+                    retry.append((now_ts() + self.backoff_seconds(attempts), str(e)[:500], r["id"]))
 
-def _session_delete_for_user(username: str) -> None:
-    try:
         conn = db_connect()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM sessions WHERE username=?", (username,))
-        conn.commit()
-    except Exception:
-        pass
-    finally:
         try:
+            cur = conn.cursor()
+            if delivered:
+                cur.executemany("DELETE FROM outbox WHERE id=?", delivered)
+            if retry:
+                cur.executemany(
+                    "UPDATE outbox SET attempts=attempts+1, next_attempt_at=?, last_error=? WHERE id=?", retry)
+            if dead:
+                cur.executemany(
+                    "UPDATE outbox SET status='dead', attempts=attempts+1, last_error=? WHERE id=?", dead)
+            conn.commit()
+        finally:
             conn.close()
-        except Exception:
-            pass
+        if dead:
+            print(f"[OUTBOX] {len(dead)} message(s) moved to dead letters")
+        return len(rows)
 
 
-def issue_token(username: str, role: str, app_name: str) -> str:
-    token = secrets.token_urlsafe(24)
-    with data_lock:
-        TOKENS[token] = {
-            "username": username,
-            "role": role,
-            "app": app_name,
-            "issued_at": now_ts(),
-            "last_seen": now_ts(),
-        }
-    _session_store(token, TOKENS[token])
-    return token
+OUTBOX = OutboxDispatcher()
 
 
-def validate_token(token: str) -> Optional[Dict[str, Any]]:
-    # 1) fast path: in-memory
-    with data_lock:
-        meta = TOKENS.get(token)
+# ================== AUTH HELPERS ==================
+def get_bearer_token() -> Optional[str]:
+    auth = request.headers.get("Authorization", "")
+    if not auth.startswith("Bearer "):
+        return None
+    return auth.split(" ", 1)[1].strip()
+
+
+def auth_cache_generation() -> int:
+    with auth_cache_lock:
+        return _auth_cache_generation
+
+
+def auth_cache_get(token: str) -> Optional[Tuple[Dict[str, Any], Optional[Tuple[str, str, str]]]]:
+    """Returns (meta, license activation key) for a cached verdict, or None."""
+    if AUTH_CACHE_TTL_SECONDS <= 0:
+        return None
+    with auth_cache_lock:
+        hit = AUTH_CACHE.get(token)
+        if not hit:
+            return None
+        expires, meta, activation = hit
+        if time.monotonic() >= expires:
+            AUTH_CACHE.pop(token, None)
+            return None
+        return meta, activation
+
+
+def auth_cache_prune() -> int:
+    """Drop verdicts whose TTL passed (normally they are only replaced when the token is presented again)."""
+    now = time.monotonic()
+    with auth_cache_lock:
+        expired = [t for t, (exp, _m, _act) in AUTH_CACHE.items() if exp <= now]
+        for t in expired:
+            AUTH_CACHE.pop(t, None)
+    return len(expired)
+
+
+def auth_cache_put(token: str, meta: Dict[str, Any], generation: int,
+                   activation: Optional[Tuple[str, str, str]] = None) -> None:
+    """Cache a positive verdict unless an invalidation happened while it was being computed."""
+    if AUTH_CACHE_TTL_SECONDS <= 0:
+        return
+    # never outlive the token itself
+    ttl = min(AUTH_CACHE_TTL_SECONDS, int(meta.get("issued_at", 0)) + TOKEN_TTL_SECONDS - now_ts())
+    if ttl <= 0:
+        return
+    with auth_cache_lock:
+        if generation != _auth_cache_generation:
+            return
+        AUTH_CACHE[token] = (time.monotonic() + ttl, meta, activation)
+
+
+def auth_cache_invalidate(username: Optional[str] = None) -> None:
+    """Drop cached verdicts for one user, or for everybody when username is None."""
+    global _auth_cache_generation
+    with auth_cache_lock:
+        _auth_cache_generation += 1
+        if username is None:
+            AUTH_CACHE.clear()
+            return
+        to_del = [t for t, (_exp, m, _act) in AUTH_CACHE.items() if m.get("username") == username]
+        for t in to_del:
+            AUTH_CACHE.pop(t, None)
+
+
+class SessionStore:
+    """
+    Session tokens. The `sessions` table is the source of truth; every process keeps a local cache of token metas.
+    Revocations are appended to the `revocations` table in the same transaction that deletes the sessions,
+    and each process replays rows it has not seen yet (at most SESSION_SYNC_INTERVAL_SECONDS apart, checked
+    on the auth path), so a token revoked by one worker or by the CLI stops working in all of them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens: Dict[str, Dict[str, Any]] = {}
+        self._sync_lock = threading.Lock()
+        self._next_sync = 0.0
+        self._last_revocation = self._max_revocation_id()
+
+    # ---- cross-process invalidation ----
+    @staticmethod
+    def _max_revocation_id() -> int:
+        conn = db_connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT COALESCE(MAX(id), 0) FROM revocations")
+            return int(cur.fetchone()[0])
+        finally:
+            conn.close()
+
+    def _drop_local(self, username: Optional[str]) -> None:
+        auth_cache_invalidate(username)
+        if username is None:
+            LICENSES.invalidate()
+            return
+        with self._lock:
+            for t in [t for t, v in self._tokens.items() if v.get("username") == username]:
+                self._tokens.pop(t, None)
+
+    @staticmethod
+    def _record_revocation(cur: sqlite3.Cursor, username: Optional[str]) -> None:
+        cur.execute("INSERT INTO revocations (username, created_at) VALUES (?, ?)", (username, now_ts()))
+
+    def sync(self) -> None:
+        """
+        Replay revocations newer than the last one seen. Cheap when nothing changed: one index seek.
+        Our own revocations are replayed too: a concurrent _load() may have re-cached a session row that was
+        read just before the revoking commit, and the replay drops it again.
+        """
+        now = time.monotonic()
+        if now < self._next_sync or not self._sync_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_sync = now + SESSION_SYNC_INTERVAL_SECONDS
+            conn = db_connect()
+            try:
+                cur = conn.cursor()
+                cur.execute("SELECT id, username FROM revocations WHERE id>? ORDER BY id", (self._last_revocation,))
+                rows = cur.fetchall()
+            finally:
+                conn.close()
+            for r in rows:
+                self._drop_local(r["username"])
+                self._last_revocation = int(r["id"])
+        except Exception as e:
+            print("[SESSIONS] revocation replay failed:", e)
+        finally:
+            self._sync_lock.release()
+
+    # ---- sessions ----
+    def issue(self, username: str, role: str, app_name: str) -> str:
+        token = secrets.token_urlsafe(24)
+        ts = now_ts()
+        meta = {"username": username, "role": role, "app": app_name, "issued_at": ts, "last_seen": ts}
+        with self._lock:
+            self._tokens[token] = meta
+        conn = db_connect()
+        try:
+            # persisted so the token survives restarts and is visible to the other workers
+            conn.cursor().execute(
+                "INSERT OR REPLACE INTO sessions (token, username, role, app, issued_at, last_seen, expires_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (token, username, role, app_name, ts, ts, ts + int(TOKEN_TTL_SECONDS)),
+            )
+            conn.commit()
+        except Exception:
+            pass
+        finally:
+            conn.close()
+        return token
+
+    def _load(self, token: str) -> Optional[Dict[str, Any]]:
+        conn = db_connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT * FROM sessions WHERE token=?", (token,))
+            row = cur.fetchone()
+            if not row:
+                return None
+            if now_ts() > int(row["expires_at"] or 0):
+                cur.execute("DELETE FROM sessions WHERE token=?", (token,))
+                conn.commit()
+                return None
+            return {
+                "username": row["username"],
+                "role": row["role"],
+                "app": row["app"],
+                "issued_at": int(row["issued_at"] or 0),
+                "last_seen": int(row["last_seen"] or 0),
+            }
+        except Exception:
+            return None
+        finally:
+            conn.close()
+
+    def get(self, token: str) -> Optional[Dict[str, Any]]:
+        self.sync()
+        # 1) fast path: local cache (no disk I/O while the lock is held)
+        expired = False
+        with self._lock:
+            meta = self._tokens.get(token)
+            if meta:
+                if now_ts() - int(meta.get("issued_at", 0)) > TOKEN_TTL_SECONDS:
+                    self._tokens.pop(token, None)
+                    expired = True
+                else:
+                    meta["last_seen"] = now_ts()
         if meta:
-            if now_ts() - int(meta.get("issued_at", 0)) > TOKEN_TTL_SECONDS:
-                TOKENS.pop(token, None)
+            if expired:
                 # best-effort cleanup DB
                 try:
                     conn = db_connect()
@@ -641,27 +2720,104 @@ def validate_token(token: str) -> Optional[Dict[str, Any]]:
                 except Exception:
                     pass
                 return None
-            meta["last_seen"] = now_ts()
-            _session_touch(token, meta["last_seen"])
+            queue_session_touch(token, meta["last_seen"])
             return meta
 
-    # 2) fallback: persistent sessions
-    meta_db = _session_load(token)
-    if not meta_db:
-        return None
+        # 2) fallback: persistent sessions (restart, or token issued by another worker)
+        meta_db = self._load(token)
+        if not meta_db:
+            return None
+        meta_db["last_seen"] = now_ts()
+        queue_session_touch(token, meta_db["last_seen"])
+        with self._lock:
+            self._tokens[token] = meta_db
+        return meta_db
+
+    def peek(self, token: str) -> Optional[Dict[str, Any]]:
+        """Locally cached meta without validation or I/O (None if unknown to this process)."""
+        with self._lock:
+            return self._tokens.get(token)
+
+    def evict(self, tokens: List[str]) -> int:
+        """Drop the given tokens plus every cached token past TOKEN_TTL_SECONDS; returns how many were dropped."""
+        cutoff = now_ts() - TOKEN_TTL_SECONDS
+        with self._lock:
+            items = list(self._tokens.items())
+        stale = set(tokens)
+        stale.update(t for t, m in items if int(m.get("issued_at", 0)) < cutoff)
+        dropped = 0
+        with self._lock:
+            for t in stale:
+                if self._tokens.pop(t, None) is not None:
+                    dropped += 1
+        return dropped
+
+    def size(self) -> int:
+        with self._lock:
+            return len(self._tokens)
+
+    def revoke_user(self, username: str) -> None:
+        conn = db_connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM sessions WHERE username=?", (username,))
+            self._record_revocation(cur, username)
+            conn.commit()
+        except Exception as e:
+            print("[SESSIONS] revoke failed for", username, e)
+        finally:
+            conn.close()
+        # after the commit: a concurrent _load() can no longer find the rows and re-cache them
+        self._drop_local(username)
+
+    def flush_auth_everywhere(self) -> None:
+        """License state changed: every process must re-check cached auth verdicts and license rows against the DB."""
+        conn = db_connect()
+        try:
+            cur = conn.cursor()
+            self._record_revocation(cur, None)
+            conn.commit()
+        except Exception as e:
+            print("[SESSIONS] auth flush not recorded:", e)
+        finally:
+            conn.close()
+        self._drop_local(None)
 
-    meta_db["last_seen"] = now_ts()
-    _session_touch(token, meta_db["last_seen"])
-    with data_lock:
-        TOKENS[token] = meta_db
-    return meta_db
 
+SESSIONS = SessionStore()
+
+
+def revoke_all_tokens_for(username: str):
+    SESSIONS.revoke_user(username)
+
+
+def issue_token(username: str, role: str, app_name: str) -> str:
+    return SESSIONS.issue(username, role, app_name)
+
+
+def validate_token(token: str) -> Optional[Dict[str, Any]]:
+    return SESSIONS.get(token)
 
 
 def require_auth():
     token = get_bearer_token()
     if not token:
         return None, jsonify({"error": "missing token"}), 401
+
+    # steady-state polling: the whole verdict is already known, no DB work at all
+    # (apart from the throttled revocation replay)
+    SESSIONS.sync()
+    hit = auth_cache_get(token)
+    if hit is not None:
+        meta, activation = hit
+        ts = now_ts()
+        meta["last_seen"] = ts
+        queue_session_touch(token, ts)
+        if activation:
+            queue_activation_touch(*activation, ts)
+        return meta, None, None
+
+    generation = auth_cache_generation()
     meta = validate_token(token)
     if not meta:
         return None, jsonify({"error": "bad/expired token"}), 401
@@ -690,59 +2846,446 @@ def require_auth():
     # Previously license validity was checked only during /login and /register.
     # That allows an already logged-in session to keep working even after the license key is deleted/inactivated via CLI.
     # If you want actions like --delete-key to immediately block access, enable enforcement on each request.
+    activation = None
     if ENFORCE_LICENSE_ON_EACH_REQUEST:
         username = (meta.get("username") or "").strip()
         if not username:
             return None, jsonify({"error": "bad/expired token"}), 401
 
+        # the verdict is decided on one pooled connection; revocation takes its own, so it runs after this
+        # one is released (with every web thread here at once the pool would otherwise be exhausted)
+        denied = None
         conn = db_connect()
         try:
             cur = conn.cursor()
             cur.execute("SELECT username, role, device_id, license_key_used FROM users WHERE username=?", (username,))
             user = cur.fetchone()
             if not user:
-                revoke_all_tokens_for(username)
-                return None, jsonify({"error": "bad/expired token"}), 401
-
-            role = (user["role"] or "").strip().lower()
-            lk = (user["license_key_used"] or "").strip()
-
-            if role != "admin":
-                if REQUIRE_LICENSE_FOR_NON_ADMIN and not lk:
-                    revoke_all_tokens_for(username)
-                    return None, jsonify({"error": "license_required", "license_valid": False}), 403
-
-                if lk:
-                    app_name = (meta.get("app") or "manager").strip().lower() or "manager"
-                    dev_for_license = (user["device_id"] or "").strip() or "0"
-                    ok_lk, reason_lk, meta_lk = validate_license_and_touch(conn, lk, app_name, dev_for_license)
-                    if not ok_lk:
-                        conn.rollback()
-                        revoke_all_tokens_for(username)
-                        return None, jsonify({"error": reason_lk, "license_valid": False, **meta_lk}), 403
-                    conn.commit()
+                denied = (True, {"error": "bad/expired token"}, 401)
+            else:
+                role = (user["role"] or "").strip().lower()
+                lk = (user["license_key_used"] or "").strip()
+
+                if role != "admin":
+                    if REQUIRE_LICENSE_FOR_NON_ADMIN and not lk:
+                        denied = (True, {"error": "license_required", "license_valid": False}, 403)
+                    elif lk:
+                        app_name = (meta.get("app") or "manager").strip().lower() or "manager"
+                        dev_for_license = (user["device_id"] or "").strip() or "0"
+                        ok_lk, reason_lk, meta_lk = validate_license_and_touch(conn, lk, app_name, dev_for_license)
+                        if not ok_lk:
+                            conn.rollback()
+                            # active_device_limit_reached is transient: the session stays, retry later
+                            denied = (reason_lk != "active_device_limit_reached",
+                                      {"error": reason_lk, "license_valid": False, **meta_lk}, 403)
+                        else:
+                            conn.commit()
+                            activation = (meta_lk["license_key"], app_name, dev_for_license)
         finally:
             conn.close()
 
-    return meta, None, None
+        if denied:
+            revoke, body, status = denied
+            if revoke:
+                revoke_all_tokens_for(username)
+            return None, jsonify(body), status
+
+    auth_cache_put(token, meta, generation, activation)
+    return meta, None, None
+
+
+
+def require_role(required_role: str):
+    def decorator(fn):
+        def wrapper(*args, **kwargs):
+            meta, err, code = require_auth()
+            if err:
+                return err, code
+            role = meta.get("role")
+            if role != required_role:
+                return jsonify({"error": "forbidden", "need": required_role}), 403
+            return fn(*args, **kwargs)
+
+        wrapper.__name__ = fn.__name__
+        return wrapper
+
+    return decorator
+
+
+# ================== ARCHIVE ==================
+# Same columns as the hot tables (plus archived_at). The archive schema lives outside MIGRATIONS: the file can be
+# rotated or deleted independently of the main DB, so it is (re)created on startup.
+ORDER_COLUMNS = "id, username, direction, cargo, tonnage, truck, date, price, info, status, created_at, closed_at"
+MARKET_ORDER_COLUMNS = "order_id, status, created_at"
+OFFER_COLUMNS = "id, order_id, transport_username, price, comment, contact, company, created_at"
+
+METRICS.describe("archived_orders_total", "counter", "Closed orders moved to the archive DB (their offers go along).")
+
+
+def ensure_archive_schema() -> None:
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS archive.orders (
+          id INTEGER PRIMARY KEY,
+          username TEXT NOT NULL,
+          direction TEXT,
+          cargo TEXT,
+          tonnage REAL,
+          truck TEXT,
+          date TEXT,
+          price REAL,
+          info TEXT,
+          status TEXT,
+          created_at INTEGER NOT NULL,
+          closed_at INTEGER,
+          archived_at INTEGER NOT NULL
+        )
+        """)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS archive.market_orders (
+          order_id INTEGER PRIMARY KEY,
+          status TEXT NOT NULL,
+          created_at INTEGER NOT NULL,
+          archived_at INTEGER NOT NULL
+        )
+        """)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS archive.market_offers (
+          id INTEGER PRIMARY KEY,
+          order_id INTEGER NOT NULL,
+          transport_username TEXT NOT NULL,
+          price INTEGER NOT NULL,
+          comment TEXT DEFAULT '',
+          contact TEXT DEFAULT '',
+          company TEXT DEFAULT '',
+          created_at INTEGER NOT NULL,
+          archived_at INTEGER NOT NULL
+        )
+        """)
+        # the same keyset shapes as the hot indexes, for ?include_archive=1
+        cur.execute("CREATE INDEX IF NOT EXISTS archive.idx_archive_orders_username_created ON orders(username, created_at, id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS archive.idx_archive_offers_order_created ON market_offers(order_id, created_at, id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS archive.idx_archive_offers_transport_created ON market_offers(transport_username, created_at, id)")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+if ARCHIVE_DB_PATH:
+    ensure_archive_schema()
+
+
+def include_archive_arg() -> bool:
+    """?include_archive=1 on history reads; ignored when no archive DB is configured."""
+    return bool(ARCHIVE_DB_PATH) and (request.args.get("include_archive") or "").strip().lower() in ("1", "true", "yes")
+
 
+def archive_union(hot_sql: str, cold_sql: str, params: List[Any]) -> Tuple[str, List[Any]]:
+    """The same SELECT over main.* and archive.*; the caller appends ORDER BY / LIMIT for the compound."""
+    return f"{hot_sql} UNION ALL {cold_sql} ", params + params
 
 
-def require_role(required_role: str):
-    def decorator(fn):
-        def wrapper(*args, **kwargs):
-            meta, err, code = require_auth()
-            if err:
-                return err, code
-            role = meta.get("role")
-            if role != required_role:
-                return jsonify({"error": "forbidden", "need": required_role}), 403
-            return fn(*args, **kwargs)
+def archive_closed_orders(max_batches: int, pause_seconds: float = 0.0) -> int:
+    """
+    Move orders closed more than ARCHIVE_AFTER_DAYS ago, with their market row and offers, to the archive DB.
+    Two transactions per batch, because a commit is not atomic across attached WAL databases:
+    1) copy into archive (INSERT OR REPLACE: re-running after a crash is harmless),
+    2) delete from the hot tables only what is now in the archive, and log one change per owner.
+    Between the two, a row exists in both files; ?include_archive=1 reads prefer the hot copy.
+    """
+    if not ARCHIVE_DB_PATH:
+        return 0
+    cutoff = now_ts() - ARCHIVE_AFTER_DAYS * 86400
+    moved = 0
+    for _ in range(max(1, max_batches)):
+        conn = db_connect()
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT id FROM main.orders WHERE status='closed' AND closed_at<? ORDER BY closed_at LIMIT ?",
+                (cutoff, ARCHIVE_BATCH_SIZE),
+            )
+            ids = [int(r[0]) for r in cur.fetchall()]
+            if not ids:
+                break
+            marks = ",".join("?" * len(ids))
+            ts = now_ts()
 
-        wrapper.__name__ = fn.__name__
-        return wrapper
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                cur.execute(f"INSERT OR REPLACE INTO archive.orders ({ORDER_COLUMNS}, archived_at) "
+                            f"SELECT {ORDER_COLUMNS}, ? FROM main.orders WHERE id IN ({marks})", [ts, *ids])
+                cur.execute(f"INSERT OR REPLACE INTO archive.market_orders ({MARKET_ORDER_COLUMNS}, archived_at) "
+                            f"SELECT {MARKET_ORDER_COLUMNS}, ? FROM main.market_orders WHERE order_id IN ({marks})", [ts, *ids])
+                cur.execute(f"INSERT OR REPLACE INTO archive.market_offers ({OFFER_COLUMNS}, archived_at) "
+                            f"SELECT {OFFER_COLUMNS}, ? FROM main.market_offers WHERE order_id IN ({marks})", [ts, *ids])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
 
-    return decorator
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                cur.execute(
+                    f"SELECT o.id, o.username FROM main.orders o JOIN archive.orders a ON a.id = o.id "
+                    f"WHERE o.id IN ({marks}) AND o.status='closed'",
+                    ids,
+                )
+                by_owner: Dict[str, List[int]] = {}
+                for r in cur.fetchall():
+                    by_owner.setdefault(r["username"], []).append(int(r["id"]))
+                done = [oid for owned in by_owner.values() for oid in owned]
+                if done:
+                    marks = ",".join("?" * len(done))
+                    cur.execute(f"DELETE FROM main.market_offers WHERE order_id IN ({marks})", done)
+                    cur.execute(f"DELETE FROM main.market_orders WHERE order_id IN ({marks})", done)
+                    cur.execute(f"DELETE FROM main.orders WHERE id IN ({marks})", done)
+                    # public: the transports' /market/my-offers views lose these rows too; one entry per order so
+                    # the order scope (/market/offers/<id> ETag) moves as well
+                    record_changes(cur, [
+                        {"kind": "orders_archived", "order_id": oid, "owner": owner, "public": True,
+                         "payload": {"order_ids": [oid]}}
+                        for owner, owned in by_owner.items() for oid in owned
+                    ])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        finally:
+            conn.close()
+        moved += len(done)
+        if len(ids) < ARCHIVE_BATCH_SIZE:
+            break
+        if pause_seconds > 0:
+            time.sleep(pause_seconds)
+    if moved:
+        METRICS.inc("archived_orders_total", value=float(moved))
+    return moved
+
+
+# ================== SWEEPER ==================
+METRICS.describe("sweeper_deleted_rows_total", "counter", "Rows deleted by the sweeper by table.")
+METRICS.describe("sweeper_evicted_total", "counter", "In-memory entries dropped by the sweeper by cache.")
+METRICS.describe("sweeper_runs_total", "counter", "Sweeper runs by outcome.")
+METRICS.describe("sweeper_last_run_timestamp_seconds", "gauge", "When the last sweep finished (0 = not yet).")
+METRICS.describe("sweeper_last_duration_seconds", "gauge", "How long the last sweep took.")
+METRICS.describe("session_cache_entries", "gauge", "Session tokens cached by this process.")
+
+
+class Sweeper:
+    """
+    Periodic cleanup: expired sessions (and their cached copies), old revocations, when
+    ACTIVATION_RETENTION_SECONDS is set idle license activations, and when ARCHIVE_DB_PATH is set old closed orders. Each table is drained oldest first
+    in SWEEP_BATCH_SIZE transactions with a pause in between, so a backlog never holds the write lock for long.
+    """
+
+    # table -> (select oldest matching keys, delete by key); both use the migration-10 / revocations indexes
+    _SESSIONS = ("SELECT token FROM sessions WHERE expires_at<? ORDER BY expires_at LIMIT ?", "DELETE FROM sessions WHERE token IN ({})")
+    _REVOCATIONS = ("SELECT id FROM revocations WHERE created_at<? ORDER BY created_at LIMIT ?", "DELETE FROM revocations WHERE id IN ({})")
+    _ACTIVATIONS = ("SELECT id FROM license_activations WHERE last_seen<? ORDER BY last_seen LIMIT ?", "DELETE FROM license_activations WHERE id IN ({})")
+
+    def __init__(self):
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.last_run = 0.0
+        self.last_duration = 0.0
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="sweeper", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=30)
+
+    def _run(self) -> None:
+        # first run one interval after start: short-lived CLI invocations never sweep
+        while not self._stop.wait(max(5.0, SWEEP_INTERVAL_SECONDS)):
+            try:
+                self.sweep_once()
+            except Exception as e:
+                METRICS.inc("sweeper_runs_total", (("outcome", "error"),))
+                print("[SWEEPER] error:", e)
+
+    def _drain(self, table: str, queries: Tuple[str, str], cutoff: int) -> Tuple[int, List[Any]]:
+        select_sql, delete_sql = queries
+        total = 0
+        keys_deleted: List[Any] = []
+        for _ in range(max(1, SWEEP_MAX_BATCHES)):
+            if self._stop.is_set():
+                break
+            conn = db_connect()
+            try:
+                cur = conn.cursor()
+                cur.execute("BEGIN IMMEDIATE")
+                cur.execute(select_sql, (cutoff, SWEEP_BATCH_SIZE))
+                keys = [r[0] for r in cur.fetchall()]
+                if keys:
+                    cur.execute(delete_sql.format(",".join("?" * len(keys))), keys)
+                conn.commit()
+            finally:
+                conn.close()
+            total += len(keys)
+            if table == "sessions":
+                keys_deleted.extend(keys)
+            if len(keys) < SWEEP_BATCH_SIZE:
+                break
+            time.sleep(SWEEP_BATCH_PAUSE_SECONDS)
+        if total:
+            METRICS.inc("sweeper_deleted_rows_total", (("table", table),), float(total))
+        return total, keys_deleted
+
+    def sweep_once(self) -> Dict[str, int]:
+        started = time.monotonic()
+        ts = now_ts()
+        report: Dict[str, int] = {}
+
+        report["sessions"], tokens = self._drain("sessions", self._SESSIONS, ts)
+        report["session_cache"] = SESSIONS.evict(tokens)
+        report["auth_cache"] = auth_cache_prune()
+        METRICS.inc("sweeper_evicted_total", (("cache", "sessions"),), float(report["session_cache"]))
+        METRICS.inc("sweeper_evicted_total", (("cache", "auth"),), float(report["auth_cache"]))
+
+        if REVOCATION_RETENTION_SECONDS > 0:
+            report["revocations"], _ = self._drain("revocations", self._REVOCATIONS, ts - REVOCATION_RETENTION_SECONDS)
+
+        if ACTIVATION_RETENTION_SECONDS > 0:
+            flush_touches()  # buffered last_seen must land first, or active devices look idle
+            report["license_activations"], _ = self._drain("license_activations", self._ACTIVATIONS, ts - ACTIVATION_RETENTION_SECONDS)
+            if report["license_activations"]:
+                SESSIONS.flush_auth_everywhere()  # freed device slots: cached device sets are stale everywhere
+
+        if ARCHIVE_DB_PATH:
+            report["archived_orders"] = archive_closed_orders(SWEEP_MAX_BATCHES, SWEEP_BATCH_PAUSE_SECONDS)
+
+        self.last_run = time.time()
+        self.last_duration = time.monotonic() - started
+        METRICS.inc("sweeper_runs_total", (("outcome", "ok"),))
+        if any(report.values()):
+            print("[SWEEPER]", ", ".join(f"{k}={v}" for k, v in report.items() if v), f"in {self.last_duration:.2f}s")
+        return report
+
+
+SWEEPER = Sweeper()
+
+_runtime_lock = threading.Lock()
+_runtime_started = False
+
+
+def start_runtime() -> None:
+    """
+    Process-wide workers of a serving process (--run, or a gunicorn worker): the KDF pool first, because it forks,
+    then the background threads. CLI tools only import the module and start none of them.
+    """
+    global _runtime_started
+    with _runtime_lock:
+        if _runtime_started:
+            return
+        _runtime_started = True
+        start_password_pool()
+        threading.Thread(target=_touch_flusher_loop, name="touch-flusher", daemon=True).start()
+        if OUTBOX_DISPATCHER_ENABLED:
+            OUTBOX.start()
+        if SWEEPER_ENABLED:
+            SWEEPER.start()
+
+
+# ================== RATE LIMITING ==================
+class TokenBucketLimiter:
+    """In-memory token buckets: key -> [tokens, last refill (monotonic), rate, burst]."""
+
+    def __init__(self, max_keys: int):
+        self._lock = threading.Lock()
+        self._buckets: Dict[Tuple[str, str], List[float]] = {}
+        self._max_keys = max(1000, max_keys)
+
+    def take(self, key: Tuple[str, str], rate: float, burst: float) -> float:
+        """Consume one token. Returns 0 if allowed, else seconds until a token is available."""
+        now = time.monotonic()
+        with self._lock:
+            b = self._buckets.get(key)
+            if b is None:
+                if len(self._buckets) >= self._max_keys:
+                    self._evict(now)
+                b = [burst, now, rate, burst]
+                self._buckets[key] = b
+            tokens = min(burst, b[0] + (now - b[1]) * rate)
+            b[1], b[2], b[3] = now, rate, burst
+            if tokens >= 1.0:
+                b[0] = tokens - 1.0
+                return 0.0
+            b[0] = tokens
+            return (1.0 - tokens) / rate if rate > 0 else 60.0
+
+    def _evict(self, now: float) -> None:
+        # full buckets carry no state worth keeping; if that is not enough, drop the least recently used half
+        for key in [k for k, (tok, last, rate, burst) in self._buckets.items() if tok + (now - last) * rate >= burst]:
+            del self._buckets[key]
+        if len(self._buckets) >= self._max_keys:
+            for key, _b in sorted(self._buckets.items(), key=lambda kv: kv[1][1])[: len(self._buckets) // 2]:
+                del self._buckets[key]
+
+
+RATE_LIMITER = TokenBucketLimiter(RATE_LIMIT_MAX_KEYS)
+
+_RATE_CLASSES = {
+    "poll": (RATE_POLL_RPS, RATE_POLL_BURST),
+    "write": (RATE_WRITE_RPS, RATE_WRITE_BURST),
+    "stream": (RATE_STREAM_RPS, RATE_STREAM_BURST),
+    "auth": (RATE_AUTH_RPS, RATE_AUTH_BURST),
+}
+_RATE_AUTH_PATHS = {"/login", "/register"}
+_RATE_STREAM_PATHS = {"/events/stream", "/market/feed"}
+
+
+def _rate_class() -> str:
+    if request.path in _RATE_AUTH_PATHS:
+        return "auth"
+    if request.path in _RATE_STREAM_PATHS:
+        return "stream"
+    return "poll" if request.method in ("GET", "HEAD") else "write"
+
+
+def _client_ip() -> str:
+    if RATE_LIMIT_TRUST_PROXY:
+        fwd = (request.headers.get("X-Forwarded-For") or "").split(",")[0].strip()
+        if fwd:
+            return fwd
+    return request.remote_addr or "?"
+
+
+@app.before_request
+def rate_limit():
+    """Runs before any handler, i.e. before require_auth(); only in-memory lookups, no DB."""
+    if not RATE_LIMIT_ENABLED or request.method == "OPTIONS":
+        return None
+    cls = _rate_class()
+    rate, burst = _RATE_CLASSES[cls]
+
+    token = get_bearer_token()
+    meta = SESSIONS.peek(token) if token and cls != "auth" else None
+    if meta:
+        wait = RATE_LIMITER.take((cls, "t:" + token), rate, burst)
+        if not wait:
+            wait = RATE_LIMITER.take((cls, "u:" + str(meta.get("username"))),
+                                     rate * RATE_USER_MULTIPLIER, burst * RATE_USER_MULTIPLIER)
+    else:
+        # login/register, or a token this process has not validated yet: charge the client address
+        mult = 1.0 if cls == "auth" else RATE_USER_MULTIPLIER
+        wait = RATE_LIMITER.take((cls, "ip:" + _client_ip()), rate * mult, burst * mult)
+    if not wait:
+        return None
+
+    retry_after = max(1, int(math.ceil(wait)))
+    METRICS.inc("rate_limited_total", (("class", cls),))
+    resp = jsonify({"error": "rate_limited", "retry_after": retry_after})
+    resp.status_code = 429
+    resp.headers["Retry-After"] = str(retry_after)
+    return resp
 
 
 # ================== LICENSE API ==================
@@ -894,10 +3437,12 @@ def admin_license_update(license_key: str):
 
         cur.execute(f"UPDATE license_keys SET {sets} WHERE license_key=?", values)
         conn.commit()
-        return jsonify({"status": "ok", "license_key": license_key, "updated": list(fields.keys())}), 200
     finally:
         conn.close()
 
+    SESSIONS.flush_auth_everywhere()  # own connection: not nested inside the one above
+    return jsonify({"status": "ok", "license_key": license_key, "updated": list(fields.keys())}), 200
+
 
 @app.get("/admin/license/list")
 @require_role("admin")
@@ -936,6 +3481,12 @@ def register():
     if not email or not phone:
         return jsonify({"error": "email/phone required"}), 400
 
+    # KDF before any connection/transaction is taken
+    try:
+        password_hash = hash_password(password)
+    except PasswordHashBusy:
+        return password_busy_response()
+
     conn = db_connect()
     cur = conn.cursor()
     try:
@@ -982,7 +3533,7 @@ def register():
         cur.execute(
             "INSERT INTO users (username, password_hash, role, email, phone, company_name, contact, device_id, license_key_used, created_at) "
             "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (username, sha256(password), role, email, phone, company_name, contact, (device_id or None), (meta.get("license_key") if not invite_code else None), now_ts()),
+            (username, password_hash, role, email, phone, company_name, contact, (device_id or None), (meta.get("license_key") if not invite_code else None), now_ts()),
         )
         conn.commit()
         return jsonify({"status": "ok", "license_valid": True}), 201
@@ -1013,11 +3564,30 @@ def login():
         cur = conn.cursor()
         cur.execute("SELECT * FROM users WHERE username=?", (username,))
         user = cur.fetchone()
-        if not user:
-            return jsonify({"error": "bad_credentials"}), 403
+    finally:
+        conn.close()
 
-        if not verify_password(password, user["password_hash"]):
-            return jsonify({"error": "bad_credentials"}), 403
+    # KDF with no pooled connection held: a login storm must not drain the pool for polling endpoints.
+    # Unknown usernames pay for the same verify, so response time does not reveal which accounts exist.
+    new_hash = None
+    try:
+        ok_pw, rehash = verify_password_upgrade(password, user["password_hash"] if user else dummy_password_hash())
+        if ok_pw and rehash:
+            new_hash = hash_password(password)
+    except PasswordHashBusy:
+        return password_busy_response()
+    if not user or not ok_pw:
+        return jsonify({"error": "bad_credentials"}), 403
+
+    license_failed = None
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        if new_hash:
+            # transparent upgrade; compare-and-set so a concurrent password change wins
+            cur.execute("UPDATE users SET password_hash=? WHERE username=? AND password_hash=?",
+                        (new_hash, username, user["password_hash"]))
+            conn.commit()
 
         role = (user["role"] or "").strip().lower()
         if role not in ALLOWED_ROLES:
@@ -1042,18 +3612,23 @@ def login():
             ok_lk, reason_lk, meta_lk = validate_license_and_touch(conn, lk, app_name or "manager", dev_for_license)
             if not ok_lk:
                 conn.rollback()
-                revoke_all_tokens_for(username)
-                return jsonify({"error": reason_lk, "license_valid": False, **meta_lk}), 403
-            conn.commit()
-
-        if SINGLE_SESSION_PER_USER:
-            revoke_all_tokens_for(username)
-
-        token = issue_token(username, role, app_name)
-        return jsonify({"token": token, "role": role, "license_valid": True}), 200
+                license_failed = (reason_lk, meta_lk)
+            else:
+                conn.commit()
     finally:
         conn.close()
 
+    # session writes take their own connection; never nest them inside the one above
+    if license_failed:
+        revoke_all_tokens_for(username)
+        return jsonify({"error": license_failed[0], "license_valid": False, **license_failed[1]}), 403
+
+    if SINGLE_SESSION_PER_USER:
+        revoke_all_tokens_for(username)
+
+    token = issue_token(username, role, app_name)
+    return jsonify({"token": token, "role": role, "license_valid": True}), 200
+
 
 @app.get("/me")
 def me():
@@ -1080,41 +3655,136 @@ def me():
 
     return jsonify(meta_out), 200
 
+def _parse_order_payload(data: Any) -> Tuple[Optional[Dict[str, Any]], str]:
+    """Validates one order body. Returns (fields, "") or (None, field_name_that_failed)."""
+    if not isinstance(data, dict):
+        return None, "order"
+    fields: Dict[str, Any] = {
+        "direction": str(data.get("direction") or "").strip(),
+        "cargo": str(data.get("cargo") or "").strip(),
+        "truck": str(data.get("truck") or "").strip(),
+        "date": str(data.get("date") or "").strip(),
+        "info": str(data.get("info") or "").strip(),
+    }
+    for name in ("tonnage", "price"):
+        try:
+            fields[name] = float(data.get(name) or 0)
+        except (TypeError, ValueError):
+            return None, name
+    return fields, ""
+
+
+def _order_row(order_id: int, username: str, fields: Dict[str, Any], created_at: int) -> Dict[str, Any]:
+    return {
+        "id": order_id, "username": username, "direction": fields["direction"], "cargo": fields["cargo"],
+        "tonnage": fields["tonnage"], "truck": fields["truck"], "date": fields["date"], "price": fields["price"],
+        "info": fields["info"], "status": "pending", "created_at": created_at, "closed_at": None,
+    }
+
+
 @app.post("/orders/create")
 def create_order():
     meta, err, code = require_auth()
     if err:
         return err, code
 
-    data = request.get_json(force=True)
-    direction = (data.get("direction") or "").strip()
-    cargo = (data.get("cargo") or "").strip()
-    tonnage = data.get("tonnage") or 0
-    truck = (data.get("truck") or "").strip()
-    date = (data.get("date") or "").strip()
-    price = data.get("price") or 0
-    info_text = (data.get("info") or "").strip()
+    fields, bad_field = _parse_order_payload(request.get_json(force=True))
+    if fields is None:
+        return jsonify({"error": "bad_order", "field": bad_field}), 400
 
     username = meta["username"]
 
     conn = db_connect()
     try:
         cur = conn.cursor()
+        created_at = now_ts()
         cur.execute(
             "INSERT INTO orders (username, direction, cargo, tonnage, truck, date, price, info, status, created_at) "
             "VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'pending', ?)",
-            (username, direction, cargo, float(tonnage), truck, date, float(price), info_text, now_ts()),
+            (username, fields["direction"], fields["cargo"], fields["tonnage"], fields["truck"], fields["date"],
+             fields["price"], fields["info"], created_at),
         )
         order_id = cur.lastrowid
 
         # publish to market for transport users
-        cur.execute("INSERT OR IGNORE INTO market_orders (order_id, status, created_at) VALUES (?, 'open', ?)", (order_id, now_ts()))
+        cur.execute("INSERT OR IGNORE INTO market_orders (order_id, status, created_at) VALUES (?, 'open', ?)", (order_id, created_at))
+        order_row = _order_row(order_id, username, fields, created_at)
+        record_change(cur, "order_created", order_id=order_id, owner=username, actor=username, public=True, payload=order_row)
         conn.commit()
+
+        CHANGE_TAIL.poke()
+        MARKET_SNAPSHOT.poke()
         return jsonify({"status": "ok", "order_id": order_id}), 201
     finally:
         conn.close()
 
 
+@app.post("/orders/create_batch")
+def create_orders_batch():
+    """{"orders": [...]} -> {"order_ids": [...]} in request order. All or nothing."""
+    meta, err, code = require_auth()
+    if err:
+        return err, code
+
+    data = request.get_json(force=True) or {}
+    items = data.get("orders") if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "orders required"}), 400
+    if len(items) > ORDERS_BATCH_MAX:
+        return jsonify({"error": "too many orders", "max": ORDERS_BATCH_MAX}), 400
+
+    parsed: List[Dict[str, Any]] = []
+    for i, item in enumerate(items):
+        fields, bad_field = _parse_order_payload(item)
+        if fields is None:
+            return jsonify({"error": "bad_order", "index": i, "field": bad_field}), 400
+        parsed.append(fields)
+
+    username = meta["username"]
+
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        # IMMEDIATE takes the write lock up front, so the id range reserved below cannot be raced
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            cur.execute("SELECT seq FROM sqlite_sequence WHERE name='orders'")
+            row = cur.fetchone()
+            seq = int(row[0]) if row else 0
+            cur.execute("SELECT COALESCE(MAX(id), 0) FROM orders")
+            first_id = max(seq, int(cur.fetchone()[0])) + 1
+            order_ids = list(range(first_id, first_id + len(parsed)))
+            created_at = now_ts()
+
+            cur.executemany(
+                "INSERT INTO orders (id, username, direction, cargo, tonnage, truck, date, price, info, status, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending', ?)",
+                [
+                    (oid, username, f["direction"], f["cargo"], f["tonnage"], f["truck"], f["date"], f["price"], f["info"], created_at)
+                    for oid, f in zip(order_ids, parsed)
+                ],
+            )
+            cur.executemany(
+                "INSERT OR IGNORE INTO market_orders (order_id, status, created_at) VALUES (?, 'open', ?)",
+                [(oid, created_at) for oid in order_ids],
+            )
+            order_rows = [_order_row(oid, username, f, created_at) for oid, f in zip(order_ids, parsed)]
+            record_changes(cur, [
+                {"kind": "order_created", "order_id": r["id"], "owner": username, "actor": username, "public": True, "payload": r}
+                for r in order_rows
+            ])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        CHANGE_TAIL.poke()
+        MARKET_SNAPSHOT.poke()
+        return jsonify({"status": "ok", "order_ids": order_ids}), 201
+    finally:
+        conn.close()
+
+
 @app.get("/orders/my")
 def list_my_orders():
     meta, err, code = require_auth()
@@ -1122,12 +3792,33 @@ def list_my_orders():
         return err, code
 
     username = meta["username"]
+    limit, cursor, bad = page_args(300)
+    if bad:
+        return bad
     conn = db_connect()
     try:
         cur = conn.cursor()
-        cur.execute("SELECT * FROM orders WHERE username=? ORDER BY id DESC LIMIT 300", (username,))
-        rows = [dict(r) for r in cur.fetchall()]
-        return jsonify({"items": rows}), 200
+        etag = make_etag(change_version(cur, "owner", username), username)
+        if etag_matches(etag):
+            return not_modified(etag)
+        where = "username=? "
+        params: List[Any] = [username]
+        if cursor:
+            where += "AND (created_at, id) < (?, ?) "
+            params.extend(cursor)
+        sql = "SELECT * FROM orders WHERE " + where
+        if include_archive_arg():
+            sql, params = archive_union(
+                f"SELECT {ORDER_COLUMNS} FROM main.orders WHERE {where}",
+                f"SELECT {ORDER_COLUMNS} FROM archive.orders a WHERE {where}"
+                "AND NOT EXISTS (SELECT 1 FROM main.orders h WHERE h.id = a.id)",
+                params,
+            )
+        sql += "ORDER BY created_at DESC, id DESC LIMIT ?"
+        params.append(limit + 1)
+        cur.execute(sql, tuple(params))
+        rows, next_cursor = keyset_page([dict(r) for r in cur.fetchall()], limit)
+        return json_with_etag({"items": rows, "next_cursor": next_cursor}, etag), 200
     finally:
         conn.close()
 
@@ -1149,22 +3840,69 @@ def close_orders():
     if not isinstance(ids, list) or not ids:
         return jsonify({"error": "ids required"}), 400
 
+    # results are keyed by the id as submitted: closed / not_found / not_owner / bad_id
+    results: Dict[str, str] = {}
+    wanted: Dict[int, str] = {}
+    for oid in ids:
+        try:
+            wanted.setdefault(int(oid), str(oid))
+        except Exception:
+            results[str(oid)] = "bad_id"
+
     username = meta["username"]
     conn = db_connect()
     try:
         cur = conn.cursor()
-        for oid in ids:
-            try:
-                oid_i = int(oid)
-            except Exception:
-                continue
-            cur.execute(
-                "UPDATE orders SET status='closed', closed_at=? WHERE id=? AND username=?",
-                (now_ts(), oid_i, username),
-            )
-            cur.execute("UPDATE market_orders SET status='closed' WHERE order_id=?", (oid_i,))
-        conn.commit()
-        return jsonify({"status": "ok"}), 200
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            closed_at = now_ts()
+            newly_closed: List[int] = []
+            closed_market: List[int] = []
+            all_ids = list(wanted)
+            for i in range(0, len(all_ids), SQL_IN_CHUNK):
+                chunk = all_ids[i:i + SQL_IN_CHUNK]
+                marks = ",".join("?" * len(chunk))
+                cur.execute(f"SELECT id, username, status FROM orders WHERE id IN ({marks})", chunk)
+                found = {int(r["id"]): r for r in cur.fetchall()}
+                mine: List[int] = []
+                for oid_i in chunk:
+                    r = found.get(oid_i)
+                    if r is None:
+                        results[wanted[oid_i]] = "not_found"
+                    elif r["username"] != username:
+                        results[wanted[oid_i]] = "not_owner"
+                    else:
+                        results[wanted[oid_i]] = "closed"
+                        mine.append(oid_i)
+                        if r["status"] != "closed":
+                            newly_closed.append(oid_i)
+                if not mine:
+                    continue
+                marks = ",".join("?" * len(mine))
+                cur.execute(
+                    f"UPDATE orders SET status='closed', closed_at=? WHERE id IN ({marks}) AND status!='closed'",
+                    [closed_at, *mine],
+                )
+                cur.execute(f"SELECT order_id FROM market_orders WHERE order_id IN ({marks}) AND status!='closed'", mine)
+                market_chunk = [int(r[0]) for r in cur.fetchall()]
+                if market_chunk:
+                    marks = ",".join("?" * len(market_chunk))
+                    cur.execute(f"UPDATE market_orders SET status='closed' WHERE order_id IN ({marks})", market_chunk)
+                    closed_market.extend(market_chunk)
+
+            if newly_closed or closed_market:
+                # one change row for the whole batch; public only when the market actually changed
+                record_change(cur, "orders_closed", owner=username, actor=username, public=bool(closed_market),
+                              payload={"ids": newly_closed, "market_ids": closed_market, "closed_at": closed_at})
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        if closed_market:
+            CHANGE_TAIL.poke()
+            MARKET_SNAPSHOT.poke()
+        return jsonify({"status": "ok", "results": results}), 200
     finally:
         conn.close()
 
@@ -1179,17 +3917,32 @@ def market_orders():
     if role != "transport":
         return jsonify({"error": "forbidden"}), 403
 
+    limit, cursor, bad = page_args(300)
+    if bad:
+        return bad
+    if MARKET_SNAPSHOT_ENABLED:
+        return MARKET_SNAPSHOT.serve("market", limit, cursor, meta["username"])
     conn = db_connect()
     try:
         cur = conn.cursor()
-        cur.execute(
+        etag = make_etag(change_version(cur, "public"), meta["username"])
+        if etag_matches(etag):
+            return not_modified(etag)
+        # CROSS JOIN pins orders as the outer loop: walk idx_orders_created backwards and stop after one page
+        sql = (
             "SELECT o.* FROM orders o "
-            "JOIN market_orders m ON m.order_id = o.id "
+            "CROSS JOIN market_orders m ON m.order_id = o.id "
             "WHERE m.status='open' "
-            "ORDER BY o.id DESC LIMIT 300"
         )
-        rows = [dict(r) for r in cur.fetchall()]
-        return jsonify({"items": rows}), 200
+        params: List[Any] = []
+        if cursor:
+            sql += "AND (o.created_at, o.id) < (?, ?) "
+            params.extend(cursor)
+        sql += "ORDER BY o.created_at DESC, o.id DESC LIMIT ?"
+        params.append(limit + 1)
+        cur.execute(sql, tuple(params))
+        rows, next_cursor = keyset_page([dict(r) for r in cur.fetchall()], limit)
+        return json_with_etag({"items": rows, "next_cursor": next_cursor}, etag), 200
     finally:
         conn.close()
 
@@ -1204,23 +3957,36 @@ def market_stats_orders():
     if role not in ("manager", "transport", "admin"):
         return jsonify({"error": "forbidden"}), 403
 
+    limit, cursor, bad = page_args(1000)
+    if bad:
+        return bad
+    if MARKET_SNAPSHOT_ENABLED:
+        return MARKET_SNAPSHOT.serve("stats", limit, cursor, meta["username"])
     conn = db_connect()
     try:
         cur = conn.cursor()
-        cur.execute(
+        etag = make_etag(change_version(cur, "public"), meta["username"])
+        if etag_matches(etag):
+            return not_modified(etag)
+        sql = (
             "SELECT "
             "o.id, o.username, o.direction, o.cargo, o.tonnage, o.truck, o.date, "
             "o.price, o.info, o.created_at, "
             "COALESCE(u.company_name, '') AS company_name "
             "FROM orders o "
-            "JOIN market_orders m ON m.order_id = o.id "
+            "CROSS JOIN market_orders m ON m.order_id = o.id "
             "LEFT JOIN users u ON u.username = o.username "
             "WHERE m.status='open' "
-            "ORDER BY o.created_at DESC, o.id DESC "
-            "LIMIT 1000"
         )
-        rows = [dict(r) for r in cur.fetchall()]
-        return jsonify({"items": rows, "total": len(rows)}), 200
+        params: List[Any] = []
+        if cursor:
+            sql += "AND (o.created_at, o.id) < (?, ?) "
+            params.extend(cursor)
+        sql += "ORDER BY o.created_at DESC, o.id DESC LIMIT ?"
+        params.append(limit + 1)
+        cur.execute(sql, tuple(params))
+        rows, next_cursor = keyset_page([dict(r) for r in cur.fetchall()], limit)
+        return json_with_etag({"items": rows, "total": len(rows), "next_cursor": next_cursor}, etag), 200
     finally:
         conn.close()
 
@@ -1251,23 +4017,41 @@ def market_offer():
     conn = db_connect()
     try:
         cur = conn.cursor()
-        cur.execute("SELECT 1 FROM market_orders WHERE order_id=? AND status='open'", (order_id_i,))
-        if not cur.fetchone():
+        cur.execute(
+            "SELECT o.username FROM market_orders m JOIN orders o ON o.id = m.order_id "
+            "WHERE m.order_id=? AND m.status='open'",
+            (order_id_i,),
+        )
+        owner_row = cur.fetchone()
+        if not owner_row:
             return jsonify({"error": "order_not_open"}), 409
 
+        created_at = now_ts()
         cur.execute(
             "INSERT OR REPLACE INTO market_offers (order_id, transport_username, price, comment, contact, company, created_at) "
             "VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (order_id_i, username, price_i, comment, contact, company, now_ts()),
+            (order_id_i, username, price_i, comment, contact, company, created_at),
         )
+        offer = {
+            "id": cur.lastrowid,
+            "order_id": order_id_i,
+            "transport_username": username,
+            "price": price_i,
+            "comment": comment,
+            "contact": contact,
+            "company": company,
+            "created_at": created_at,
+        }
+        record_change(cur, "offer_upserted", order_id=order_id_i, owner=owner_row["username"], actor=username, payload=offer)
+        # optional notify via telegram engine, delivered by the outbox dispatcher after commit
+        if telegram_engine:
+            enqueue_outbox(cur, "telegram_offer", offer)
         conn.commit()
 
-        # optional notify via telegram engine
+        # the manager's open /events/stream connections get it from the change log, on whichever worker they are
+        CHANGE_TAIL.poke()
         if telegram_engine:
-            try:
-                telegram_engine.notify_new_offer(order_id_i, username, price_i, comment, contact, company)  # type: ignore
-            except Exception:
-                pass
+            OUTBOX.wake()
 
         return jsonify({"status": "ok"}), 201
     finally:
@@ -1280,15 +4064,106 @@ def market_offers(order_id: int):
     if err:
         return err, code
 
+    limit, cursor, bad = page_args(200)
+    if bad:
+        return bad
     conn = db_connect()
     try:
         cur = conn.cursor()
-        cur.execute(
-            "SELECT * FROM market_offers WHERE order_id=? ORDER BY created_at DESC LIMIT 200",
-            (order_id,),
-        )
-        rows = [dict(r) for r in cur.fetchall()]
-        return jsonify({"items": rows}), 200
+        etag = make_etag(change_version(cur, "order", order_id), meta["username"])
+        if etag_matches(etag):
+            return not_modified(etag)
+        where = "order_id=? "
+        params: List[Any] = [order_id]
+        if cursor:
+            where += "AND (created_at, id) < (?, ?) "
+            params.extend(cursor)
+        sql = "SELECT * FROM market_offers WHERE " + where
+        if include_archive_arg():
+            sql, params = archive_union(
+                f"SELECT {OFFER_COLUMNS} FROM main.market_offers WHERE {where}",
+                f"SELECT {OFFER_COLUMNS} FROM archive.market_offers a WHERE {where}"
+                "AND NOT EXISTS (SELECT 1 FROM main.market_offers h WHERE h.id = a.id)",
+                params,
+            )
+        sql += "ORDER BY created_at DESC, id DESC LIMIT ?"
+        params.append(limit + 1)
+        cur.execute(sql, tuple(params))
+        rows, next_cursor = keyset_page([dict(r) for r in cur.fetchall()], limit)
+        return json_with_etag({"items": rows, "next_cursor": next_cursor}, etag), 200
+    finally:
+        conn.close()
+
+
+@app.get("/market/offers")
+def market_offers_batch():
+    """
+    Offers for many orders in one call: ?order_ids=1,2,3&after=<version>.
+    after=0 (or missing) returns the current offers of every order; a later call passes back the returned `after`
+    (a change-log version) and gets only offers written since, so a late commit is never skipped. Offers can repeat
+    across calls; clients de-duplicate by id. Managers only get their own orders; other ids are left out.
+    """
+    meta, err, code = require_auth()
+    if err:
+        return err, code
+
+    order_ids = set()
+    for part in (request.args.get("order_ids") or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            order_ids.add(int(part))
+        except Exception:
+            return jsonify({"error": "bad order_ids"}), 400
+    if len(order_ids) > MARKET_OFFERS_BATCH_MAX_ORDERS:
+        return jsonify({"error": "too_many_order_ids", "max": MARKET_OFFERS_BATCH_MAX_ORDERS}), 400
+
+    after_raw = (request.args.get("after") or "").strip()
+    try:
+        after = int(after_raw) if after_raw else 0
+    except Exception:
+        return jsonify({"error": "bad after"}), 400
+    if after < 0:
+        return jsonify({"error": "bad after"}), 400
+
+    if not order_ids:
+        return jsonify({"items": {}, "after": after}), 200
+
+    ids = sorted(order_ids)
+    q_marks = ",".join(["?"] * len(ids))
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("BEGIN")  # one read snapshot for the ownership check, the offers and the version
+        try:
+            if meta.get("role") == "manager":
+                cur.execute(f"SELECT id FROM orders WHERE id IN ({q_marks}) AND username=?", (*ids, meta["username"]))
+                ids = sorted(int(r["id"]) for r in cur.fetchall())
+                q_marks = ",".join(["?"] * len(ids))
+            groups: Dict[str, list] = {}
+            version = after
+            if ids and after == 0:
+                cur.execute("SELECT COALESCE(MAX(version), 0) FROM changes")
+                version = int(cur.fetchone()[0])
+                cur.execute(
+                    f"SELECT * FROM market_offers WHERE order_id IN ({q_marks}) ORDER BY order_id, created_at DESC, id DESC",
+                    ids,
+                )
+                for r in cur.fetchall():
+                    groups.setdefault(str(r["order_id"]), []).append(dict(r))
+            elif ids:
+                cur.execute(
+                    f"SELECT version, order_id, payload FROM changes WHERE order_id IN ({q_marks}) AND version>? "
+                    "AND kind='offer_upserted' ORDER BY version LIMIT ?",
+                    (*ids, after, MARKET_OFFERS_BATCH_MAX_CHANGES),
+                )
+                for r in cur.fetchall():
+                    groups.setdefault(str(r["order_id"]), []).insert(0, json.loads(r["payload"] or "{}"))  # newest first
+                    version = int(r["version"])
+        finally:
+            conn.rollback()
+        return jsonify({"items": groups, "after": version}), 200
     finally:
         conn.close()
 
@@ -1313,12 +4188,20 @@ def market_my_offers():
         if hours_i <= 0 or hours_i > MARKET_MY_OFFERS_MAX_HOURS:
             return jsonify({"error": "bad hours"}), 400
         cutoff_ts = now_ts() - (hours_i * 3600)
+    limit, cursor, bad = page_args(500)
+    if bad:
+        return bad
     conn = db_connect()
     try:
         cur = conn.cursor()
-        sql = (
+        # own offers + order/market status changes; the hours window also slides with time
+        version = max(change_version(cur, "actor", username), change_version(cur, "public"))
+        etag = make_etag(version, username, cutoff_ts // 60 if cutoff_ts is not None else "")
+        if etag_matches(etag):
+            return not_modified(etag)
+        select = (
             "SELECT "
-            "mo.order_id, mo.price AS offer_price, mo.comment AS offer_comment, "
+            "mo.id AS offer_id, mo.order_id, mo.price AS offer_price, mo.comment AS offer_comment, "
             "mo.contact AS offer_contact, mo.company AS offer_company, "
             "mo.created_at AS offer_created_at, "
             "o.direction, o.cargo, o.tonnage, o.truck, o.date, "
@@ -1327,25 +4210,197 @@ def market_my_offers():
             "COALESCE(m.status, '') AS market_status, "
             "COALESCE(u.company_name, '') AS from_company, "
             "o.username AS manager_username "
-            "FROM market_offers mo "
-            "JOIN orders o ON o.id = mo.order_id "
-            "LEFT JOIN market_orders m ON m.order_id = mo.order_id "
-            "LEFT JOIN users u ON u.username = o.username "
+            "FROM {db}.market_offers mo "
+            "JOIN {db}.orders o ON o.id = mo.order_id "
+            "LEFT JOIN {db}.market_orders m ON m.order_id = mo.order_id "
+            "LEFT JOIN main.users u ON u.username = o.username "
             "WHERE mo.transport_username=? "
-            "ORDER BY mo.created_at DESC, mo.id DESC "
         )
-        params = [username]
+        where = ""
+        params: List[Any] = [username]
         if cutoff_ts is not None:
-            sql = sql.replace("WHERE mo.transport_username=? ", "WHERE mo.transport_username=? AND mo.created_at>=? ")
+            where += "AND mo.created_at>=? "
             params.append(cutoff_ts)
-        sql += "LIMIT 500"
+        if cursor:
+            where += "AND (mo.created_at, mo.id) < (?, ?) "
+            params.extend(cursor)
+        sql = select.format(db="main") + where
+        order = "ORDER BY mo.created_at DESC, mo.id DESC LIMIT ?"
+        if include_archive_arg():
+            sql, params = archive_union(
+                sql,
+                select.format(db="archive") + where + "AND NOT EXISTS (SELECT 1 FROM main.market_offers h WHERE h.id = mo.id)",
+                params,
+            )
+            order = "ORDER BY offer_created_at DESC, offer_id DESC LIMIT ?"
+        sql += order
+        params.append(limit + 1)
         cur.execute(sql, tuple(params))
-        rows = [dict(r) for r in cur.fetchall()]
-        return jsonify({"items": rows, "total": len(rows)}), 200
+        rows, next_cursor = keyset_page([dict(r) for r in cur.fetchall()], limit, "offer_created_at", "offer_id")
+        return json_with_etag({"items": rows, "total": len(rows), "next_cursor": next_cursor}, etag), 200
     finally:
         conn.close()
 
 
+@app.get("/sync")
+def sync_changes():
+    """
+    Incremental sync: ?since=<version>&limit=N. Returns change-log entries newer than `since` that the caller can see
+    (market-wide entries, plus entries for orders they own or changes they made), oldest first.
+    Pass the returned `version` back as `since`; repeat while `has_more` is true.
+    """
+    meta, err, code = require_auth()
+    if err:
+        return err, code
+
+    try:
+        since = int((request.args.get("since") or "0").strip() or 0)
+        limit = int((request.args.get("limit") or str(SYNC_DEFAULT_LIMIT)).strip())
+    except Exception:
+        return jsonify({"error": "bad since/limit"}), 400
+    if since < 0 or limit < 1:
+        return jsonify({"error": "bad since/limit"}), 400
+    limit = min(limit, SYNC_MAX_LIMIT)
+
+    username = meta["username"]
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT version, kind, order_id, payload, created_at FROM changes "
+            "WHERE version>? AND (public=1 OR owner=? OR actor=?) "
+            "ORDER BY version LIMIT ?",
+            (since, username, username, limit + 1),
+        )
+        rows = cur.fetchall()
+    finally:
+        conn.close()
+
+    has_more = len(rows) > limit
+    items = []
+    for r in rows[:limit]:
+        try:
+            data = json.loads(r["payload"] or "{}")
+        except Exception:
+            data = {}
+        items.append({"version": r["version"], "kind": r["kind"], "order_id": r["order_id"], "data": data, "created_at": r["created_at"]})
+    version = items[-1]["version"] if items else since
+    return jsonify({"items": items, "version": version, "has_more": has_more}), 200
+
+
+@app.get("/events/stream")
+def events_stream():
+    """
+    Server-Sent Events for the caller: `offer` when a transport bids on one of their orders.
+    Event ids are change versions; Last-Event-ID replays the offers missed since then (on any worker).
+    Comment lines are sent as heartbeats; the token is re-checked on each heartbeat and the stream ends once it is revoked.
+    """
+    meta, err, code = require_auth()
+    if err:
+        return err, code
+    resume = MarketFeed.parse_token((request.headers.get("Last-Event-ID") or "").strip())
+    release = acquire_stream_slot()
+    if release is None:
+        return streams_busy_response()
+
+    username = meta["username"]
+    try:
+        CHANGE_TAIL.ensure_started()
+        q = EVENTS.subscribe(username)  # before the replay: nothing can fall between the two
+    except Exception:
+        release()
+        raise
+
+    def gen():
+        try:
+            yield ": connected\n\n"
+            last = 0
+            if resume is not None:
+                for version, data in replay_offer_events(username, resume):
+                    last = version
+                    yield sse_format("offer", data, str(version))
+            while True:
+                try:
+                    version, event, data = q.get(timeout=EVENTS_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    _meta, err_hb, _code = require_auth()
+                    if err_hb:
+                        return
+                    yield ": ping\n\n"
+                    continue
+                if version <= last:
+                    continue  # already sent by the replay
+                yield sse_format(event, data, str(version))
+        finally:
+            EVENTS.unsubscribe(username, q)
+
+    resp = Response(
+        stream_with_context(gen()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    resp.call_on_close(release)
+    return resp
+
+
+@app.get("/market/feed")
+def market_feed():
+    """
+    Server-Sent Events with market deltas for transport clients: order_opened (full order row) and
+    orders_closed ({"ids": [...]}, also sent for deleted orders). Every event carries an id usable as a resume token
+    (Last-Event-ID header or ?since=) on any worker. When the token cannot be resumed the stream starts with `reset`:
+    the client reloads /market/orders once and applies deltas from then on.
+    """
+    meta, err, code = require_auth()
+    if err:
+        return err, code
+    if meta.get("role") not in ("transport", "admin"):
+        return jsonify({"error": "forbidden"}), 403
+
+    resume = (request.headers.get("Last-Event-ID") or request.args.get("since") or "").strip()
+    after = MARKET_FEED.parse_token(resume) if resume else None
+    release = acquire_stream_slot()
+    if release is None:
+        return streams_busy_response()
+    try:
+        CHANGE_TAIL.ensure_started()
+    except Exception:
+        release()
+        raise
+
+    def gen():
+        last = after
+        if last is None:
+            last = MARKET_FEED.current()
+            yield sse_format("reset", {}, MARKET_FEED.token(last))
+        next_beat = time.monotonic() + EVENTS_HEARTBEAT_SECONDS
+        while True:
+            got = MARKET_FEED.read(last, EVENTS_HEARTBEAT_SECONDS)
+            if got is None:
+                last = MARKET_FEED.current()
+                yield sse_format("reset", {}, MARKET_FEED.token(last))
+                continue
+            last, events = got
+            for seq, event, data in events:
+                yield sse_format(event, data, MARKET_FEED.token(seq))
+            if events:
+                next_beat = time.monotonic() + EVENTS_HEARTBEAT_SECONDS
+            elif time.monotonic() >= next_beat:
+                _meta, err_hb, _code = require_auth()
+                if err_hb:
+                    return
+                yield ": ping\n\n"
+                next_beat = time.monotonic() + EVENTS_HEARTBEAT_SECONDS
+
+    resp = Response(
+        stream_with_context(gen()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    resp.call_on_close(release)
+    return resp
+
+
 @app.get("/health")
 def health():
     return jsonify({
@@ -1356,12 +4411,156 @@ def health():
     }), 200
 
 
+# ================== METRICS ENDPOINT ==================
+METRICS.describe("db_pool_connections", "gauge", "Pooled SQLite connections by state (size = configured maximum).")
+METRICS.describe("outbox_messages", "gauge", "Outbox rows by status (pending includes leased).")
+METRICS.describe("outbox_oldest_pending_age_seconds", "gauge", "Age of the oldest pending outbox row.")
+METRICS.describe("forwarder_queue_depth", "gauge", "Orders accepted by forwarder_app in this process and not yet delivered.")
+METRICS.describe("sse_connections", "gauge", "Open /events/stream connections.")
+METRICS.describe("auth_cache_entries", "gauge", "Cached auth verdicts.")
+METRICS.describe("license_cache_keys", "gauge", "License rows held by the license cache.")
+METRICS.describe("market_snapshot_orders", "gauge", "Open market orders in the in-memory snapshot.")
+
+
+def _collect_runtime() -> List[Tuple[str, Tuple[Tuple[str, str], ...], float]]:
+    out: List[Tuple[str, Tuple[Tuple[str, str], ...], float]] = []
+    for state, n in DB_POOL.stats().items():
+        out.append(("db_pool_connections", (("state", state),), float(n)))
+    out.append(("sse_connections", (), float(EVENTS.connections())))
+    with auth_cache_lock:
+        out.append(("auth_cache_entries", (), float(len(AUTH_CACHE))))
+    out.append(("license_cache_keys", (), float(LICENSES.size())))
+    out.append(("session_cache_entries", (), float(SESSIONS.size())))
+    out.append(("market_snapshot_orders", (), float(MARKET_SNAPSHOT.size())))
+    out.append(("sweeper_last_run_timestamp_seconds", (), float(SWEEPER.last_run)))
+    out.append(("sweeper_last_duration_seconds", (), float(SWEEPER.last_duration)))
+    if forwarder.spool is not None:
+        out.append(("forwarder_queue_depth", (), float(forwarder.depth)))
+    return out
+
+
+def _collect_outbox() -> List[Tuple[str, Tuple[Tuple[str, str], ...], float]]:
+    out: List[Tuple[str, Tuple[Tuple[str, str], ...], float]] = []
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        counts = {"pending": 0, "dead": 0}
+        cur.execute("SELECT status, COUNT(*) AS n FROM outbox GROUP BY status")
+        for r in cur.fetchall():
+            counts[r["status"]] = int(r["n"])
+        for status, n in counts.items():
+            out.append(("outbox_messages", (("status", status),), float(n)))
+        cur.execute("SELECT MIN(created_at) FROM outbox WHERE status='pending'")
+        oldest = cur.fetchone()[0]
+        out.append(("outbox_oldest_pending_age_seconds", (), float(now_ts() - int(oldest)) if oldest else 0.0))
+    finally:
+        conn.close()
+    return out
+
+
+METRICS.add_collector(_collect_runtime)
+METRICS.add_collector(_collect_outbox)
+
+
+@app.get("/metrics")
+def metrics():
+    if not METRICS_ENABLED:
+        abort(404)
+    if METRICS_TOKEN and not hmac.compare_digest(get_bearer_token() or "", METRICS_TOKEN):
+        return jsonify({"error": "forbidden"}), 403
+    return Response(METRICS.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/admin/sql/top")
+@require_role("admin")
+def admin_sql_top():
+    if not SQL_TRACE_ENABLED:
+        return jsonify({"error": "sql_trace_disabled", "hint": "set SQL_TRACE_ENABLED=1"}), 409
+    try:
+        limit = max(1, min(int(request.args.get("limit") or 20), 200))
+    except ValueError:
+        return jsonify({"error": "bad_limit"}), 400
+    sort = (request.args.get("sort") or "total").strip().lower()
+    if sort not in ("total", "max", "calls", "rows", "slow"):
+        return jsonify({"error": "bad_sort", "allowed": ["total", "max", "calls", "rows", "slow"]}), 400
+    return jsonify({"status": "ok", "slow_ms": SQL_SLOW_MS, "sort": sort, **SQL_TRACER.top(limit, sort)}), 200
+
+
+@app.post("/admin/sql/reset")
+@require_role("admin")
+def admin_sql_reset():
+    SQL_TRACER.reset()
+    return jsonify({"status": "ok"}), 200
+
+
+@forwarder_app.get("/metrics")
+def forwarder_metrics():
+    lines = [
+        "# HELP forwarder_queue_depth Orders accepted and not yet delivered (includes retries waiting for backoff).",
+        "# TYPE forwarder_queue_depth gauge",
+        f"forwarder_queue_depth {forwarder.depth}",
+        "# HELP forwarder_queue_max Admission limit; at this depth /orders/create answers 503.",
+        "# TYPE forwarder_queue_max gauge",
+        f"forwarder_queue_max {FORWARDER_QUEUE_MAX}",
+    ]
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+
+# ================== PRODUCTION SERVER ==================
+def _worker_exit(_server, _worker) -> None:
+    # the worker imported this file as `server` (see load() below); flush that module's buffers
+    import server as worker_mod  # type: ignore
+    worker_mod.flush_touches()
+    worker_mod.DB_POOL.close_idle()
+
+
+def serve_production() -> None:
+    """Run `app` under gunicorn with gthread workers. gunicorn handles SIGTERM as a graceful drain."""
+    try:
+        from gunicorn.app.base import BaseApplication  # type: ignore
+    except Exception:
+        print("ERROR: --serve requires gunicorn (pip install gunicorn); use --run for the development server")
+        raise SystemExit(2)
+
+    options = {
+        "bind": f"{HOST}:{PORT}",
+        "workers": max(1, WEB_WORKERS),
+        "worker_class": "gthread",
+        "threads": max(1, WEB_THREADS),
+        "keepalive": WEB_KEEPALIVE,
+        "timeout": WEB_TIMEOUT,
+        "graceful_timeout": WEB_GRACEFUL_TIMEOUT,
+        "max_requests": WEB_MAX_REQUESTS,
+        "max_requests_jitter": WEB_MAX_REQUESTS // 10,
+        "preload_app": False,
+        "accesslog": "-" if WEB_ACCESS_LOG else None,
+        "worker_exit": _worker_exit,
+    }
+
+    class _Gunicorn(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # imported fresh in every worker after fork: no SQLite handle or thread crosses the fork
+            import server as worker_mod  # type: ignore
+            worker_mod.start_runtime()  # before gthread starts its request threads
+            return worker_mod.app
+
+    # the master never serves requests (start_runtime() runs in the workers), and no open connection may be forked
+    DB_POOL.close_idle()
+    print(f"[SERVER] gunicorn on {HOST}:{PORT}: {options['workers']} worker(s) x {options['threads']} thread(s)")
+    _Gunicorn().run()
+
+
 # ================== MAIN ==================
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description="MVP server + local console tools (users/roles/license keys)")
     parser.add_argument("--run", action="store_true", help="Run HTTP server (default if no other action)")
+    parser.add_argument("--serve", action="store_true", help="Run HTTP server under gunicorn (WEB_* env vars), for production")
 
     # ===== License keys =====
     parser.add_argument("--keygen", action="store_true", help="Generate and store a new license key in DB, then exit")
@@ -1416,6 +4615,14 @@ if __name__ == "__main__":
     parser.add_argument("--list-users", action="store_true", help="List last N users with roles and exit")
     parser.add_argument("--users-limit", type=int, default=200, help="Limit for --list-users (default 200)")
 
+    # ===== Outbox =====
+    parser.add_argument("--outbox-status", action="store_true", help="Print outbox pending/dead counts and recent dead letters, then exit")
+    parser.add_argument("--outbox-requeue-dead", action="store_true", help="Move dead outbox messages back to pending and exit")
+
+    # ===== Maintenance =====
+    parser.add_argument("--sweep", action="store_true", help="Run one sweeper pass now (expired sessions, old revocations, idle activations) and exit")
+    parser.add_argument("--archive-now", action="store_true", help="Move every order closed more than ARCHIVE_AFTER_DAYS ago to ARCHIVE_DB_PATH and exit")
+
     args = parser.parse_args()
 
     print(f"[SERVER] DB: {DB_PATH}")
@@ -1486,6 +4693,7 @@ if __name__ == "__main__":
                             revoke_all_tokens_for(str(uname))
                 except Exception:
                     pass
+            SESSIONS.flush_auth_everywhere()
 
             cur.execute("SELECT license_key, active, app, max_devices, max_users, max_active_devices, expires_at, company, note, created_at FROM license_keys WHERE license_key=?", (key,))
             updated = cur.fetchone()
@@ -1570,6 +4778,7 @@ if __name__ == "__main__":
             cur.execute("DELETE FROM license_keys WHERE license_key=?", (key,))
 
             conn.commit()
+            SESSIONS.flush_auth_everywhere()
         finally:
             conn.close()
 
@@ -1660,8 +4869,18 @@ if __name__ == "__main__":
             device_id = (u["device_id"] or "").strip()
             lk = (u["license_key_used"] or "").strip()
 
-            # delete offers created by this transport user
+            # delete offers created by this transport user; each touched order gets a change row so its
+            # /market/offers/<id> ETag moves and managers stop getting 304 with the deleted offers
+            cur.execute(
+                "SELECT DISTINCT f.order_id, o.username FROM market_offers f "
+                "LEFT JOIN orders o ON o.id = f.order_id WHERE f.transport_username=?",
+                (username,),
+            )
+            offered = [(int(r["order_id"]), r["username"]) for r in cur.fetchall()]
             cur.execute("DELETE FROM market_offers WHERE transport_username=?", (username,))
+            for offer_order_id, offer_owner in offered:
+                record_change(cur, "offer_deleted", order_id=offer_order_id, owner=offer_owner, actor=username,
+                              payload={"order_id": offer_order_id, "transport_username": username})
 
             # delete orders created by this user + related market rows
             cur.execute("SELECT id FROM orders WHERE username=?", (username,))
@@ -1671,6 +4890,17 @@ if __name__ == "__main__":
                 cur.execute(f"DELETE FROM market_offers WHERE order_id IN ({q_marks})", order_ids)
                 cur.execute(f"DELETE FROM market_orders WHERE order_id IN ({q_marks})", order_ids)
                 cur.execute(f"DELETE FROM orders WHERE id IN ({q_marks})", order_ids)
+                record_change(cur, "orders_deleted", owner=username, public=True, payload={"order_ids": order_ids})
+
+            # archived history goes too (separate file: committed on its own, same as the archiver's copy step)
+            if ARCHIVE_DB_PATH:
+                cur.execute("DELETE FROM archive.market_offers WHERE transport_username=?", (username,))
+                cur.execute(
+                    "DELETE FROM archive.market_offers WHERE order_id IN (SELECT id FROM archive.orders WHERE username=?)",
+                    (username,),
+                )
+                cur.execute("DELETE FROM archive.market_orders WHERE order_id IN (SELECT id FROM archive.orders WHERE username=?)", (username,))
+                cur.execute("DELETE FROM archive.orders WHERE username=?", (username,))
 
             # delete license activations for this device/key (best-effort)
             if lk and device_id:
@@ -1687,12 +4917,57 @@ if __name__ == "__main__":
             conn.close()
 
         revoke_all_tokens_for(username)
+        if lk and device_id:
+            SESSIONS.flush_auth_everywhere()  # the freed device slot must be visible to cached license state
         print("DELETED_USER:", username)
 
+    def _outbox_status():
+        conn = db_connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT status, COUNT(*) AS n FROM outbox GROUP BY status")
+            for r in cur.fetchall():
+                print(f"{r['status']}: {r['n']}")
+            cur.execute("SELECT id, kind, attempts, last_error, created_at FROM outbox WHERE status='dead' ORDER BY id DESC LIMIT 20")
+            for r in cur.fetchall():
+                print(f"DEAD #{r['id']} {r['kind']} attempts={r['attempts']} created_at={r['created_at']} error={r['last_error']}")
+        finally:
+            conn.close()
+
+    def _outbox_requeue_dead():
+        conn = db_connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("UPDATE outbox SET status='pending', attempts=0, next_attempt_at=? WHERE status='dead'", (now_ts(),))
+            conn.commit()
+            print("REQUEUED:", cur.rowcount)
+        finally:
+            conn.close()
+
     if args.delete_user:
         _delete_user_forever(args.delete_user)
         raise SystemExit(0)
 
+    if args.outbox_status:
+        _outbox_status()
+        raise SystemExit(0)
+
+    if args.outbox_requeue_dead:
+        _outbox_requeue_dead()
+        raise SystemExit(0)
+
+    if args.archive_now:
+        if not ARCHIVE_DB_PATH:
+            print("ERROR: ARCHIVE_DB_PATH is not set")
+            raise SystemExit(2)
+        print("ARCHIVED_ORDERS:", archive_closed_orders(max_batches=1_000_000))
+        raise SystemExit(0)
+
+    if args.sweep:
+        for table, n in SWEEPER.sweep_once().items():
+            print(f"{table}: {n}")
+        raise SystemExit(0)
+
     if args.disable_key:
         _set_license_active(args.disable_key, 0)
         raise SystemExit(0)
@@ -1769,9 +5044,15 @@ if __name__ == "__main__":
         _list_activations(args.key, args.activations_limit)
         raise SystemExit(0)
 
+    if args.serve:
+        print(f"[SERVER] TELEGRAM_ENABLED env: {TELEGRAM_ENABLED}")
+        serve_production()
+        raise SystemExit(0)
+
     # default: run server
     if args.run or (not args.keygen and not args.list_keys and not args.list_active_keys and not args.list_users and not args.users_count
                     and not args.disable_key and not args.enable_key and not args.set_key_company and not args.list_activations and not args.delete_user):
         print(f"[SERVER] TELEGRAM_ENABLED env: {TELEGRAM_ENABLED}")
+        start_runtime()
         app.run(host=HOST, port=PORT, debug=False)
-
+
@@ -14,6 +14,7 @@ import tkinter as tk
 from tkinter import ttk
 
 import requests
+from client_http import backoff_remaining, enable_conditional_get, enable_rate_limit_backoff, iter_sse_events
 
 from market_stats_popup import open_market_stats_popup
 
@@ -25,6 +26,7 @@ LOGIN_BG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "login_
 API_URL = os.getenv("API_URL", "http://34.179.169.197")
 
 POLL_INTERVAL_MS = 4000
+FEED_READ_TIMEOUT = 60  # /market/feed шлёт heartbeat каждые ~15 с
 HTTP_TIMEOUT = 8
 MY_ANSWERS_WINDOW_HOURS = 48
 MY_ANSWERS_WINDOW_SECONDS = MY_ANSWERS_WINDOW_HOURS * 3600
@@ -637,6 +639,8 @@ class TransportApp:
 
         self.http = requests.Session()
         self.http.headers.update(self.headers)
+        enable_rate_limit_backoff(self.http)
+        enable_conditional_get(self.http)
 
         # Wrap all HTTP requests: if server says the license is disabled/expired, force-exit the app.
         _orig_request = self.http.request
@@ -684,6 +688,11 @@ class TransportApp:
         self.polling_active = False
         self.auto_refresh_enabled = True
         self.orders_by_item: Dict[str, IncomingOrder] = {}
+
+        # живая лента рынка (/market/feed): пока подключена, полный список не перекачиваем
+        self.feed_token: Optional[str] = None
+        self.feed_connected = False
+        self._feed_stop = threading.Event()
         self.sent_offers: Dict[int, Dict[str, Any]] = {}
 
         self._load_local_offers()
@@ -711,6 +720,7 @@ class TransportApp:
         self._update_profile_labels()
         self._refresh_incoming_orders(initial=True)
         self._start_polling()
+        threading.Thread(target=self._market_feed_loop, daemon=True).start()
 
     def _process_ui_queue(self):
         try:
@@ -899,6 +909,7 @@ class TransportApp:
     def _logout(self):
         try:
             self._stop_polling()
+            self._feed_stop.set()
         except Exception:
             pass
 
@@ -1608,6 +1619,10 @@ class TransportApp:
                 self._stop_polling()
                 return
 
+            if resp.status_code == 429:
+                # сервер просит притормозить; следующий тик подождёт Retry-After
+                return
+
             if resp.status_code != 200:
                 j = safe_json(resp)
                 warn(self.root, "Сервер", f"Не удалось получить заявки: {resp.status_code}\n{j or resp.text}")
@@ -1638,41 +1653,10 @@ class TransportApp:
             self.orders_by_item.clear()
 
             for o in orders:
-                try:
-                    oid = int(o.get("id"))
-                except Exception:
+                order = self._order_from_row(o)
+                if order is None:
                     continue
-
-                order = IncomingOrder(
-                    id=oid,
-                    direction=str(repair_mojibake_text(o.get("direction") or "")),
-                    cargo=str(repair_mojibake_text(o.get("cargo") or "")),
-                    tonnage=float(o.get("tonnage") or 0),
-                    truck=str(repair_mojibake_text(o.get("truck") or "")),
-                    date=str(repair_mojibake_text(o.get("date") or "")),
-                    budget_price=float(o.get("price") or 0),
-                    info=str(repair_mojibake_text(o.get("info") or "")),
-                    from_company=str(repair_mojibake_text(o.get("from_company") or "")),
-                )
-
-                cargo_disp = f"{order.cargo} {order.tonnage}т".strip()
-                my_offer = self.sent_offers.get(order.id, {}).get("price", "")
-
-                item = self.tree.insert(
-                    "",
-                    "end",
-                    values=(
-                        UNCHECKED,
-                        order.id,
-                        order.direction,
-                        cargo_disp,
-                        order.truck,
-                        order.date,
-                        f"{order.budget_price}$" if order.budget_price else "",
-                        order.info,
-                        f"{my_offer}$" if my_offer else "",
-                    ),
-                )
+                item = self.tree.insert("", "end", values=self._order_row_values(order))
                 self.orders_by_item[item] = order
 
             if initial:
@@ -1680,6 +1664,119 @@ class TransportApp:
 
         self._run_http_async(work, on_ok=on_ok)
 
+    def _order_from_row(self, o: Dict[str, Any]) -> Optional[IncomingOrder]:
+        try:
+            oid = int(o.get("id"))
+        except Exception:
+            return None
+
+        return IncomingOrder(
+            id=oid,
+            direction=str(repair_mojibake_text(o.get("direction") or "")),
+            cargo=str(repair_mojibake_text(o.get("cargo") or "")),
+            tonnage=float(o.get("tonnage") or 0),
+            truck=str(repair_mojibake_text(o.get("truck") or "")),
+            date=str(repair_mojibake_text(o.get("date") or "")),
+            budget_price=float(o.get("price") or 0),
+            info=str(repair_mojibake_text(o.get("info") or "")),
+            from_company=str(repair_mojibake_text(o.get("from_company") or "")),
+        )
+
+    def _order_row_values(self, order: IncomingOrder) -> Tuple[Any, ...]:
+        cargo_disp = f"{order.cargo} {order.tonnage}т".strip()
+        my_offer = self.sent_offers.get(order.id, {}).get("price", "")
+        return (
+            UNCHECKED,
+            order.id,
+            order.direction,
+            cargo_disp,
+            order.truck,
+            order.date,
+            f"{order.budget_price}$" if order.budget_price else "",
+            order.info,
+            f"{my_offer}$" if my_offer else "",
+        )
+
+    def _find_order_item(self, order_id: int) -> Optional[str]:
+        for item, order in self.orders_by_item.items():
+            if int(order.id) == int(order_id):
+                return item
+        return None
+
+    def _apply_market_delta(self, event: str, data: Dict[str, Any]):
+        """Применяет одно событие ленты к таблице, не перекачивая весь список."""
+        if not self.auto_refresh_enabled:
+            # авто-обновление на паузе; при включении список перечитывается целиком
+            return
+        if event in ("order_opened", "order_updated"):
+            order = self._order_from_row(data)
+            if order is None:
+                return
+            item = self._find_order_item(order.id)
+            if item is not None:
+                # сохраняем галочку пользователя
+                old_vals = list(self.tree.item(item, "values") or [])
+                vals = list(self._order_row_values(order))
+                if old_vals:
+                    vals[0] = old_vals[0]
+                self.tree.item(item, values=vals)
+                self.orders_by_item[item] = order
+            elif event == "order_opened":
+                # список отсортирован от новых к старым
+                item = self.tree.insert("", 0, values=self._order_row_values(order))
+                self.orders_by_item[item] = order
+        elif event in ("orders_closed", "order_closed"):
+            ids = data.get("ids") if event == "orders_closed" else [data.get("id")]
+            wanted = set()
+            for oid in ids or []:
+                try:
+                    wanted.add(int(oid))
+                except Exception:
+                    pass
+            # одно событие на всю пачку: один проход по таблице
+            for item, order in list(self.orders_by_item.items()):
+                if int(order.id) in wanted:
+                    self.tree.delete(item)
+                    self.orders_by_item.pop(item, None)
+
+    def _market_feed_loop(self):
+        """Фоновый поток: держит /market/feed и передаёт дельты в UI-поток."""
+        backoff = 2
+        http = requests.Session()
+        http.headers.update(self.headers)
+        while not self._feed_stop.is_set():
+            try:
+                headers = {"Last-Event-ID": self.feed_token} if self.feed_token else {}
+                with http.get(f"{API_URL}/market/feed", headers=headers, stream=True,
+                              timeout=(HTTP_TIMEOUT, FEED_READ_TIMEOUT)) as r:
+                    if r.status_code in (401, 403, 404):
+                        # сессия/лицензия закончились или сервер без ленты — остаёмся на опросе
+                        return
+                    if r.status_code != 200:
+                        raise RuntimeError(f"HTTP {r.status_code}")
+                    self.feed_connected = True
+                    backoff = 2
+                    for event, event_id, data in iter_sse_events(r):
+                        if self._feed_stop.is_set():
+                            return
+                        if event_id:
+                            self.feed_token = event_id
+                        if event == "reset":
+                            # продолжить с прежнего места нельзя — один раз перечитываем весь список
+                            self.ui_queue.put(lambda: self._refresh_incoming_orders())
+                            continue
+                        try:
+                            payload = json.loads(data)
+                        except Exception:
+                            continue
+                        self.ui_queue.put(lambda ev=event, pl=payload: self._apply_market_delta(ev, pl))
+            except Exception:
+                pass
+            finally:
+                self.feed_connected = False
+            self._feed_stop.wait(backoff)
+            backoff = min(backoff * 2, 30)
+
     def _send_offer(self):
         order = self._selected_order()
         if not order:
@@ -1758,6 +1855,7 @@ class TransportApp:
         self._update_auto_btn()
         if self.auto_refresh_enabled:
             self.status_lbl.config(text="Авто-обновление включено")
+            self._refresh_incoming_orders()
         else:
             self.status_lbl.config(text="Авто-обновление выключено")
 
@@ -1777,7 +1875,9 @@ class TransportApp:
     def _poll_tick(self):
         if not self.polling_active:
             return
-        if self.auto_refresh_enabled:
+        # при живой ленте изменения приходят дельтами — полный список не нужен
+        # после 429 тики пропускаются, пока не истечёт Retry-After
+        if self.auto_refresh_enabled and not self.feed_connected and backoff_remaining(self.http) <= 0:
             self._refresh_incoming_orders()
         self.root.after(POLL_INTERVAL_MS, self._poll_tick)
 